@@ -38,7 +38,7 @@ INSTALLED_APPS = (
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'tinymce',  # 富文本编辑器
-    # 'haystack',  # 全文检索框架
+    'haystack',  # 全文检索框架
     'user',  # 用户模块
     'goods',  # 商品模块
     'cart',  # 购物车模块
@@ -166,14 +166,37 @@ FDFS_CLIENT_CONF = './utils/fdfs/client.conf'
 FDFS_NGINX_URL = 'http://192.168.0.102:8888/'
 
 # 全文搜索引擎
-# HAYSTACK_CONNECTIONS = {
-#   'default': {
-#       # 使用whoosh引擎
-#       'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
-#       # 索引文件路径
-#       'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
-#   }
-# }
-
-# 当添加、修改、删除数据时，自动生成索引
-# HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+HAYSTACK_CONNECTIONS = {
+  'default': {
+      # 使用whoosh引擎
+      'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
+      # 索引文件路径
+      'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
+  }
+}
+
+# 当添加、修改、删除数据时，把商品id加入队列，由celery任务批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'goods.search_signals.QueuedSignalProcessor'
+
+# 指定搜索结果每页显示的条数
+HAYSTACK_SEARCH_RESULTS_PER_PAGE = 1
+
+# 订单id中的主机编号(0-31)，为None时使用主机名的哈希，多台主机部署时应该分别指定
+SNOWFLAKE_HOST_ID = None
+
+# 用户中心显示、redis中保存的浏览记录的数目
+HISTORY_LENGTH = 5
+
+# 异步下单: 下单请求放入队列立即返回，由celery按批创建订单，前端轮询处理结果
+ORDER_ASYNC_COMMIT = False
+
+# 支付宝异步通知的地址，需要能从外网访问
+ALIPAY_NOTIFY_URL = 'http://127.0.0.1:8000/order/notify'
+
+# 支付网关，本地开发和压测时可以使用stub网关:
+# {'BACKEND': 'order.gateway.StubGateway', 'APPID': '2016090800464004', 'URL': 'http://127.0.0.1:8090'}
+PAYMENT_GATEWAY = {
+    'BACKEND': 'order.gateway.AlipayGateway',
+    'APPID': '2016090800464004',
+    'URL': 'https://openapi.alipaydev.com/gateway.do',
+}
@@ -20,7 +20,7 @@ from django.contrib import admin
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^tinymce/', include('tinymce.urls')),  # 富文本编辑器
-    # url(r'^search/', include('haystack.urls')),  # 全文检索
+    url(r'^search/', include('haystack.urls')),  # 全文检索
     # url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
     url(r'^user/', include('user.urls', namespace='user')),  # 用户模块
     url(r'^cart/', include('cart.urls', namespace='cart')),  # 购物车模块
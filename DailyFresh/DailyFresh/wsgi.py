@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DailyFresh.settings")
 
 application = get_wsgi_application()
+
+# 在fork出工作进程之前创建支付网关，密钥只读取解析一次
+from order.gateway import get_gateway
+get_gateway()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from cart.store import user_cart, rebuild_cart_summary
+import re
+
+
+class Command(BaseCommand):
+    help = '根据redis中的购物车记录重新生成所有购物车的汇总(商品总件数和条目数)'
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        pattern = re.compile(r'^cart_(\d+)$')
+
+        count = 0
+        for key in conn.scan_iter('cart_*', count=1000):
+            match = pattern.match(key.decode() if isinstance(key, bytes) else key)
+            if match is None:
+                # 购物车的汇总等其他key
+                continue
+            rebuild_cart_summary(user_cart(int(match.group(1))))
+            count += 1
+
+        self.stdout.write('重新生成了%d个购物车的汇总' % count)
@@ -0,0 +1,347 @@
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from collections import namedtuple
+
+
+# 购物车数据的存储
+# 每个用户的购物车保存在redis的hash中 cart_用户id: {'sku_id': 商品数目}
+# 同时在cart_summary_用户id: {'count': 商品总件数, 'items': 商品条目数}中保存购物车的汇总
+# 修改购物车的同时在lua脚本中原子地更新汇总，返回总件数时不需要读取整个购物车
+# 没有登录的用户的购物车按照session保存在cart_guest_session_key中，设置较短的过期时间，登录时合并到用户的购物车
+
+# 汇总不存在时(升级之前的购物车)根据购物车记录生成
+# KEYS[1]: 购物车 KEYS[2]: 汇总
+CART_SUMMARY_INIT = '''
+if redis.call('exists', KEYS[2]) == 0 then
+    local count = 0
+    local vals = redis.call('hvals', KEYS[1])
+    for i = 1, #vals do
+        count = count + tonumber(vals[i])
+    end
+    redis.call('hmset', KEYS[2], 'count', count, 'items', #vals)
+end
+'''
+
+# 设置商品的数目，返回{商品总件数, 商品条目数}
+# ARGV[1]: 商品id ARGV[2]: 商品数目
+CART_SET_SCRIPT = CART_SUMMARY_INIT + '''
+local old = redis.call('hget', KEYS[1], ARGV[1])
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+if not old then
+    old = 0
+    redis.call('hincrby', KEYS[2], 'items', 1)
+end
+local count = redis.call('hincrby', KEYS[2], 'count', tonumber(ARGV[2]) - tonumber(old))
+return {count, tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+# 删除商品，返回{商品总件数, 商品条目数}
+# ARGV: 商品id
+CART_DELETE_SCRIPT = CART_SUMMARY_INIT + '''
+local count = 0
+local items = 0
+for i = 1, #ARGV do
+    local old = redis.call('hget', KEYS[1], ARGV[i])
+    if old then
+        redis.call('hdel', KEYS[1], ARGV[i])
+        count = count + tonumber(old)
+        items = items + 1
+    end
+end
+redis.call('hincrby', KEYS[2], 'items', -items)
+count = redis.call('hincrby', KEYS[2], 'count', -count)
+return {count, tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+# 商品的库存上限，添加购物车时在脚本中判断库存，不需要查询数据库
+# sku_stock: {'sku_id': 库存}，商品库存变化时更新
+SKU_STOCK_KEY = 'sku_stock'
+
+# 添加商品，返回{状态, 商品总件数, 商品条目数}
+# 状态: 1 添加成功 0 没有缓存商品的库存 -1 库存不足
+# KEYS[3]: 商品的库存
+# ARGV[1]: 商品id ARGV[2]: 增加的数目
+CART_ADD_SCRIPT = '''
+local stock = redis.call('hget', KEYS[3], ARGV[1])
+if not stock then
+    return {0, 0, 0}
+end
+''' + CART_SUMMARY_INIT + '''
+local old = redis.call('hget', KEYS[1], ARGV[1])
+local count = tonumber(old or 0) + tonumber(ARGV[2])
+if count > tonumber(stock) then
+    return {-1, tonumber(redis.call('hget', KEYS[2], 'count')), tonumber(redis.call('hget', KEYS[2], 'items'))}
+end
+redis.call('hset', KEYS[1], ARGV[1], count)
+if not old then
+    redis.call('hincrby', KEYS[2], 'items', 1)
+end
+count = redis.call('hincrby', KEYS[2], 'count', ARGV[2])
+return {1, count, tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+# 把未登录时的购物车合并到用户的购物车，数目累加，超过库存时取库存，返回{商品总件数, 商品条目数}
+# 没有缓存库存的商品不限制数目，这些商品添加到未登录的购物车时已经判断过库存
+# KEYS[4]: 未登录时的购物车 KEYS[5]: 未登录时的购物车的汇总
+CART_MERGE_SCRIPT = CART_SUMMARY_INIT + '''
+local guest = redis.call('hgetall', KEYS[4])
+local count = 0
+local items = 0
+for i = 1, #guest, 2 do
+    local old = redis.call('hget', KEYS[1], guest[i])
+    local origin = tonumber(old or 0)
+    local new = origin + tonumber(guest[i + 1])
+    local stock = redis.call('hget', KEYS[3], guest[i])
+    if stock and new > tonumber(stock) then
+        new = math.max(origin, tonumber(stock))
+    end
+    if new > origin then
+        redis.call('hset', KEYS[1], guest[i], new)
+        count = count + new - origin
+        if not old then
+            items = items + 1
+        end
+    end
+end
+redis.call('del', KEYS[4], KEYS[5])
+redis.call('hincrby', KEYS[2], 'items', items)
+count = redis.call('hincrby', KEYS[2], 'count', count)
+return {count, tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+# 批量修改购物车，返回{商品总件数, 商品条目数}
+# ARGV: 商品id1, 数目1, 商品id2, 数目2, ...，数目为0表示删除
+CART_BATCH_SCRIPT = CART_SUMMARY_INIT + '''
+local count = 0
+local items = 0
+for i = 1, #ARGV, 2 do
+    local old = redis.call('hget', KEYS[1], ARGV[i])
+    local new = tonumber(ARGV[i + 1])
+    if new > 0 then
+        redis.call('hset', KEYS[1], ARGV[i], new)
+        count = count + new - tonumber(old or 0)
+        if not old then
+            items = items + 1
+        end
+    elseif old then
+        redis.call('hdel', KEYS[1], ARGV[i])
+        count = count - tonumber(old)
+        items = items - 1
+    end
+end
+redis.call('hincrby', KEYS[2], 'items', items)
+count = redis.call('hincrby', KEYS[2], 'count', count)
+return {count, tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+# 根据购物车记录重新生成汇总，返回{商品总件数, 商品条目数}
+CART_REBUILD_SCRIPT = '''
+redis.call('del', KEYS[2])
+''' + CART_SUMMARY_INIT + '''
+return {tonumber(redis.call('hget', KEYS[2], 'count')), tonumber(redis.call('hget', KEYS[2], 'items'))}
+'''
+
+
+# 未登录的用户的购物车的过期时间，每次修改之后重新计算
+GUEST_CART_TIMEOUT = 3 * 24 * 3600
+
+# 购物车在redis中的key: 购物车、汇总、过期时间(None表示不过期)
+Cart = namedtuple('Cart', ['key', 'summary_key', 'timeout'])
+
+
+def cart_key(user_id):
+    '''用户购物车的key'''
+    return 'cart_%d' % user_id
+
+
+def cart_summary_key(user_id):
+    '''用户购物车汇总的key'''
+    return 'cart_summary_%d' % user_id
+
+
+def user_cart(user_id):
+    '''登录用户的购物车'''
+    return Cart(cart_key(user_id), cart_summary_key(user_id), None)
+
+
+def guest_cart(session_key):
+    '''没有登录的用户按照session保存的购物车'''
+    return Cart('cart_guest_%s' % session_key, 'cart_summary_guest_%s' % session_key, GUEST_CART_TIMEOUT)
+
+
+def request_cart(request, create=False):
+    '''
+    获取当前请求的购物车，没有登录时使用session中的购物车
+    create为False并且没有session时返回None，为True时创建session
+    '''
+    user = request.user
+    if user.is_authenticated():
+        return user_cart(user.id)
+
+    session = request.session
+    if session.session_key is None:
+        if not create:
+            return None
+        # 保存session生成session_key，标记为修改过，应答中才会设置sessionid cookie
+        session.save()
+        session.modified = True
+    return guest_cart(session.session_key)
+
+
+def _run(script, cart, keys, args):
+    '''执行修改购物车的脚本，未登录的购物车同时更新过期时间，只需要一次网络往返'''
+    conn = get_redis_connection('default')
+    script = conn.register_script(script)
+    if cart.timeout is None:
+        return script(keys=keys, args=args)
+
+    pipe = conn.pipeline(transaction=False)
+    script(keys=keys, args=args, client=pipe)
+    pipe.expire(cart.key, cart.timeout)
+    pipe.expire(cart.summary_key, cart.timeout)
+    return pipe.execute()[0]
+
+
+def _run_cart(script, cart, args):
+    '''执行修改购物车的脚本，返回(商品总件数, 商品条目数)'''
+    count, items = _run(script, cart, [cart.key, cart.summary_key], args)
+    return int(count), int(items)
+
+
+class StockError(Exception):
+    '''商品库存不足'''
+    pass
+
+
+def add_cart_count(cart, sku_id, count):
+    '''
+    增加购物车中商品的数目，返回(商品总件数, 商品条目数)
+    增加之后的数目超过库存时抛出StockError，商品不存在时抛出GoodsSKU.DoesNotExist
+    一次脚本调用完成读取、判断库存、修改，只在没有缓存商品的库存时查询数据库
+    '''
+    keys = [cart.key, cart.summary_key, SKU_STOCK_KEY]
+    args = [int(sku_id), int(count)]
+
+    status, total_count, items = _run(CART_ADD_SCRIPT, cart, keys, args)
+    if status == 0:
+        # 没有缓存商品的库存，从数据库中加载之后重新执行
+        stock = GoodsSKU.objects.values_list('stock', flat=True).get(id=int(sku_id))
+        set_sku_stock(sku_id, stock)
+        status, total_count, items = _run(CART_ADD_SCRIPT, cart, keys, args)
+
+    if status == -1:
+        raise StockError('商品库存不足')
+    return int(total_count), int(items)
+
+
+def set_sku_stock(sku_id, stock):
+    '''更新缓存的商品库存'''
+    conn = get_redis_connection('default')
+    conn.hset(SKU_STOCK_KEY, int(sku_id), stock)
+
+
+def refresh_sku_stock(sku_ids):
+    '''商品的库存变化之后，根据数据库更新缓存的库存'''
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return
+
+    conn = get_redis_connection('default')
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    pipe = conn.pipeline(transaction=False)
+    if stocks:
+        pipe.hmset(SKU_STOCK_KEY, stocks)
+    # 已经删除的商品
+    deleted = [sku_id for sku_id in sku_ids if sku_id not in stocks]
+    if deleted:
+        pipe.hdel(SKU_STOCK_KEY, *deleted)
+    pipe.execute()
+
+
+def set_cart_count(cart, sku_id, count):
+    '''设置购物车中商品的数目，返回(商品总件数, 商品条目数)'''
+    return _run_cart(CART_SET_SCRIPT, cart, [int(sku_id), int(count)])
+
+
+def delete_cart_items(cart, sku_ids):
+    '''删除购物车中的商品，返回(商品总件数, 商品条目数)'''
+    return _run_cart(CART_DELETE_SCRIPT, cart, [int(sku_id) for sku_id in sku_ids])
+
+
+def update_cart_items(cart, items):
+    '''批量修改购物车，items: [(商品id, 数目), ...]，数目为0表示删除，返回(商品总件数, 商品条目数)'''
+    args = []
+    for sku_id, count in items:
+        args.extend([int(sku_id), int(count)])
+    return _run_cart(CART_BATCH_SCRIPT, cart, args)
+
+
+def rebuild_cart_summary(cart):
+    '''根据购物车记录重新生成汇总，返回(商品总件数, 商品条目数)'''
+    return _run_cart(CART_REBUILD_SCRIPT, cart, [])
+
+
+def merge_guest_cart(session_key, user_id):
+    '''登录时把未登录时的购物车合并到用户的购物车，一次脚本调用完成，返回(商品总件数, 商品条目数)'''
+    guest = guest_cart(session_key)
+    cart = user_cart(user_id)
+    keys = [cart.key, cart.summary_key, SKU_STOCK_KEY, guest.key, guest.summary_key]
+    count, items = _run(CART_MERGE_SCRIPT, cart, keys, [])
+    return int(count), int(items)
+
+
+def get_cart_count(cart):
+    '''获取购物车商品的条目数'''
+    if cart is None:
+        return 0
+    conn = get_redis_connection('default')
+    return conn.hlen(cart.key)
+
+
+def get_cart_skus(cart, sku_ids=None):
+    '''
+    获取购物车中的商品，sku_ids为None时获取购物车中所有的商品
+    一次HMGET(HGETALL)读取数目，一次id__in查询获取商品信息
+    返回(商品列表, 总件数, 总金额)，商品对象上增加了count(数目)和amount(小计)属性
+    不存在、已经下线或者不在购物车中的商品不返回
+    '''
+    if cart is None:
+        return [], 0, 0
+
+    conn = get_redis_connection('default')
+    key = cart.key
+
+    if sku_ids is None:
+        # 按照sku_id排序，页面上的顺序是固定的
+        items = sorted((int(sku_id), count) for sku_id, count in conn.hgetall(key).items())
+    else:
+        sku_ids = [int(sku_id) for sku_id in sku_ids]
+        items = list(zip(sku_ids, conn.hmget(key, sku_ids))) if sku_ids else []
+
+    # 去掉不在购物车中的商品
+    items = [(sku_id, int(count)) for sku_id, count in items if count is not None]
+    if not items:
+        return [], 0, 0
+
+    # 只查询上线的商品
+    skus = GoodsSKU.objects.filter(id__in=[sku_id for sku_id, count in items], status=1)
+    skus = {sku.id: sku for sku in skus}
+
+    result = []
+    total_count = 0
+    total_price = 0
+    for sku_id, count in items:
+        sku = skus.get(sku_id)
+        if sku is None:
+            # 商品不存在或者已经下线
+            continue
+        # 动态给sku对象增加属性amount和count, 分别保存商品的小计和购物车中商品的数量
+        sku.count = count
+        sku.amount = sku.price * count
+        result.append(sku)
+        # 累加计算商品的总件数和总价格
+        total_count += count
+        total_price += sku.amount
+
+    return result, total_count, total_price
@@ -1,3 +1,200 @@
-from django.test import TestCase
+from django.test import TestCase, Client
+from django_redis import get_redis_connection
+
+from goods.models import GoodsType, Goods, GoodsSKU
+from cart.store import cart_key, cart_summary_key, user_cart, guest_cart, merge_guest_cart, get_cart_skus, \
+    set_cart_count, add_cart_count, delete_cart_items, update_cart_items, rebuild_cart_summary, StockError, \
+    SKU_STOCK_KEY
+from decimal import Decimal
+import json
 
 # Create your tests here.
+
+
+class CartSkusTest(TestCase):
+    '''购物车商品批量获取的测试'''
+
+    user_id = 999999
+    cart = user_cart(user_id)
+
+    def setUp(self):
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        goods = Goods.objects.create(name='苹果')
+        self.skus = []
+        for i in range(30):
+            self.skus.append(GoodsSKU.objects.create(type=type, goods=goods, name='苹果%d' % i, desc='苹果',
+                                                     price=Decimal('1.50'), unite='500g', image='sku/%d.jpg' % i,
+                                                     stock=100, sales=0, status=1))
+
+        self.conn = get_redis_connection('default')
+        self.key = cart_key(self.user_id)
+        self.conn.delete(self.key)
+        self.addCleanup(self.conn.delete, self.key)
+        for sku in self.skus:
+            self.conn.hset(self.key, sku.id, 2)
+
+    def test_one_query_for_whole_cart(self):
+        '''不论购物车中有多少商品，只查询一次数据库'''
+        with self.assertNumQueries(1):
+            skus, total_count, total_price = get_cart_skus(self.cart)
+
+        self.assertEqual([sku.id for sku in skus], sorted(sku.id for sku in self.skus))
+        self.assertEqual(total_count, 60)
+        self.assertEqual(total_price, Decimal('90.00'))
+        self.assertEqual(skus[0].amount, Decimal('3.00'))
+
+    def test_selected_skus(self):
+        '''只获取选中的商品，保持选中的顺序'''
+        sku_ids = [self.skus[2].id, self.skus[0].id]
+        with self.assertNumQueries(1):
+            skus, total_count, total_price = get_cart_skus(self.cart, [str(sku_id) for sku_id in sku_ids])
+
+        self.assertEqual([sku.id for sku in skus], sku_ids)
+        self.assertEqual(total_count, 4)
+
+    def test_drop_missing_and_offline(self):
+        '''删除、下线以及不在购物车中的商品不返回'''
+        offline = self.skus[0]
+        offline.status = 0
+        offline.save()
+        deleted_id = self.skus[1].id
+        self.skus[1].delete()
+        self.conn.hdel(self.key, self.skus[2].id)
+
+        skus, total_count, total_price = get_cart_skus(self.cart, [offline.id, deleted_id, self.skus[2].id, self.skus[3].id])
+
+        self.assertEqual([sku.id for sku in skus], [self.skus[3].id])
+        self.assertEqual(total_count, 2)
+
+
+class CartSummaryTest(TestCase):
+    '''购物车汇总的测试'''
+
+    user_id = 999999
+    cart = user_cart(user_id)
+
+    def setUp(self):
+        self.conn = get_redis_connection('default')
+        self.keys = [cart_key(self.user_id), cart_summary_key(self.user_id)]
+        self.conn.delete(*self.keys)
+        self.addCleanup(self.conn.delete, *self.keys)
+
+    def test_set_and_delete(self):
+        '''修改购物车时同时更新总件数和条目数'''
+        self.assertEqual(set_cart_count(self.cart, 1, 2), (2, 1))
+        self.assertEqual(set_cart_count(self.cart, 2, 3), (5, 2))
+        # 修改已有商品的数目
+        self.assertEqual(set_cart_count(self.cart, 1, 5), (8, 2))
+        # 不在购物车中的商品不影响汇总
+        self.assertEqual(delete_cart_items(self.cart, [1, 3]), (3, 1))
+
+    def test_batch(self):
+        '''批量修改和删除，同时更新总件数和条目数'''
+        set_cart_count(self.cart, 1, 2)
+        set_cart_count(self.cart, 2, 3)
+        self.assertEqual(update_cart_items(self.cart, [(1, 4), (2, 0), (3, 1), (4, 0)]), (5, 2))
+        self.assertEqual(self.conn.hgetall(self.cart.key), {b'1': b'4', b'3': b'1'})
+
+    def test_init_from_existing_cart(self):
+        '''汇总不存在时根据购物车记录生成'''
+        self.conn.hmset(cart_key(self.user_id), {1: 2, 2: 3})
+        self.assertEqual(set_cart_count(self.cart, 3, 1), (6, 3))
+
+        # 汇总和购物车不一致时可以重新生成
+        self.conn.hset(cart_key(self.user_id), 4, 10)
+        self.assertEqual(rebuild_cart_summary(self.cart), (16, 4))
+
+
+class CartAddTest(TestCase):
+    '''添加购物车的测试'''
+
+    user_id = 999999
+    cart = user_cart(user_id)
+
+    def setUp(self):
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        goods = Goods.objects.create(name='苹果')
+        self.sku = GoodsSKU.objects.create(type=type, goods=goods, name='苹果', desc='苹果', price=Decimal('1.50'),
+                                           unite='500g', image='sku/1.jpg', stock=5, sales=0, status=1)
+
+        self.conn = get_redis_connection('default')
+        keys = [cart_key(self.user_id), cart_summary_key(self.user_id)]
+        self.conn.delete(*keys)
+        self.addCleanup(self.conn.delete, *keys)
+        self.addCleanup(self.conn.hdel, SKU_STOCK_KEY, self.sku.id)
+
+    def test_stock_ceiling(self):
+        '''累加之后超过库存时不修改购物车'''
+        self.assertEqual(add_cart_count(self.cart, self.sku.id, 3), (3, 1))
+        with self.assertRaises(StockError):
+            add_cart_count(self.cart, self.sku.id, 3)
+        self.assertEqual(int(self.conn.hget(cart_key(self.user_id), self.sku.id)), 3)
+
+    def test_stock_cache(self):
+        '''缓存了库存时不查询数据库，库存变化时更新缓存'''
+        self.conn.hdel(SKU_STOCK_KEY, self.sku.id)
+        with self.assertNumQueries(1):
+            add_cart_count(self.cart, self.sku.id, 1)
+        with self.assertNumQueries(0):
+            add_cart_count(self.cart, self.sku.id, 1)
+
+        self.sku.stock = 2
+        self.sku.save()
+        with self.assertRaises(StockError):
+            add_cart_count(self.cart, self.sku.id, 1)
+
+    def test_missing_sku(self):
+        '''商品不存在'''
+        with self.assertRaises(GoodsSKU.DoesNotExist):
+            add_cart_count(self.cart, 0, 1)
+
+
+class GuestCartTest(TestCase):
+    '''未登录时的购物车的测试'''
+
+    user_id = 999999
+    session_key = 'guestcarttest'
+
+    def setUp(self):
+        self.cart = user_cart(self.user_id)
+        self.guest = guest_cart(self.session_key)
+        self.conn = get_redis_connection('default')
+        keys = [self.cart.key, self.cart.summary_key, self.guest.key, self.guest.summary_key]
+        self.conn.delete(*keys)
+        self.addCleanup(self.conn.delete, *keys)
+        self.addCleanup(self.conn.hdel, SKU_STOCK_KEY, 1, 2, 3)
+
+    def test_guest_cart_expires(self):
+        '''未登录时的购物车设置了过期时间'''
+        set_cart_count(self.guest, 1, 2)
+        self.assertGreater(self.conn.ttl(self.guest.key), 0)
+        self.assertGreater(self.conn.ttl(self.guest.summary_key), 0)
+
+    def test_merge(self):
+        '''登录时合并购物车，数目累加，超过库存时取库存'''
+        self.conn.hmset(SKU_STOCK_KEY, {1: 10, 2: 3})
+        set_cart_count(self.cart, 1, 2)
+        set_cart_count(self.cart, 2, 2)
+        set_cart_count(self.guest, 1, 3)
+        set_cart_count(self.guest, 2, 5)
+        set_cart_count(self.guest, 3, 1)
+
+        self.assertEqual(merge_guest_cart(self.session_key, self.user_id), (9, 3))
+        self.assertEqual(self.conn.hgetall(self.cart.key), {b'1': b'5', b'2': b'3', b'3': b'1'})
+        self.assertFalse(self.conn.exists(self.guest.key))
+
+
+class CartTokenTest(TestCase):
+    '''静态详情页添加购物车之前获取csrf token的测试'''
+
+    def test_token_allows_add(self):
+        '''没有csrftoken cookie时先获取token，之后可以通过csrf检查'''
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(client.post('/cart/add', {'sku_id': 1, 'count': 1}).status_code, 403)
+
+        response = client.get('/cart/token')
+        token = json.loads(response.content.decode())['csrf']
+        self.assertIn('csrftoken', response.cookies)
+
+        response = client.post('/cart/add', {'sku_id': 1, 'count': 1, 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 200)
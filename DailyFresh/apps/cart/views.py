@@ -1,11 +1,19 @@
 from django.shortcuts import render
 from django.views.generic import View
 from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import ensure_csrf_cookie
 
 from goods.models import GoodsSKU
+from goods.sku_cache import get_sku
+from cart.store import request_cart, get_cart_skus, set_cart_count, add_cart_count, delete_cart_items, update_cart_items, \
+    StockError
+import json
 
-from django_redis import get_redis_connection
-from utils.mixin import LoginRequiredMixin
+
+# 批量修改时一次最多包含的操作数目
+CART_BATCH_LIMIT = 100
 
 
 # Create your views here.
@@ -23,10 +31,8 @@ class CartAddView(View):
 
     def post(self, request):
         '''添加记录'''
-        # 获取user
-        user = request.user
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+        # 获取购物车，没有登录时使用session中的购物车
+        cart = request_cart(request, create=True)
 
         # 接收参数
         sku_id = request.POST.get('sku_id')
@@ -37,13 +43,6 @@ class CartAddView(View):
             # 数据不完整
             return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
 
-        # 校验商品id
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            # 商品不存在
-            return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
-
         # 校验商品数量
         try:
             count = int(count)
@@ -56,61 +55,44 @@ class CartAddView(View):
             return JsonResponse({'res': 3, 'errmsg': '商品数目不合法'})
 
         # 业务处理: 添加购物车记录
-        # 先去redis中获取属性sku_id的值，如果有则商品的数目做累加，如果没有添加新属性
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        cart_count = conn.hget(cart_key, sku_id)
-
-        if cart_count:
-            # 商品数目累加
-            count += int(cart_count)
-
-        # 判断商品的库存
-        if count > sku.stock:
+        # 在一次lua脚本调用中完成数目累加、判断库存、设置购物车记录，并获取用户购物车中商品的条目数
+        # 只有redis中没有缓存商品的库存时才查询数据库
+        try:
+            total_count, cart_count = add_cart_count(cart, sku_id, count)
+        except GoodsSKU.DoesNotExist:
+            # 商品不存在
+            return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
+        except StockError:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 设置购物车中sku_id对应的值
-        conn.hset(cart_key, sku_id, count)
-
-        # 获取用户购物车中商品的条目数
-        cart_count = conn.hlen(cart_key)
-
         # 返回应答
         return JsonResponse({'res': 5, 'cart_count': cart_count, 'message': '添加成功'})
 
 
+# /cart/token
+# 采用ajax get请求
+# 静态详情页中没有csrf_token，没有访问过动态页面的用户也没有csrftoken cookie
+# 第一次添加购物车之前先获取csrf token，同时设置cookie
+class CartTokenView(View):
+    '''获取csrf token'''
+
+    @method_decorator(ensure_csrf_cookie)
+    def get(self, request):
+        '''返回csrf token'''
+        return JsonResponse({'res': 1, 'csrf': get_token(request)})
+
+
 # /cart/
-class CartInfoView(LoginRequiredMixin, View):
+class CartInfoView(View):
     '''购物车页面'''
 
     def get(self, request):
         '''显示'''
-        # 获取user
-        user = request.user
-
-        # 获取redis中对应用户的购物车记录 cart_用户id: {'sku_id':商品数目}
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        cart_dict = conn.hgetall(cart_key)  # {'sku_id':商品数量}
-
-        skus = []
-        total_count = 0
-        total_price = 0
-        # 获取购物车中商品id对应的商品信息
-        for sku_id, count in cart_dict.items():
-            # 根据sku_id获取商品的信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 计算商品的小计
-            amount = sku.price * int(count)
-            # 动态给sku对象增加属性amount和count, 分别保存商品的小计和购物车中商品的数量
-            sku.amount = amount
-            sku.count = count
-            # 添加sku
-            skus.append(sku)
-            # 累加计算商品的总件数和总价格
-            total_count += int(count)
-            total_price += amount
+        # 获取购物车，没有登录时使用session中的购物车
+        cart = request_cart(request)
+
+        # 一次获取购物车中所有商品的数目和信息
+        skus, total_count, total_price = get_cart_skus(cart)
 
         # 组织模板上下文
         context = {'total_count': total_count,
@@ -129,10 +111,8 @@ class CartUpdateView(View):
 
     def post(self, request):
         '''更新'''
-        # 获取user
-        user = request.user
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+        # 获取购物车，没有登录时使用session中的购物车
+        cart = request_cart(request, create=True)
 
         # 接收参数
         sku_id = request.POST.get('sku_id')
@@ -145,7 +125,7 @@ class CartUpdateView(View):
 
         # 校验商品id
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            sku = get_sku(sku_id)
         except GoodsSKU.DoesNotExist:
             # 商品不存在
             return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
@@ -162,21 +142,12 @@ class CartUpdateView(View):
             return JsonResponse({'res': 3, 'errmsg': '商品数目不合法'})
 
         # 业务处理：购物车记录更新
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
         # 判断商品的库存
         if count > sku.stock:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 获取更新之后购物车商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+        # 更新，同时获取更新之后购物车商品的总件数
+        total_count, cart_count = set_cart_count(cart, sku_id, count)
 
         # 返回应答
         return JsonResponse({'res': 5, 'total_count': total_count, 'message': '更新成功'})
@@ -190,10 +161,8 @@ class CartDeleteView(View):
 
     def post(self, request):
         '''记录删除'''
-        # 获取user
-        user = request.user
-        if not user.is_authenticated():
-            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
+        # 获取购物车，没有登录时使用session中的购物车
+        cart = request_cart(request, create=True)
 
         # 接收参数
         sku_id = request.POST.get('sku_id')
@@ -205,23 +174,82 @@ class CartDeleteView(View):
 
         # 校验商品id
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            sku = get_sku(sku_id)
         except GoodsSKU.DoesNotExist:
             # 商品不存在
             return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
 
         # 业务处理: 删除购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        # 删除redis中的记录，同时获取删除之后购物车商品的总件数
+        total_count, cart_count = delete_cart_items(cart, [sku_id])
+
+        # 返回应答
+        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
 
-        # 删除redis中的记录
-        conn.hdel(cart_key, sku_id)
 
-        # 获取更新时候购物车商品的总件数
-        total_count = 0
-        vals = conn.hvals(cart_key)
-        for val in vals:
-            total_count += int(val)
+# /cart/batch
+# 采用ajax post请求
+# 前端需要传递的参数: 操作列表的json(ops) [{"sku_id": 1, "count": 3}, {"sku_id": 2, "delete": true}, ...]
+# 购物车页面把一段时间内的修改合并成一次请求
+class CartBatchView(View):
+    '''购物车记录批量修改'''
+
+    def post(self, request):
+        '''批量修改'''
+        # 获取购物车，没有登录时使用session中的购物车
+        cart = request_cart(request, create=True)
+
+        # 接收参数
+        try:
+            ops = json.loads(request.POST.get('ops', ''))
+        except ValueError:
+            ops = None
+
+        # 参数校验
+        if not isinstance(ops, list) or not ops or len(ops) > CART_BATCH_LIMIT:
+            # 数据不完整
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+
+        # {sku_id: 商品数目}，数目为0表示删除，同一个商品的多次操作以最后一次为准
+        counts = {}
+        for op in ops:
+            if not isinstance(op, dict):
+                return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+
+            # 校验商品id
+            try:
+                sku_id = int(op.get('sku_id'))
+            except (TypeError, ValueError):
+                return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
+
+            if op.get('delete'):
+                counts[sku_id] = 0
+                continue
+
+            # 校验商品数量
+            try:
+                count = int(op.get('count'))
+            except (TypeError, ValueError):
+                return JsonResponse({'res': 3, 'errmsg': '商品数目不合法'})
+
+            if count <= 0:
+                return JsonResponse({'res': 3, 'errmsg': '商品数目不合法'})
+
+            counts[sku_id] = count
+
+        # 一次查询校验所有商品的库存
+        stocks = dict(GoodsSKU.objects.filter(id__in=list(counts)).values_list('id', 'stock'))
+        for sku_id, count in counts.items():
+            if count == 0:
+                # 删除的商品不需要校验，已经不存在的商品也可以删除
+                continue
+            if sku_id not in stocks:
+                return JsonResponse({'res': 2, 'errmsg': '商品不存在', 'sku_id': sku_id})
+            if count > stocks[sku_id]:
+                return JsonResponse({'res': 4, 'errmsg': '商品库存不足', 'sku_id': sku_id})
+
+        # 业务处理: 在一次lua脚本调用中完成所有修改，同时获取修改之后购物车商品的总件数
+        total_count, cart_count = update_cart_items(cart, counts.items())
 
         # 返回应答
-        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
+        return JsonResponse({'res': 5, 'total_count': total_count, 'cart_count': cart_count, 'message': '修改成功'})
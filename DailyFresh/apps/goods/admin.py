@@ -1,5 +1,6 @@
 from django.contrib import admin
-from django.core.cache import cache
+from goods.index_data import expire_index_data
+from goods.static_pages import schedule_static_index_html
 from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner, GoodsSKU, GoodsImage, Goods
 # Register your models here.
 
@@ -10,24 +11,22 @@ class BaseAdmin(admin.ModelAdmin):
         # 调用父类的方法，实现更新或新增操作
         super().save_model(request, obj, form, change)
 
-        # 附加操作: 发出任务，重新生成静态首页
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        # 附加操作: 重新生成静态首页，短时间内的多次修改只生成一次
+        schedule_static_index_html()
 
-        # 附加操作: 更新缓存
-        cache.delete('index_page_data')
+        # 附加操作: 使首页数据的缓存失效
+        expire_index_data()
 
     def delete_model(self, request, obj):
         '''数据删除时调用'''
         # 调用父类的方法，实现数据的删除操作
         super().delete_model(request, obj)
 
-        # 附加操作: 发出任务，重新生成静态首页
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        # 附加操作: 重新生成静态首页，短时间内的多次修改只生成一次
+        schedule_static_index_html()
 
-        # 附加操作: 更新缓存
-        cache.delete('index_page_data')
+        # 附加操作: 使首页数据的缓存失效
+        expire_index_data()
 
 
 class GoodsTypeAdmin(BaseAdmin):
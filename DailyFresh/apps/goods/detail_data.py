@@ -0,0 +1,32 @@
+from goods.models import GoodsSKU, GoodsType
+from order.models import OrderGoods
+
+
+# 详情页数据的组织
+# DetailView和生成静态详情页共用
+
+
+def get_detail_data(sku, types=None):
+    '''获取详情页展示的数据'''
+
+    # 获取商品的分类信息
+    if types is None:
+        types = GoodsType.objects.all()
+
+    # 获取商品的评论信息
+    order_skus = OrderGoods.objects.filter(sku=sku).exclude(comment='').select_related('order__user').order_by('-update_time')
+
+    # 获取和该商品同类型的另外两个商品
+    new_skus = GoodsSKU.objects.filter(type=sku.type_id).order_by('-create_time')[:2]
+
+    # 获取和商品同一个spu其他规格的商品信息
+    same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods_id).exclude(id=sku.id)
+
+    # 组织模板上下文
+    context = {'sku': sku,
+               'types': types,
+               'order_skus': order_skus,
+               'new_skus': new_skus,
+               'same_spu_skus': same_spu_skus}
+
+    return context
@@ -0,0 +1,148 @@
+from django.core.cache import cache
+from goods.models import GoodsSKU, GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.ranking import top_sku_ids_for_types
+from utils.cache_tasks import incr_version
+import math
+import random
+import time
+
+
+# 首页数据的组织
+# IndexView和生成静态首页的celery任务共用
+# 不论有多少个商品种类，查询的次数都是固定的
+
+# 每个种类显示的热销商品的数目
+INDEX_HOT_COUNT = 3
+
+
+def get_index_data():
+    '''获取首页展示的数据'''
+
+    # 获取商品的分类信息
+    types = list(GoodsType.objects.all())
+
+    # 获取首页的轮播商品信息
+    index_banner = IndexGoodsBanner.objects.select_related('sku').order_by('index')
+
+    # 获取首页促销活动信息
+    promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
+
+    # 一次查询出所有分类的展示商品，连同展示用到的sku一起查出
+    type_banners = IndexTypeGoodsBanner.objects.select_related('sku').order_by('index')
+
+    # 在内存中按照种类和展示类型分组
+    # {(type_id, display_type): [banner, ...]}
+    banner_groups = {}
+    for banner in type_banners:
+        banner_groups.setdefault((banner.type_id, banner.display_type), []).append(banner)
+
+    for type in types:
+        # 动态给type对象增加两个属性:
+        # title_banner(保存type类型首页展示的文字商品)
+        # image_banner(保存type类型首页展示的图片商品)
+        type.title_banner = banner_groups.get((type.id, 0), [])
+        type.image_banner = banner_groups.get((type.id, 1), [])
+
+    # 从redis的销量排行中获取每个种类最近7天的热销商品
+    hot_ids = top_sku_ids_for_types([type.id for type in types], '7d', INDEX_HOT_COUNT)
+    sku_ids = [sku_id for ids in hot_ids.values() for sku_id in ids]
+    skus = GoodsSKU.objects.in_bulk(sku_ids) if sku_ids else {}
+    for type in types:
+        # 动态给type对象增加属性hot_skus，保存type类型的热销商品
+        type.hot_skus = [skus[sku_id] for sku_id in hot_ids.get(type.id, []) if sku_id in skus]
+
+    # 组织模板上下文
+    context = {'types': types,
+               'index_banner': list(index_banner),
+               'promotion_banner': list(promotion_banner)}
+
+    return context
+
+
+# 首页数据的缓存
+# 后台修改数据时不再删除缓存，而是增加缓存的版本号，旧版本的数据在重新生成期间继续提供服务
+# 同一时间只有一个请求重新生成首页数据(single flight)，其他请求使用旧数据
+# 缓存快要过期时按照概率提前重新生成(XFetch)，避免大量请求在同一时刻同时未命中
+
+# 版本号的缓存名称
+INDEX_VERSION_KEY = 'index_page_version'
+# 首页数据的缓存名称
+INDEX_DATA_KEY = 'index_page_data'
+# 重新生成首页数据时使用的锁
+INDEX_LOCK_KEY = 'index_page_lock'
+
+# 首页数据的有效时间
+INDEX_DATA_TIMEOUT = 3600
+# 数据过期之后还可以作为旧数据使用的时间
+INDEX_STALE_TIMEOUT = 3600
+# 锁的过期时间，防止生成数据的进程异常退出之后无法释放锁
+INDEX_LOCK_TIMEOUT = 30
+# 提前重新生成的系数，越大越早重新生成
+INDEX_EARLY_BETA = 1.0
+# 没有任何旧数据时，等待其他请求生成数据的次数和间隔
+INDEX_WAIT_TIMES = 20
+INDEX_WAIT_INTERVAL = 0.05
+
+
+def expire_index_data():
+    '''使首页数据的缓存失效'''
+    incr_version(INDEX_VERSION_KEY)
+
+
+def _should_rebuild(data, version):
+    '''判断缓存的首页数据是否需要重新生成'''
+    if data is None or data['version'] != version:
+        return True
+
+    # XFetch: 生成数据花费的时间越长，越接近过期时间，越有可能提前重新生成
+    # -log(u) (u属于(0, 1])服从指数分布
+    early = -data['delta'] * INDEX_EARLY_BETA * math.log(1.0 - random.random())
+    return time.time() + early >= data['expires']
+
+
+def _rebuild(version):
+    '''重新生成首页数据并设置缓存'''
+    start = time.time()
+    context = get_index_data()
+    now = time.time()
+
+    data = {'version': version,
+            'context': context,
+            'delta': now - start,
+            'expires': now + INDEX_DATA_TIMEOUT}
+    cache.set(INDEX_DATA_KEY, data, INDEX_DATA_TIMEOUT + INDEX_STALE_TIMEOUT)
+    return data
+
+
+def get_cached_index_data():
+    '''获取首页展示的数据，优先使用缓存'''
+
+    # 一次获取版本号和缓存的数据
+    values = cache.get_many([INDEX_VERSION_KEY, INDEX_DATA_KEY])
+    version = values.get(INDEX_VERSION_KEY, 0)
+    data = values.get(INDEX_DATA_KEY)
+
+    if not _should_rebuild(data, version):
+        return data['context']
+
+    # 尝试获取重新生成数据的锁，只有获取到锁的请求才重新生成
+    if cache.add(INDEX_LOCK_KEY, version, INDEX_LOCK_TIMEOUT):
+        try:
+            data = _rebuild(version)
+        finally:
+            cache.delete(INDEX_LOCK_KEY)
+        return data['context']
+
+    if data is not None:
+        # 其他请求正在生成数据，先使用旧数据
+        return data['context']
+
+    # 没有任何旧数据，等待其他请求生成数据
+    for i in range(INDEX_WAIT_TIMES):
+        time.sleep(INDEX_WAIT_INTERVAL)
+        data = cache.get(INDEX_DATA_KEY)
+        if data is not None:
+            return data['context']
+
+    # 等待超时，自己生成数据
+    return _rebuild(version)['context']
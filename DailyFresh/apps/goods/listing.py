@@ -0,0 +1,101 @@
+from django.core.cache import cache
+
+from goods.models import GoodsSKU
+from goods.ranking import top_sku_ids
+from utils.cache_tasks import incr_version
+from utils.pagination import KeysetPage, keyset_page
+
+
+# 列表页的分页
+# 每种排序方式按需生成访问过的页的游标并缓存，翻页时根据游标查询，不需要OFFSET扫描
+# 商品数据变化时增加该种类的版本号，使缓存的商品数目和游标失效
+# 下单时只修改销量，增加该种类的销量版本号，只使按照销量排序的游标失效
+# 缓存只通过版本号失效，过期时间只用于清理旧版本的缓存
+
+# 每页显示的商品数目
+LIST_PER_PAGE = 1
+
+# 排序方式: ((字段名, 是否降序), ...)
+# 最后按照id排序，保证排序字段的值相同时顺序也是确定的
+LIST_ORDERINGS = {
+    # sort=default 按照默认方式(id)进行排序
+    'default': (('id', True),),
+    # sort=price 按照商品价格(price)进行排序
+    'price': (('price', False), ('id', False)),
+    # sort=hot 按照商品销量(sales)进行排序
+    'hot': (('sales', True), ('id', True)),
+}
+
+# 旧版本的缓存的过期时间
+LIST_CACHE_TIMEOUT = 3600
+
+
+def list_version_key(type_id):
+    '''种类版本号的缓存名称'''
+    return 'sku_list_version_%d' % type_id
+
+
+def list_sales_version_key(type_id):
+    '''种类销量版本号的缓存名称'''
+    return 'sku_list_sales_version_%d' % type_id
+
+
+def expire_list_data(type_id):
+    '''使种类的商品数目和游标的缓存失效'''
+    incr_version(list_version_key(type_id))
+
+
+def expire_list_sales(type_ids):
+    '''商品的销量变化，使种类按照销量排序的游标失效'''
+    for type_id in type_ids:
+        incr_version(list_sales_version_key(type_id))
+
+
+def get_list_page(type_id, sort, page):
+    '''获取种类商品第page页的内容，商品数目和生成的游标按照版本号缓存'''
+    keys = [list_version_key(type_id), list_sales_version_key(type_id)]
+    versions = cache.get_many(keys)
+    version, sales_version = [versions.get(key, 0) for key in keys]
+    count_key = 'sku_count_%d_%d' % (type_id, version)
+    cursors_key = 'sku_cursors_%d_%s_%d' % (type_id, sort, version)
+    if sort == 'hot':
+        # 按照销量排序的游标在销量变化时也失效
+        cursors_key += '_%d' % sales_version
+
+    queryset = GoodsSKU.objects.filter(type=type_id)
+    values = cache.get_many([count_key, cursors_key])
+    count = values.get(count_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(count_key, count, LIST_CACHE_TIMEOUT)
+    cursors = values.get(cursors_key, {})
+
+    known = len(cursors)
+    sku_page = keyset_page(queryset, LIST_ORDERINGS[sort], cursors, count, LIST_PER_PAGE, page)
+    if len(cursors) != known:
+        cache.set(cursors_key, cursors, LIST_CACHE_TIMEOUT)
+    return sku_page
+
+
+def get_hot_page(type_id, page):
+    '''从redis的销量排行中获取种类商品第page页的内容，排行不存在时返回None'''
+    if page <= 0:
+        page = 1
+
+    start = (page - 1) * LIST_PER_PAGE
+    count, sku_ids = top_sku_ids(type_id, 'all', start, start + LIST_PER_PAGE - 1)
+    if count == 0:
+        # 销量排行还没有生成
+        return None
+
+    num_pages = (count + LIST_PER_PAGE - 1) // LIST_PER_PAGE
+    if page > num_pages:
+        # 默认获取第1页的内容
+        page = 1
+        count, sku_ids = top_sku_ids(type_id, 'all', 0, LIST_PER_PAGE - 1)
+
+    # 按照排行的顺序返回商品
+    skus = GoodsSKU.objects.in_bulk(sku_ids)
+    object_list = [skus[sku_id] for sku_id in sku_ids if sku_id in skus]
+
+    return KeysetPage(object_list, page, num_pages)
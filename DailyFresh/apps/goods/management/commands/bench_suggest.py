@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from goods.suggest import PrefixIndex
+import random
+import time
+
+
+# 用于生成商品名称的字
+NAME_CHARS = '新鲜红富士苹果香蕉橙子柠檬草莓葡萄西瓜哈密瓜芒果猕猴桃樱桃蓝莓菠萝荔枝龙眼桃李杏梨柚' \
+             '猪牛羊鸡鸭鱼虾蟹贝扇海带紫菜鸡蛋鸭蛋白菜青菜萝卜土豆番茄黄瓜茄子辣椒大蒜生姜冷冻速食'
+
+
+class Command(BaseCommand):
+    help = '在随机生成的商品数据上测试搜索提示的前缀索引的性能'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=100000, help='商品数目')
+        parser.add_argument('--queries', type=int, default=100000, help='查询次数')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+
+        def random_name():
+            return ''.join(rnd.choice(NAME_CHARS) for i in range(rnd.randint(2, 8)))
+
+        # 随机生成商品数据，每10个商品属于同一个SPU
+        goods_names = [random_name() for i in range(options['skus'] // 10 + 1)]
+        entries = [(sku_id, random_name(), goods_names[sku_id // 10]) for sku_id in range(options['skus'])]
+
+        start = time.time()
+        index = PrefixIndex.build(entries)
+        self.stdout.write('生成前缀索引: %d个商品，%d个索引词，耗时%.2f秒' % (
+            len(entries), len(index.keys), time.time() - start))
+
+        # 查询的前缀从索引词中随机截取
+        prefixes = []
+        for i in range(options['queries']):
+            key = rnd.choice(index.keys)
+            prefixes.append(key[:rnd.randint(1, len(key))])
+
+        timings = []
+        for prefix in prefixes:
+            start = time.perf_counter()
+            index.lookup(prefix)
+            timings.append(time.perf_counter() - start)
+
+        timings.sort()
+        avg = sum(timings) / len(timings)
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        self.stdout.write('查询%d次: 平均%.1f微秒，p99 %.1f微秒，最大%.1f微秒' % (
+            len(timings), avg * 1e6, p99 * 1e6, timings[-1] * 1e6))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from goods.static_pages import build_all_static_detail_pages, STATIC_DETAIL_CHUNK_SIZE
+import time
+
+
+class Command(BaseCommand):
+    help = '生成所有商品的静态详情页'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None, help='进程数，默认为cpu的核数')
+        parser.add_argument('--chunk-size', type=int, default=STATIC_DETAIL_CHUNK_SIZE, help='每个进程每次处理的商品数目')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = build_all_static_detail_pages(processes=options['processes'], chunk_size=options['chunk_size'])
+        elapsed = time.time() - start
+
+        self.stdout.write('生成了%d个静态详情页，耗时%.2f秒，%.1f页/秒' % (count, elapsed, count / elapsed if elapsed else 0))
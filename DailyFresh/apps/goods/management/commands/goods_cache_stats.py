@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from goods.sku_cache import cache_stats
+
+
+class Command(BaseCommand):
+    help = '显示所有worker进程中商品缓存的命中次数和命中率'
+
+    def handle(self, *args, **options):
+        stats = cache_stats()
+        self.stdout.write('内存命中: %d' % stats['local_hits'])
+        self.stdout.write('redis命中: %d' % stats['redis_hits'])
+        self.stdout.write('查询数据库: %d' % stats['misses'])
+        self.stdout.write('内存命中率: %.2f%%' % (stats['local_hit_ratio'] * 100))
+        self.stdout.write('总命中率: %.2f%%' % (stats['hit_ratio'] * 100))
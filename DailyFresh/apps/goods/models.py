@@ -44,6 +44,12 @@ class GoodsSKU(BaseModel):
         db_table = 'df_goods_sku'
         verbose_name = '商品'
         verbose_name_plural = verbose_name
+        # 列表页各种排序方式使用的覆盖索引
+        index_together = [
+            ('type', 'price', 'id'),
+            ('type', 'sales', 'id'),
+            ('type', 'id'),
+        ]
 
 
 class Goods(BaseModel):
@@ -0,0 +1,158 @@
+from django.db.models import Sum
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from order.models import OrderInfo, OrderGoods
+from datetime import timedelta
+import time
+
+
+# 商品的销量排行
+# 每个种类在redis中保存一个总销量的有序集合，以及按小时分桶的销量有序集合
+# 最近24小时、最近7天的销量由对应的小时桶合并得到，合并的结果缓存一小段时间
+# 小时桶设置过期时间，超出时间窗口之后自动删除
+# 下单时增加销量，定时任务根据df_order_goods校正
+
+# 时间窗口: 窗口名称 -> 包含的小时桶的数目，None表示总销量
+RANK_WINDOWS = {
+    'all': None,
+    '7d': 7 * 24,
+    '24h': 24,
+}
+# 小时桶的过期时间，比最大的时间窗口多一个小时
+RANK_BUCKET_TIMEOUT = (7 * 24 + 1) * 3600
+# 时间窗口合并结果的过期时间
+RANK_WINDOW_TIMEOUT = 60
+
+# 获取时间窗口的排行: 合并结果不存在时先合并小时桶，返回(商品数目, 商品id列表)
+# KEYS[1]: 合并结果 KEYS[2...]: 小时桶
+# ARGV[1]: 开始位置 ARGV[2]: 结束位置 ARGV[3]: 合并结果的过期时间
+RANK_TOP_SCRIPT = '''
+if #KEYS > 1 and redis.call('exists', KEYS[1]) == 0 then
+    redis.call('zunionstore', KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+    redis.call('expire', KEYS[1], ARGV[3])
+end
+return {redis.call('zcard', KEYS[1]), redis.call('zrevrange', KEYS[1], ARGV[1], ARGV[2])}
+'''
+
+
+def rank_key(type_id, window='all'):
+    '''种类销量排行的key'''
+    if window == 'all':
+        return 'hot_sales_%d' % type_id
+    return 'hot_sales_%d_%s' % (type_id, window)
+
+
+def bucket_key(type_id, hour):
+    '''种类小时桶的key'''
+    return 'hot_sales_%d_h%d' % (type_id, hour)
+
+
+def current_hour(timestamp=None):
+    '''从1970年开始的小时数'''
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp // 3600)
+
+
+def _window_keys(type_id, window):
+    '''时间窗口的合并结果和包含的小时桶'''
+    keys = [rank_key(type_id, window)]
+    hours = RANK_WINDOWS[window]
+    if hours is not None:
+        now = current_hour()
+        keys.extend(bucket_key(type_id, hour) for hour in range(now - hours + 1, now + 1))
+    return keys
+
+
+def record_sales(items):
+    '''增加商品的销量，items: [(种类id, 商品id, 数目), ...]'''
+    if not items:
+        return
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    hour = current_hour()
+    for type_id, sku_id, count in items:
+        pipe.zincrby(rank_key(type_id), sku_id, count)
+        pipe.zincrby(bucket_key(type_id, hour), sku_id, count)
+        pipe.expire(bucket_key(type_id, hour), RANK_BUCKET_TIMEOUT)
+    pipe.execute()
+
+
+def add_sku(type_id, sku_id, old_type_id=None):
+    '''新增的商品加入总销量排行，销量为0时也能在列表页中显示'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    if old_type_id is not None and old_type_id != type_id:
+        # 商品修改了种类
+        pipe.zrem(rank_key(old_type_id), sku_id)
+    pipe.zincrby(rank_key(type_id), sku_id, 0)
+    pipe.execute()
+
+
+def remove_sku(type_id, sku_id):
+    '''删除的商品移出总销量排行'''
+    conn = get_redis_connection('default')
+    conn.zrem(rank_key(type_id), sku_id)
+
+
+def top_sku_ids(type_id, window='all', start=0, stop=-1):
+    '''获取种类销量排行中start到stop(包含)的商品id，返回(商品数目, 商品id列表)'''
+    conn = get_redis_connection('default')
+    script = conn.register_script(RANK_TOP_SCRIPT)
+    count, sku_ids = script(keys=_window_keys(type_id, window), args=[start, stop, RANK_WINDOW_TIMEOUT])
+    return count, [int(sku_id) for sku_id in sku_ids]
+
+
+def top_sku_ids_for_types(type_ids, window='7d', count=3):
+    '''一次获取多个种类销量排行的前count个商品id，返回{种类id: [商品id, ...]}'''
+    conn = get_redis_connection('default')
+    script = conn.register_script(RANK_TOP_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for type_id in type_ids:
+        script(keys=_window_keys(type_id, window), args=[0, count - 1, RANK_WINDOW_TIMEOUT], client=pipe)
+    results = pipe.execute()
+    return {type_id: [int(sku_id) for sku_id in sku_ids] for type_id, (total, sku_ids) in zip(type_ids, results)}
+
+
+def reconcile_sales():
+    '''根据df_order_goods重新计算所有种类的销量排行'''
+
+    # 总销量，没有销量的商品分数为0
+    totals = {}
+    for sku_id, type_id in GoodsSKU.objects.values_list('id', 'type_id'):
+        totals.setdefault(type_id, {})[sku_id] = 0
+    # 超时未支付被取消的订单不计入销量
+    lines = OrderGoods.objects.exclude(order__order_status=OrderInfo.ORDER_STATUS_ENUM['CANCELED'])
+    rows = lines.values('sku_id', 'sku__type_id').annotate(total=Sum('count'))
+    for row in rows:
+        totals.setdefault(row['sku__type_id'], {})[row['sku_id']] = row['total']
+
+    # 最大时间窗口内每个小时的销量
+    buckets = {}
+    since = timezone.now() - timedelta(hours=RANK_WINDOWS['7d'])
+    rows = lines.filter(create_time__gte=since).values_list('sku_id', 'sku__type_id', 'count', 'create_time')
+    for sku_id, type_id, count, create_time in rows.iterator():
+        key = bucket_key(type_id, current_hour(create_time.timestamp()))
+        scores = buckets.setdefault(key, {})
+        scores[sku_id] = scores.get(sku_id, 0) + count
+
+    conn = get_redis_connection('default')
+    now = current_hour()
+    for type_id, scores in totals.items():
+        # 每个种类在一个事务中替换，读取的一方不会看到一半的数据
+        pipe = conn.pipeline()
+        pipe.delete(rank_key(type_id))
+        if scores:
+            pipe.zadd(rank_key(type_id), **{str(sku_id): score for sku_id, score in scores.items()})
+        for hour in range(now - RANK_WINDOWS['7d'] + 1, now + 1):
+            key = bucket_key(type_id, hour)
+            pipe.delete(key)
+            if key in buckets:
+                pipe.zadd(key, **{str(sku_id): score for sku_id, score in buckets[key].items()})
+                pipe.expire(key, RANK_BUCKET_TIMEOUT - (now - hour) * 3600)
+        for window in ('7d', '24h'):
+            pipe.delete(rank_key(type_id, window))
+        pipe.execute()
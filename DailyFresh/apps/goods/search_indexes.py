@@ -13,5 +13,6 @@ class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
         return GoodsSKU
 
     # 搜索引擎会对这个方法返回的数据建立索引
+    # 只对上线的商品建立索引，按照id排序，建立索引时按照id分批查询，不会一次查出所有的数据
     def index_queryset(self, using=None):
-        return self.get_model().objects.all()
+        return self.get_model().objects.filter(status=1).select_related('goods').order_by('id')
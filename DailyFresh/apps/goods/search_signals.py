@@ -0,0 +1,91 @@
+from django.core.cache import cache
+from django.db.models import signals
+from django_redis import get_redis_connection
+from haystack import connections
+from haystack.signals import BaseSignalProcessor
+
+from goods.models import GoodsSKU, Goods
+from utils.cache_tasks import schedule_once
+
+
+# 全文检索索引的异步更新
+# 商品数据变化时只把商品id加入redis集合，由celery任务批量更新whoosh索引
+# 后台保存和批量导入数据时不需要等待索引写入完成
+
+# 需要更新索引的商品id
+SEARCH_PENDING_KEY = 'search_index_pending'
+# 是否已经发出了更新任务
+SEARCH_SCHEDULED_KEY = 'search_index_scheduled'
+# 发出更新任务之前等待的时间，期间的修改合并为一次更新
+SEARCH_DEBOUNCE = 5
+# 每次写入索引的商品数目
+SEARCH_BATCH_SIZE = 500
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    '''数据变化时把商品id加入队列的信号处理器'''
+
+    def setup(self):
+        signals.post_save.connect(self.handle_sku, sender=GoodsSKU)
+        signals.post_delete.connect(self.handle_sku, sender=GoodsSKU)
+        # 索引中包含商品SPU的详情
+        signals.post_save.connect(self.handle_goods, sender=Goods)
+
+    def teardown(self):
+        signals.post_save.disconnect(self.handle_sku, sender=GoodsSKU)
+        signals.post_delete.disconnect(self.handle_sku, sender=GoodsSKU)
+        signals.post_save.disconnect(self.handle_goods, sender=Goods)
+
+    def handle_sku(self, sender, instance, **kwargs):
+        '''商品修改或者删除'''
+        queue_search_update([instance.id])
+
+    def handle_goods(self, sender, instance, **kwargs):
+        '''商品SPU修改'''
+        queue_search_update(GoodsSKU.objects.filter(goods=instance.id).values_list('id', flat=True))
+
+
+def queue_search_update(sku_ids):
+    '''把商品id加入队列，并发出更新索引的任务'''
+    sku_ids = list(sku_ids)
+    if not sku_ids:
+        return
+
+    conn = get_redis_connection('default')
+    conn.sadd(SEARCH_PENDING_KEY, *sku_ids)
+
+    schedule_once(SEARCH_SCHEDULED_KEY, SEARCH_DEBOUNCE * 6, 'update_search_index', countdown=SEARCH_DEBOUNCE)
+
+
+def pop_search_pending():
+    '''取出所有需要更新索引的商品id'''
+    conn = get_redis_connection('default')
+
+    # 之后的修改会发出新的更新任务
+    cache.delete(SEARCH_SCHEDULED_KEY)
+
+    pipe = conn.pipeline()
+    pipe.smembers(SEARCH_PENDING_KEY)
+    pipe.delete(SEARCH_PENDING_KEY)
+    sku_ids, _ = pipe.execute()
+    return sorted(int(sku_id) for sku_id in sku_ids)
+
+
+def apply_search_updates(sku_ids, using='default', batch_size=SEARCH_BATCH_SIZE):
+    '''批量更新商品的索引，下线或者删除的商品从索引中删除'''
+    backend = connections[using].get_backend()
+    index = connections[using].get_unified_index().get_index(GoodsSKU)
+
+    for start in range(0, len(sku_ids), batch_size):
+        batch = sku_ids[start:start + batch_size]
+
+        # index_queryset只包含上线的商品
+        skus = list(index.index_queryset(using=using).filter(id__in=batch))
+        if skus:
+            backend.update(index, skus)
+
+        # 不在index_queryset中的商品从索引中删除
+        found = {sku.id for sku in skus}
+        for sku_id in batch:
+            if sku_id not in found:
+                backend.remove('goods.goodssku.%d' % sku_id)
@@ -0,0 +1,128 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from goods.models import GoodsType, GoodsSKU, Goods, GoodsImage
+from goods.static_pages import affected_sku_ids, schedule_static_detail_html, schedule_static_detail_rebuild
+from goods.listing import expire_list_data
+from goods import ranking
+from goods.suggest import expire_catalog
+from goods.sku_cache import invalidate_skus, invalidate_types
+from order.models import OrderGoods
+from cart.store import set_sku_stock, refresh_sku_stock
+
+
+# 商品数据变化时的附加操作
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_save, sender=Goods)
+@receiver(post_save, sender=GoodsImage)
+@receiver(post_save, sender=OrderGoods)
+def update_static_detail_on_save(sender, instance, **kwargs):
+    '''重新生成受影响的商品的静态详情页'''
+    schedule_static_detail_html(affected_sku_ids(instance))
+
+
+@receiver(post_delete, sender=GoodsSKU)
+@receiver(post_delete, sender=Goods)
+@receiver(post_delete, sender=GoodsImage)
+@receiver(post_delete, sender=OrderGoods)
+def update_static_detail_on_delete(sender, instance, **kwargs):
+    '''重新生成受影响的商品的静态详情页'''
+    schedule_static_detail_html(affected_sku_ids(instance, deleted=True))
+
+
+@receiver(pre_save, sender=GoodsType)
+def remember_type_nav(sender, instance, **kwargs):
+    '''记录商品分类修改之前在详情页上显示的名称和标识'''
+    instance._old_nav = None
+    if instance.pk:
+        instance._old_nav = GoodsType.objects.filter(pk=instance.pk).values_list('name', 'logo').first()
+
+
+@receiver(post_save, sender=GoodsType)
+def rebuild_static_detail_on_save(sender, instance, **kwargs):
+    '''所有的详情页上都会显示商品分类的名称和标识，有变化时重新生成所有商品的静态详情页'''
+    if getattr(instance, '_old_nav', None) != (instance.name, instance.logo):
+        schedule_static_detail_rebuild()
+
+
+@receiver(post_delete, sender=GoodsType)
+def rebuild_static_detail_on_delete(sender, instance, **kwargs):
+    '''删除的商品分类不再显示在详情页上'''
+    schedule_static_detail_rebuild()
+
+
+@receiver(pre_save, sender=GoodsSKU)
+def remember_sku_type(sender, instance, **kwargs):
+    '''记录商品修改之前的种类'''
+    instance._old_type_id = None
+    if instance.pk:
+        instance._old_type_id = GoodsSKU.objects.filter(pk=instance.pk).values_list('type_id', flat=True).first()
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+def expire_sku_list(sender, instance, **kwargs):
+    '''使商品所在种类的列表页缓存失效'''
+    expire_list_data(instance.type_id)
+
+    # 商品修改了种类，原来种类的列表页缓存也需要失效
+    old_type_id = getattr(instance, '_old_type_id', None)
+    if old_type_id is not None and old_type_id != instance.type_id:
+        expire_list_data(old_type_id)
+
+
+@receiver(post_save, sender=GoodsSKU)
+def add_sku_ranking(sender, instance, **kwargs):
+    '''商品加入所在种类的销量排行'''
+    ranking.add_sku(instance.type_id, instance.id, getattr(instance, '_old_type_id', None))
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def remove_sku_ranking(sender, instance, **kwargs):
+    '''商品移出所在种类的销量排行'''
+    ranking.remove_sku(instance.type_id, instance.id)
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+@receiver(post_save, sender=Goods)
+@receiver(post_delete, sender=Goods)
+def expire_suggest(sender, instance, **kwargs):
+    '''商品数据变化，搜索提示的前缀索引需要重新生成'''
+    expire_catalog()
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+def invalidate_sku_cache(sender, instance, **kwargs):
+    '''删除商品的两级缓存'''
+    invalidate_skus([instance.id])
+
+
+@receiver(post_save, sender=Goods)
+@receiver(post_delete, sender=Goods)
+def invalidate_goods_cache(sender, instance, **kwargs):
+    '''缓存的商品对象中包含spu，删除spu下所有商品的缓存'''
+    invalidate_skus(GoodsSKU.objects.filter(goods=instance.id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=GoodsType)
+@receiver(post_delete, sender=GoodsType)
+def invalidate_type_cache(sender, instance, **kwargs):
+    '''删除商品分类的缓存，缓存的商品对象中包含分类，同时删除该分类下所有商品的缓存'''
+    invalidate_types()
+    invalidate_skus(GoodsSKU.objects.filter(type=instance.id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=GoodsSKU)
+def update_sku_stock(sender, instance, **kwargs):
+    '''更新添加购物车时使用的商品库存'''
+    set_sku_stock(instance.id, instance.stock)
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def remove_sku_stock(sender, instance, **kwargs):
+    '''删除添加购物车时使用的商品库存'''
+    refresh_sku_stock([instance.id])
@@ -0,0 +1,298 @@
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU, GoodsType
+from utils.lru import LRUCache
+from collections import namedtuple
+from decimal import Decimal
+import copy
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+
+
+# 商品和商品分类的两级缓存
+# 第一级是每个worker进程内存中的LRU缓存，第二级是redis缓存，都没有命中时查询数据库
+# 数据变化时把redis缓存换成一个唯一的删除标记，并通过redis的发布订阅通知所有的worker进程删除内存中的缓存
+# 查询数据库之后只在redis缓存还是查询之前读到的值(不存在或者删除标记)时写入，查询期间数据变化时不会写入旧数据
+# 写入redis失败或者查询期间收到过删除通知时，查询到的数据也不放入内存
+
+# 内存中缓存的数据数目和过期时间，过期时间用于防止丢失删除通知时一直使用旧数据
+LOCAL_CACHE_SIZE = 2048
+LOCAL_CACHE_TTL = 60
+# redis缓存的过期时间
+REDIS_CACHE_TIMEOUT = 3600
+
+# 发布删除通知的频道
+INVALIDATE_CHANNEL = 'goods_cache_invalidate'
+# 缓存命中次数的统计
+STATS_KEY = 'goods_cache_stats'
+# 统计数据写入redis的间隔
+STATS_FLUSH_INTERVAL = 10
+
+# 商品分类的缓存名称
+TYPES_KEY = 'goods_types'
+
+# 商品卡片的缓存，浏览记录等只需要展示商品的名称、价格、图片的地方使用，只保存在redis中
+# sku_card_商品id: [名称, 价格, 图片地址, 单位]的json，每个商品单独过期
+CARD_KEY_PREFIX = 'sku_card_'
+
+# 删除标记的前缀，缓存的数据是pickle或者json，不会以它开头
+CACHE_INVALID = b'invalid:'
+
+# 写入查询到的数据，已经变化的缓存跳过，返回写入的数目
+# KEYS: 缓存名称 ARGV[1]: 过期时间 ARGV[i * 2]: 查询之前的值，不存在时为空字符串 ARGV[i * 2 + 1]: 新的数据
+FILL_SCRIPT = '''
+local filled = 0
+for i, key in ipairs(KEYS) do
+    if (redis.call('get', key) or '') == ARGV[i * 2] then
+        redis.call('set', key, ARGV[i * 2 + 1], 'EX', ARGV[1])
+        filled = filled + 1
+    end
+end
+return filled
+'''
+
+# 商品卡片
+SkuCard = namedtuple('SkuCard', ['id', 'name', 'price', 'image_url', 'unite'])
+
+_local = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+# 当前进程收到删除通知的次数，查询期间有变化时查询到的数据不放入内存
+_local_version = [0]
+
+# 当前进程的统计数据: 内存命中、redis命中、查询数据库
+_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+_stats_flushed = [time.time()]
+# 同一进程的多个请求线程同时修改统计数据
+_stats_lock = threading.Lock()
+
+# 订阅删除通知的线程所在的进程id，uwsgi fork出worker进程之后需要在worker进程中重新启动线程
+_subscriber = {'pid': None}
+_subscriber_lock = threading.Lock()
+
+
+def sku_key(sku_id):
+    '''商品的缓存名称'''
+    return 'sku_row_%d' % int(sku_id)
+
+
+def card_key(sku_id):
+    '''商品卡片的缓存名称'''
+    return CARD_KEY_PREFIX + str(int(sku_id))
+
+
+def _listen():
+    '''接收删除通知，删除内存中的缓存'''
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            # 订阅之前发布的通知收不到，清空内存中的缓存
+            _local_version[0] += 1
+            _local.clear()
+            for message in pubsub.listen():
+                key = message['data']
+                if isinstance(key, bytes):
+                    key = key.decode()
+                _local_version[0] += 1
+                if key == '*':
+                    _local.clear()
+                else:
+                    _local.delete(key)
+        except Exception:
+            # 连接断开，稍后重新订阅
+            time.sleep(1)
+
+
+def _ensure_subscriber():
+    '''确保当前进程中启动了订阅删除通知的线程'''
+    pid = os.getpid()
+    if _subscriber['pid'] == pid:
+        return
+    with _subscriber_lock:
+        if _subscriber['pid'] != pid:
+            thread = threading.Thread(target=_listen, name='goods-cache-invalidate', daemon=True)
+            thread.start()
+            _subscriber['pid'] = pid
+
+
+def _count(name):
+    '''记录命中次数，每隔一段时间写入redis'''
+    now = time.time()
+    with _stats_lock:
+        _stats[name] += 1
+        if now - _stats_flushed[0] < STATS_FLUSH_INTERVAL:
+            return
+
+        _stats_flushed[0] = now
+        values = dict(_stats)
+        for key in values:
+            _stats[key] = 0
+
+    try:
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        for key, value in values.items():
+            if value:
+                pipe.hincrby(STATS_KEY, key, value)
+        pipe.execute()
+    except Exception:
+        # 统计数据不影响正常的请求
+        pass
+
+
+def _is_missing(value):
+    '''redis缓存不存在或者是删除标记'''
+    return value is None or value.startswith(CACHE_INVALID)
+
+
+def _fill(conn, values):
+    '''写入查询到的数据，values: {缓存名称: (查询之前的值, 新的数据)}，返回写入的数目'''
+    args = [REDIS_CACHE_TIMEOUT]
+    for key, (old, value) in values.items():
+        args.extend([old or b'', value])
+    return conn.register_script(FILL_SCRIPT)(keys=list(values), args=args)
+
+
+def _get(key, load):
+    '''依次从内存、redis、数据库中获取数据'''
+    _ensure_subscriber()
+
+    value = _local.get(key)
+    if value is not LRUCache.MISSING:
+        _count('local_hits')
+        return value
+
+    version = _local_version[0]
+    conn = get_redis_connection('default')
+    cached = conn.get(key)
+    if not _is_missing(cached):
+        _count('redis_hits')
+        value = pickle.loads(cached)
+    else:
+        _count('misses')
+        value = load()
+        if not _fill(conn, {key: (cached, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))}):
+            # 查询期间数据变化，下一次重新查询
+            return value
+
+    if _local_version[0] == version:
+        _local.set(key, value)
+    return value
+
+
+def get_sku(sku_id):
+    '''获取商品的拷贝，商品不存在时抛出GoodsSKU.DoesNotExist异常'''
+    sku_id = int(sku_id)
+
+    def load():
+        # 不存在的商品缓存为False，防止反复查询数据库
+        try:
+            return GoodsSKU.objects.select_related('type', 'goods').get(id=sku_id)
+        except GoodsSKU.DoesNotExist:
+            return False
+
+    sku = _get(sku_key(sku_id), load)
+    if sku is False:
+        raise GoodsSKU.DoesNotExist('商品不存在')
+    # 内存中的对象被同一进程的所有请求共用，视图会在商品对象上增加属性，返回拷贝
+    return copy.copy(sku)
+
+
+def get_types():
+    '''获取所有的商品分类'''
+    return list(_get(TYPES_KEY, lambda: list(GoodsType.objects.all())))
+
+
+def get_type(type_id):
+    '''获取商品分类，分类不存在时抛出GoodsType.DoesNotExist异常'''
+    type_id = int(type_id)
+    for type in get_types():
+        if type.id == type_id:
+            return type
+    raise GoodsType.DoesNotExist('商品分类不存在')
+
+
+def _invalidate(keys):
+    '''把redis中的缓存换成删除标记，并通知所有的worker进程删除内存中的缓存'''
+    if not keys:
+        return
+
+    # 每次使用新的删除标记，正在查询数据库的请求不会写入
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, CACHE_INVALID + uuid.uuid4().hex.encode(), ex=REDIS_CACHE_TIMEOUT)
+        pipe.publish(INVALIDATE_CHANNEL, key)
+    pipe.execute()
+
+    # 当前进程立即删除
+    _local_version[0] += 1
+    for key in keys:
+        _local.delete(key)
+
+
+def _card_fields(sku):
+    return json.dumps([sku.name, str(sku.price), sku.image.url, sku.unite])
+
+
+def _card(sku_id, value):
+    name, price, image_url, unite = json.loads(value.decode() if isinstance(value, bytes) else value)
+    return SkuCard(sku_id, name, Decimal(price), image_url, unite)
+
+
+def get_sku_cards(sku_ids, cached=None):
+    '''
+    按照sku_ids的顺序获取商品卡片，不存在的商品跳过
+    cached: 已经从缓存中读取的[卡片json、删除标记或None, ...]，和sku_ids对应，为None时使用一次mget读取
+    缓存中没有的商品使用一次in_bulk查询，并写入缓存
+    '''
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return []
+
+    conn = get_redis_connection('default')
+    if cached is None:
+        cached = conn.mget([card_key(sku_id) for sku_id in sku_ids])
+
+    cards = {}
+    # {商品id: 查询之前的值}
+    missing = {}
+    for sku_id, value in zip(sku_ids, cached):
+        if _is_missing(value):
+            missing[sku_id] = value
+        else:
+            cards[sku_id] = _card(sku_id, value)
+
+    if missing:
+        skus = GoodsSKU.objects.in_bulk(list(missing))
+        if skus:
+            values = {sku_id: _card_fields(sku) for sku_id, sku in skus.items()}
+            _fill(conn, {card_key(sku_id): (missing[sku_id], value) for sku_id, value in values.items()})
+            cards.update((sku_id, _card(sku_id, value)) for sku_id, value in values.items())
+
+    return [cards[sku_id] for sku_id in sku_ids if sku_id in cards]
+
+
+def invalidate_skus(sku_ids):
+    '''商品数据变化，同时删除商品卡片'''
+    _invalidate([sku_key(sku_id) for sku_id in sku_ids] + [card_key(sku_id) for sku_id in sku_ids])
+
+
+def invalidate_types():
+    '''商品分类数据变化'''
+    _invalidate([TYPES_KEY])
+
+
+def cache_stats():
+    '''所有worker进程的缓存命中次数和命中率'''
+    values = get_redis_connection('default').hgetall(STATS_KEY)
+    stats = {key.decode() if isinstance(key, bytes) else key: int(value) for key, value in values.items()}
+    for name in _stats:
+        stats.setdefault(name, 0)
+
+    total = sum(stats.values())
+    stats['total'] = total
+    stats['local_hit_ratio'] = stats['local_hits'] / total if total else 0
+    stats['hit_ratio'] = (stats['local_hits'] + stats['redis_hits']) / total if total else 0
+    return stats
@@ -0,0 +1,296 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.template import loader
+from goods.models import GoodsSKU, GoodsType, Goods, GoodsImage
+from goods.detail_data import get_detail_data
+from order.models import OrderGoods
+from utils.cache_tasks import schedule_once
+from django_redis import get_redis_connection
+from multiprocessing import Pool
+import gzip
+import hashlib
+import io
+import os
+import time
+
+try:
+    # brotli在requirements.txt中，没有安装(例如缺少编译环境)时只生成gzip压缩文件
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# 静态页面的生成
+# 后台短时间内的多次修改合并成一次生成(debounce)
+# 生成的同时写入gzip和brotli压缩文件，nginx可以直接返回压缩好的内容(gzip_static/brotli_static)
+
+# 最后一次修改之后等待的时间，期间的修改合并为一次生成
+STATIC_INDEX_DEBOUNCE = 10
+# 从第一次修改开始最多等待的时间，防止连续修改时一直不生成
+STATIC_INDEX_MAX_DELAY = 60
+
+# 最后一次修改的时间
+STATIC_INDEX_TRIGGER_KEY = 'static_index_trigger'
+# 第一次修改的时间
+STATIC_INDEX_FIRST_TRIGGER_KEY = 'static_index_first_trigger'
+# 是否已经发出了生成任务
+STATIC_INDEX_SCHEDULED_KEY = 'static_index_scheduled'
+# 上一次生成静态首页时数据的指纹
+STATIC_INDEX_FINGERPRINT_KEY = 'static_index_fingerprint'
+
+
+def static_path(name):
+    '''获取静态文件的保存路径'''
+    return os.path.join(settings.BASE_DIR, 'static', name)
+
+
+def _write_file(path, content):
+    '''先写入临时文件再重命名，nginx不会读到写了一半的文件'''
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_static_file(name, html):
+    '''保存静态页面，同时保存gzip和brotli压缩后的文件'''
+    path = static_path(name)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    content = html.encode('utf-8')
+    _write_file(path, content)
+
+    _write_file(path + '.gz', _gzip(content))
+
+    if brotli is not None:
+        _write_file(path + '.br', brotli.compress(content))
+
+
+def _gzip(content):
+    '''gzip压缩，mtime=0使内容相同时压缩结果也相同'''
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def remove_static_file(name):
+    '''删除静态页面以及压缩文件'''
+    path = static_path(name)
+    for filename in (path, path + '.gz', path + '.br'):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def fingerprint(*objects):
+    '''根据模型对象的主键和更新时间计算数据的指纹'''
+    md5 = hashlib.md5()
+    for obj in objects:
+        md5.update(('%s:%s:%s;' % (obj.__class__.__name__, obj.pk, obj.update_time)).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def index_fingerprint(context):
+    '''计算首页数据的指纹'''
+    objects = []
+    for type in context['types']:
+        objects.append(type)
+        for banner in type.title_banner + type.image_banner:
+            objects.extend([banner, banner.sku])
+        # 热销商品的排行变化时也需要重新生成
+        objects.extend(getattr(type, 'hot_skus', []))
+    for banner in context['index_banner']:
+        objects.extend([banner, banner.sku])
+    objects.extend(context['promotion_banner'])
+    return fingerprint(*objects)
+
+
+def schedule_static_index_html():
+    '''请求重新生成静态首页，短时间内的多次请求只生成一次'''
+    now = time.time()
+    cache.set(STATIC_INDEX_TRIGGER_KEY, now, None)
+    cache.add(STATIC_INDEX_FIRST_TRIGGER_KEY, now, None)
+
+    # 已经发出了生成任务，不再重复发出
+    # 设置过期时间，防止任务丢失之后再也无法发出任务
+    schedule_once(STATIC_INDEX_SCHEDULED_KEY, STATIC_INDEX_MAX_DELAY + STATIC_INDEX_DEBOUNCE * 2,
+                  'generate_static_index_html', countdown=STATIC_INDEX_DEBOUNCE, value=now)
+
+
+def static_index_wait_time():
+    '''距离可以生成静态首页还需要等待的时间'''
+    values = cache.get_many([STATIC_INDEX_TRIGGER_KEY, STATIC_INDEX_FIRST_TRIGGER_KEY])
+    now = time.time()
+    last = values.get(STATIC_INDEX_TRIGGER_KEY, 0)
+    first = values.get(STATIC_INDEX_FIRST_TRIGGER_KEY, now)
+
+    if now - first >= STATIC_INDEX_MAX_DELAY:
+        return 0
+    return max(0, last + STATIC_INDEX_DEBOUNCE - now)
+
+
+def begin_static_index_html():
+    '''开始生成静态首页，之后的修改会发出新的生成任务'''
+    cache.delete_many([STATIC_INDEX_SCHEDULED_KEY, STATIC_INDEX_FIRST_TRIGGER_KEY])
+
+
+def static_index_changed(value):
+    '''判断首页数据和上一次生成静态首页时相比是否有变化'''
+    if not os.path.exists(static_path('index.html')):
+        return True
+    return value != cache.get(STATIC_INDEX_FINGERPRINT_KEY)
+
+
+def save_static_index_fingerprint(value):
+    '''保存生成静态首页时数据的指纹'''
+    cache.set(STATIC_INDEX_FINGERPRINT_KEY, value, None)
+
+
+# 静态详情页
+# 为每个上线的商品生成匿名用户看到的详情页，保存在static/goods/商品id.html
+# nginx对没有登录的用户(没有sessionid cookie)直接返回静态详情页:
+# location ~ ^/goods/(\d+)$ {
+#     if ($cookie_sessionid = "") { rewrite ^/goods/(\d+)$ /static/goods/$1.html break; }
+#     ...
+# }
+# 商品数据变化时只重新生成受影响的商品的详情页
+
+# 需要重新生成详情页的商品id
+STATIC_DETAIL_PENDING_KEY = 'static_detail_pending'
+# 是否已经发出了生成任务
+STATIC_DETAIL_SCHEDULED_KEY = 'static_detail_scheduled'
+# 是否已经发出了全量生成的任务
+STATIC_DETAIL_REBUILD_SCHEDULED_KEY = 'static_detail_rebuild_scheduled'
+# 发出生成任务之前等待的时间，期间的修改合并为一次生成
+STATIC_DETAIL_DEBOUNCE = 5
+# 全量生成时每个任务处理的商品数目
+STATIC_DETAIL_CHUNK_SIZE = 100
+
+
+def detail_page_name(sku_id):
+    '''静态详情页的文件名'''
+    return 'goods/%d.html' % int(sku_id)
+
+
+def generate_static_detail_pages(sku_ids):
+    '''生成商品的静态详情页，下线或者删除的商品删除静态详情页，返回生成的页面数目'''
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    skus = GoodsSKU.objects.select_related('type', 'goods').in_bulk(sku_ids)
+
+    # 所有页面共用的分类信息只查询一次
+    types = list(GoodsType.objects.all())
+    temp = loader.get_template('detail.html')
+
+    count = 0
+    for sku_id in sku_ids:
+        sku = skus.get(sku_id)
+        if sku is None or sku.status != 1:
+            # 商品不存在或者已经下线
+            remove_static_file(detail_page_name(sku_id))
+            continue
+
+        context = get_detail_data(sku, types=types)
+        # 匿名用户购物车中商品的数目
+        context.update(cart_count=0)
+        write_static_file(detail_page_name(sku_id), temp.render(context))
+        count += 1
+
+    return count
+
+
+def _chunks(items, size):
+    '''将列表按照size切分'''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def static_detail_chunks(chunk_size=STATIC_DETAIL_CHUNK_SIZE):
+    '''全量生成时需要处理的商品id，按照chunk_size分组'''
+    sku_ids = list(GoodsSKU.objects.order_by('id').values_list('id', flat=True))
+    return _chunks(sku_ids, chunk_size)
+
+
+def build_all_static_detail_pages(processes=None, chunk_size=STATIC_DETAIL_CHUNK_SIZE):
+    '''使用进程池生成所有商品的静态详情页，返回生成的页面数目'''
+    chunks = static_detail_chunks(chunk_size)
+
+    # 子进程不能共用父进程的数据库连接，fork之前关闭连接，子进程会重新建立连接
+    connections.close_all()
+
+    pool = Pool(processes)
+    try:
+        count = sum(pool.imap_unordered(generate_static_detail_pages, chunks))
+    finally:
+        pool.close()
+        pool.join()
+
+    return count
+
+
+def affected_sku_ids(instance, deleted=False):
+    '''数据变化时，需要重新生成详情页的商品id'''
+    if isinstance(instance, GoodsSKU):
+        sku_ids = {instance.id}
+        # 同一个spu的其他规格的商品页面上会显示该商品
+        sku_ids.update(GoodsSKU.objects.filter(goods=instance.goods_id).values_list('id', flat=True))
+        # 该商品是(或者删除之前是)同类型的新品时，同类型的商品页面上会显示该商品
+        new_ids = GoodsSKU.objects.filter(type=instance.type_id).order_by('-create_time').values_list('id', flat=True)[:2]
+        if deleted or instance.id in new_ids:
+            sku_ids.update(GoodsSKU.objects.filter(type=instance.type_id).values_list('id', flat=True))
+        return sku_ids
+
+    if isinstance(instance, Goods):
+        return set(GoodsSKU.objects.filter(goods=instance.id).values_list('id', flat=True))
+
+    if isinstance(instance, GoodsImage):
+        return {instance.sku_id}
+
+    if isinstance(instance, OrderGoods):
+        # 只有评论会显示在详情页上
+        return {instance.sku_id} if instance.comment else set()
+
+    return set()
+
+
+def schedule_static_detail_html(sku_ids):
+    '''请求重新生成商品的静态详情页，短时间内的多次请求合并为一次生成'''
+    if not sku_ids:
+        return
+
+    conn = get_redis_connection('default')
+    conn.sadd(STATIC_DETAIL_PENDING_KEY, *sku_ids)
+
+    schedule_once(STATIC_DETAIL_SCHEDULED_KEY, STATIC_DETAIL_DEBOUNCE * 6, 'generate_static_detail_html',
+                  countdown=STATIC_DETAIL_DEBOUNCE)
+
+
+def pop_static_detail_pending():
+    '''取出所有需要重新生成详情页的商品id'''
+    conn = get_redis_connection('default')
+
+    # 之后的修改会发出新的生成任务
+    cache.delete(STATIC_DETAIL_SCHEDULED_KEY)
+
+    pipe = conn.pipeline()
+    pipe.smembers(STATIC_DETAIL_PENDING_KEY)
+    pipe.delete(STATIC_DETAIL_PENDING_KEY)
+    sku_ids, _ = pipe.execute()
+    return sorted(int(sku_id) for sku_id in sku_ids)
+
+
+def schedule_static_detail_rebuild():
+    '''请求重新生成所有商品的静态详情页，短时间内的多次请求只生成一次，还没有商品时不需要生成'''
+    if not GoodsSKU.objects.exists():
+        return
+
+    schedule_once(STATIC_DETAIL_REBUILD_SCHEDULED_KEY, STATIC_DETAIL_DEBOUNCE * 6, 'rebuild_static_detail_html',
+                  countdown=STATIC_DETAIL_DEBOUNCE)
+
+
+def begin_static_detail_rebuild():
+    '''开始全量生成，之后的修改会发出新的生成任务'''
+    cache.delete(STATIC_DETAIL_REBUILD_SCHEDULED_KEY)
@@ -0,0 +1,164 @@
+from django.core.cache import cache
+
+from goods.models import GoodsSKU
+from utils.cache_tasks import incr_version, schedule_once
+from array import array
+import bisect
+import time
+import jieba
+
+try:
+    # pypinyin是可选的依赖，没有安装时不支持拼音搜索
+    from pypinyin import lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+
+# 搜索框的输入提示
+# 根据商品名称和SPU名称、分词结果、拼音全拼和首字母生成前缀索引，保存在每个worker进程的内存中
+# 前缀索引由版本号对应的快照生成，快照保存在redis中，所有的worker进程共用
+# 商品数据变化时增加版本号，worker进程发现版本号变化之后重新加载快照
+# 查询时只在内存中二分查找，不访问数据库和搜索引擎
+
+# 商品数据的版本号
+CATALOG_VERSION_KEY = 'catalog_version'
+# 快照的过期时间
+SUGGEST_SNAPSHOT_TIMEOUT = 24 * 3600
+# 是否已经发出了生成快照的任务
+SUGGEST_SCHEDULED_KEY = 'suggest_snapshot_scheduled'
+# 生成快照的任务的最长执行时间，超时之后可以再次发出任务
+SUGGEST_SCHEDULE_TIMEOUT = 600
+# worker进程检查版本号的间隔
+SUGGEST_CHECK_INTERVAL = 5
+# 默认返回的提示数目
+SUGGEST_LIMIT = 10
+
+
+def expire_catalog():
+    '''增加商品数据的版本号'''
+    incr_version(CATALOG_VERSION_KEY)
+
+
+def suggest_terms(name, goods_name):
+    '''生成商品的索引词'''
+    terms = set()
+    for text in (name, goods_name):
+        text = text.strip().lower()
+        if not text:
+            continue
+        terms.add(text)
+        # 分词之后每个词都可以作为前缀，输入"苹果"可以提示"红富士苹果"
+        terms.update(word.strip() for word in jieba.cut_for_search(text) if word.strip())
+        if lazy_pinyin is not None:
+            letters = lazy_pinyin(text)
+            # 拼音全拼和首字母
+            terms.add(''.join(letters))
+            terms.add(''.join(letter[0] for letter in letters if letter))
+    terms.discard('')
+    return terms
+
+
+class PrefixIndex(object):
+    '''前缀索引'''
+
+    def __init__(self, keys, sku_ids, names):
+        # keys: 排好序的索引词
+        # sku_ids: 和keys对应的商品id，同一个索引词的商品按照销量从高到低排列
+        # names: {商品id: 商品名称}
+        self.keys = keys
+        self.sku_ids = sku_ids
+        self.names = names
+
+    @classmethod
+    def build(cls, entries):
+        '''根据(商品id, 商品名称, SPU名称)生成前缀索引，entries按照销量从高到低排列'''
+        pairs = []
+        names = {}
+        for rank, (sku_id, name, goods_name) in enumerate(entries):
+            names[sku_id] = name
+            for term in suggest_terms(name, goods_name):
+                pairs.append((term, rank, sku_id))
+        pairs.sort()
+
+        keys = [term for term, rank, sku_id in pairs]
+        sku_ids = array('l', (sku_id for term, rank, sku_id in pairs))
+        return cls(keys, sku_ids, names)
+
+    def snapshot(self):
+        '''保存到redis中的快照'''
+        return self.keys, self.sku_ids, self.names
+
+    def lookup(self, prefix, limit=SUGGEST_LIMIT):
+        '''查找以prefix开头的索引词对应的商品，返回[(商品id, 商品名称), ...]'''
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(results) < limit and self.keys[i].startswith(prefix):
+            sku_id = self.sku_ids[i]
+            if sku_id not in seen:
+                seen.add(sku_id)
+                results.append((sku_id, self.names[sku_id]))
+            i += 1
+        return results
+
+
+def build_suggest_index():
+    '''根据数据库中上线的商品生成前缀索引'''
+    entries = GoodsSKU.objects.filter(status=1).order_by('-sales', 'id').values_list('id', 'name', 'goods__name')
+    return PrefixIndex.build(entries.iterator())
+
+
+def snapshot_key(version):
+    '''快照的缓存名称'''
+    return 'suggest_snapshot_%d' % version
+
+
+def save_suggest_snapshot():
+    '''根据当前的版本号生成快照'''
+    # 之后的版本变化会发出新的生成任务
+    cache.delete(SUGGEST_SCHEDULED_KEY)
+
+    version = cache.get(CATALOG_VERSION_KEY, 0)
+    index = build_suggest_index()
+    cache.set(snapshot_key(version), index.snapshot(), SUGGEST_SNAPSHOT_TIMEOUT)
+    return index
+
+
+def load_suggest_index(version):
+    '''获取版本号对应的前缀索引，快照不存在时发出生成快照的任务并返回None'''
+    snapshot = cache.get(snapshot_key(version))
+    if snapshot is not None:
+        return PrefixIndex(*snapshot)
+
+    # 商品数目多时生成快照需要较长的时间，交给celery生成，同一时间只发出一个任务
+    schedule_once(SUGGEST_SCHEDULED_KEY, SUGGEST_SCHEDULE_TIMEOUT, 'generate_suggest_snapshot', value=version)
+    return None
+
+
+# 当前worker进程中的前缀索引
+_suggest = {'version': None, 'index': None, 'checked': 0}
+
+
+def get_suggest_index():
+    '''获取当前worker进程中的前缀索引，版本号变化时重新加载，还没有生成过快照时返回None'''
+    now = time.time()
+    if _suggest['index'] is not None and now - _suggest['checked'] < SUGGEST_CHECK_INTERVAL:
+        return _suggest['index']
+
+    _suggest['checked'] = now
+    version = cache.get(CATALOG_VERSION_KEY, 0)
+    if version == _suggest['version']:
+        return _suggest['index']
+
+    index = load_suggest_index(version)
+    if index is not None:
+        _suggest['index'] = index
+        _suggest['version'] = version
+
+    # 新版本的快照还没有生成时继续使用旧索引
+    # 进程刚启动并且没有任何快照时返回None，不在请求中扫描商品表，等待celery任务生成快照
+    return _suggest['index']
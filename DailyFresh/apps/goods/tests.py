@@ -1,3 +1,380 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from unittest import mock
+
+from goods.models import GoodsType, Goods, GoodsSKU, IndexTypeGoodsBanner, IndexGoodsBanner
+from goods.index_data import get_index_data, get_cached_index_data, expire_index_data
+from goods.listing import get_list_page, expire_list_sales
+from goods.suggest import PrefixIndex
+from goods.static_pages import schedule_static_index_html, static_index_wait_time, begin_static_index_html, \
+    index_fingerprint, begin_static_detail_rebuild, STATIC_INDEX_DEBOUNCE, STATIC_INDEX_MAX_DELAY, \
+    STATIC_DETAIL_DEBOUNCE
+from goods import sku_cache
+from goods.sku_cache import card_key, get_sku_cards, invalidate_skus
+from utils.lru import LRUCache
+from utils.user_state import get_history, history_key
+from datetime import datetime, timedelta
+from decimal import Decimal
+import threading
+import time
+
 
 # Create your tests here.
+
+
+class IndexDataTest(TestCase):
+    '''首页数据组织的测试'''
+
+    def add_type(self, n):
+        '''添加一个商品种类，以及它的文字和图片展示商品'''
+        type = GoodsType.objects.create(name='种类%d' % n, logo='logo%d' % n, image='type/%d.jpg' % n)
+        goods = Goods.objects.create(name='商品%d' % n)
+        for display_type in (0, 1):
+            sku = GoodsSKU.objects.create(type=type, goods=goods, name='sku%d' % n, desc='',
+                                          price=10, unite='500g', image='goods/%d.jpg' % n)
+            IndexTypeGoodsBanner.objects.create(type=type, sku=sku, display_type=display_type)
+        return type
+
+    def test_query_count_is_constant(self):
+        '''查询次数不随商品种类的数目增长'''
+        self.add_type(1)
+        with self.assertNumQueries(4):
+            context = get_index_data()
+            # 访问展示商品的sku不会产生额外的查询
+            for type in context['types']:
+                for banner in type.title_banner + type.image_banner:
+                    banner.sku.name
+
+        for n in range(2, 7):
+            self.add_type(n)
+        with self.assertNumQueries(4):
+            context = get_index_data()
+            for type in context['types']:
+                for banner in type.title_banner + type.image_banner:
+                    banner.sku.name
+
+    def test_banners_grouped_by_type(self):
+        '''展示商品按照种类和展示类型分组'''
+        first = self.add_type(1)
+        second = self.add_type(2)
+
+        types = {type.id: type for type in get_index_data()['types']}
+
+        for type in (first, second):
+            self.assertEqual([banner.display_type for banner in types[type.id].title_banner], [0])
+            self.assertEqual([banner.display_type for banner in types[type.id].image_banner], [1])
+            self.assertTrue(all(banner.type_id == type.id for banner in types[type.id].image_banner))
+
+
+class HistoryTest(TestCase):
+    '''浏览记录的测试'''
+
+    user_id = 10 ** 9
+
+    def setUp(self):
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        goods = Goods.objects.create(name='苹果')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='苹果%d' % i, desc='', price=Decimal('2.50'),
+                                             unite='500g', image='sku/%d.jpg' % i)
+                     for i in range(4)]
+        conn = get_redis_connection('default')
+        conn.delete(history_key(self.user_id))
+        self.addCleanup(conn.delete, history_key(self.user_id))
+        self.addCleanup(conn.delete, *[card_key(sku.id) for sku in self.skus])
+
+    def test_recency_order(self):
+        '''按照浏览的先后返回，缓存中没有的商品只查询一次数据库，之后不访问数据库'''
+        conn = get_redis_connection('default')
+        deleted = self.skus[3].id
+        self.skus[3].delete()
+        for sku_id in (self.skus[2].id, deleted, self.skus[0].id, self.skus[1].id):
+            conn.lpush(history_key(self.user_id), sku_id)
+
+        with self.assertNumQueries(1):
+            cards = get_history(self.user_id, 10)
+        self.assertEqual([card.id for card in cards], [self.skus[1].id, self.skus[0].id, self.skus[2].id])
+        self.assertEqual((cards[0].name, cards[0].price, cards[0].unite), ('苹果1', Decimal('2.50'), '500g'))
+        self.assertTrue(cards[0].image_url.endswith('sku/1.jpg'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual([card.id for card in get_history(self.user_id, 2)], [self.skus[1].id, self.skus[0].id])
+
+        # 商品修改之后重新查询
+        invalidate_skus([self.skus[0].id])
+        with self.assertNumQueries(1):
+            get_history(self.user_id, 2)
+
+    def test_invalidate_during_load(self):
+        '''查询数据库期间商品变化时不写入查询到的旧数据'''
+        sku = self.skus[0]
+        in_bulk = GoodsSKU.objects.in_bulk
+
+        def change_after_load(sku_ids):
+            # 查询之后商品被修改
+            result = in_bulk(sku_ids)
+            GoodsSKU.objects.filter(id=sku.id).update(name='新苹果')
+            invalidate_skus([sku.id])
+            return result
+
+        with mock.patch.object(GoodsSKU.objects, 'in_bulk', side_effect=change_after_load):
+            self.assertEqual(get_sku_cards([sku.id])[0].name, '苹果0')
+        self.assertEqual(get_sku_cards([sku.id])[0].name, '新苹果')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_sku_cards([sku.id])[0].name, '新苹果')
+        self.assertGreater(get_redis_connection('default').ttl(card_key(sku.id)), 0)
+
+
+class SkuCacheTest(SimpleTestCase):
+    '''商品两级缓存的测试'''
+
+    key = 'test_sku_cache'
+
+    def setUp(self):
+        self.addCleanup(get_redis_connection('default').delete, self.key)
+        self.addCleanup(sku_cache._local.delete, self.key)
+
+    def test_invalidate_during_load(self):
+        '''查询数据库期间数据变化时不写入查询到的旧数据'''
+        def load():
+            # 查询之后数据被修改
+            sku_cache._invalidate([self.key])
+            return 'old'
+
+        self.assertEqual(sku_cache._get(self.key, load), 'old')
+        self.assertEqual(sku_cache._get(self.key, lambda: 'new'), 'new')
+
+        # redis中是查询到的新数据
+        sku_cache._local.delete(self.key)
+        self.assertEqual(sku_cache._get(self.key, lambda: 'newer'), 'new')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StaticDetailRebuildTest(TestCase):
+    '''商品分类变化时全量生成静态详情页的测试'''
+
+    def setUp(self):
+        cache.clear()
+        patchers = [mock.patch('celery_tasks.tasks.rebuild_static_detail_html'),
+                    mock.patch('celery_tasks.tasks.generate_static_detail_html')]
+        self.task = patchers[0].start()
+        patchers[1].start()
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_rebuild_debounce(self):
+        '''还没有商品时不生成，显示的名称和标识变化时才生成，多次修改只发出一次任务'''
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        GoodsSKU.objects.create(type=type, goods=Goods.objects.create(name='苹果'), name='苹果', desc='',
+                                price=Decimal('2.50'), unite='500g', image='sku/1.jpg')
+        self.assertFalse(self.task.apply_async.called)
+
+        type.image = 'type/fruit2.jpg'
+        type.save()
+        self.assertFalse(self.task.apply_async.called)
+
+        type.name = '新鲜水果'
+        type.save()
+        GoodsType.objects.create(name='海鲜', logo='seafood', image='type/seafood.jpg')
+        self.task.apply_async.assert_called_once_with((), countdown=STATIC_DETAIL_DEBOUNCE)
+
+        # 开始生成之后的修改发出新的任务
+        begin_static_detail_rebuild()
+        type.logo = 'fruits'
+        type.save()
+        self.assertEqual(self.task.apply_async.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ListPageTest(TestCase):
+    '''列表页分页的测试'''
+
+    def setUp(self):
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        goods = Goods.objects.create(name='苹果')
+        self.type_id = type.id
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='苹果%d' % i, desc='', price=Decimal(i + 1),
+                                             unite='500g', image='sku/%d.jpg' % i, sales=i)
+                     for i in range(4)]
+
+    def test_lazy_cursors(self):
+        '''直接跳页时只查询一次游标，销量变化时按照销量排序的游标失效'''
+        with self.assertNumQueries(3):
+            sku_page = get_list_page(self.type_id, 'price', 3)
+        self.assertEqual((list(sku_page)[0].id, sku_page.num_pages), (self.skus[2].id, 4))
+        # 顺序翻页不需要再查询游标
+        with self.assertNumQueries(1):
+            self.assertEqual(list(get_list_page(self.type_id, 'price', 4))[0].id, self.skus[3].id)
+
+        self.assertEqual(list(get_list_page(self.type_id, 'hot', 2))[0].id, self.skus[2].id)
+        GoodsSKU.objects.filter(id=self.skus[0].id).update(sales=10)
+        expire_list_sales([self.type_id])
+        self.assertEqual(list(get_list_page(self.type_id, 'hot', 2))[0].id, self.skus[3].id)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(get_list_page(self.type_id, 'price', 3))[0].id, self.skus[2].id)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class IndexCacheTest(SimpleTestCase):
+    '''首页数据缓存的测试'''
+
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+
+    def slow_build(self):
+        '''模拟耗时的首页数据生成'''
+        self.builds += 1
+        time.sleep(0.2)
+        return {'types': [], 'build': self.builds}
+
+    def burst(self, count=10):
+        '''同时发起count个请求'''
+        results = []
+
+        def request():
+            results.append(get_cached_index_data())
+
+        threads = [threading.Thread(target=request) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_rebuild_after_expire(self):
+        '''后台修改数据之后，大量请求只重新生成一次'''
+        with mock.patch('goods.index_data.get_index_data', self.slow_build):
+            get_cached_index_data()
+            expire_index_data()
+            results = self.burst()
+
+        self.assertEqual(self.builds, 2)
+        # 其他请求继续使用旧数据
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(context['build'] in (1, 2) for context in results))
+        self.assertEqual(get_cached_index_data()['build'], 2)
+
+    def test_single_rebuild_when_cold(self):
+        '''没有任何缓存数据时，也只生成一次'''
+        with mock.patch('goods.index_data.get_index_data', self.slow_build):
+            results = self.burst()
+
+        self.assertEqual(self.builds, 1)
+        self.assertTrue(all(context['build'] == 1 for context in results))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StaticIndexTest(SimpleTestCase):
+    '''静态首页生成的合并和指纹的测试'''
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('celery_tasks.tasks.generate_static_index_html')
+        self.task = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def schedule(self, now):
+        with mock.patch('goods.static_pages.time.time', return_value=now):
+            schedule_static_index_html()
+
+    def wait_time(self, now):
+        with mock.patch('goods.static_pages.time.time', return_value=now):
+            return static_index_wait_time()
+
+    def test_debounce(self):
+        '''多次修改只发出一次任务，最后一次修改之后等待，最多等待STATIC_INDEX_MAX_DELAY'''
+        self.schedule(1000)
+        self.schedule(1005)
+        self.task.apply_async.assert_called_once_with((), countdown=STATIC_INDEX_DEBOUNCE)
+
+        self.assertEqual(self.wait_time(1010), STATIC_INDEX_DEBOUNCE - 5)
+        self.assertEqual(self.wait_time(1005 + STATIC_INDEX_DEBOUNCE), 0)
+
+        # 一直有修改时，从第一次修改开始最多等待STATIC_INDEX_MAX_DELAY
+        self.schedule(1000 + STATIC_INDEX_MAX_DELAY - 1)
+        self.assertEqual(self.wait_time(1000 + STATIC_INDEX_MAX_DELAY), 0)
+        self.assertEqual(self.task.apply_async.call_count, 1)
+
+        # 开始生成之后的修改发出新的任务
+        begin_static_index_html()
+        self.schedule(1100)
+        self.assertEqual(self.task.apply_async.call_count, 2)
+        self.assertEqual(self.wait_time(1100), STATIC_INDEX_DEBOUNCE)
+
+    def context(self, update_time):
+        sku = GoodsSKU(id=1, update_time=update_time)
+        type = GoodsType(id=1, update_time=update_time)
+        type.title_banner = [IndexTypeGoodsBanner(id=1, sku=sku, update_time=update_time)]
+        type.image_banner = []
+        return {'types': [type], 'index_banner': [IndexGoodsBanner(id=1, sku=sku, update_time=update_time)],
+                'promotion_banner': []}
+
+    def test_fingerprint(self):
+        '''数据没有修改时指纹不变，修改之后指纹变化'''
+        update_time = datetime(2017, 11, 1)
+        value = index_fingerprint(self.context(update_time))
+        self.assertEqual(index_fingerprint(self.context(update_time)), value)
+
+        context = self.context(update_time)
+        context['types'][0].title_banner[0].sku.update_time = update_time + timedelta(seconds=1)
+        self.assertNotEqual(index_fingerprint(context), value)
+
+        # 热销商品变化
+        context = self.context(update_time)
+        context['types'][0].hot_skus = [GoodsSKU(id=2, update_time=update_time)]
+        hot = index_fingerprint(context)
+        self.assertNotEqual(hot, value)
+        context['types'][0].hot_skus.insert(0, GoodsSKU(id=3, update_time=update_time))
+        self.assertNotEqual(index_fingerprint(context), hot)
+
+
+class PrefixIndexTest(SimpleTestCase):
+    '''搜索提示前缀索引的测试'''
+
+    def setUp(self):
+        # 按照销量从高到低排列
+        self.index = PrefixIndex.build([
+            (1, '红富士苹果', '苹果'),
+            (2, '青苹果', '苹果'),
+            (3, '草莓', '草莓'),
+        ])
+
+    def test_lookup_by_prefix(self):
+        '''根据名称和分词结果的前缀查找，销量高的商品排在前面'''
+        self.assertEqual(self.index.lookup('草'), [(3, '草莓')])
+        self.assertEqual([sku_id for sku_id, name in self.index.lookup('苹果')], [1, 2])
+
+    def test_lookup_limit(self):
+        '''返回的数目不超过limit，同一个商品只返回一次'''
+        self.assertEqual(len(self.index.lookup('苹', limit=1)), 1)
+        self.assertEqual(self.index.lookup('  '), [])
+        self.assertEqual(self.index.lookup('西瓜'), [])
+
+
+class LRUCacheTest(SimpleTestCase):
+    '''进程内LRU缓存的测试'''
+
+    def test_evict_least_recently_used(self):
+        '''超过数目上限时删除最久没有使用的数据'''
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        # 使用过a之后，b成为最久没有使用的数据
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIs(lru.get('b'), LRUCache.MISSING)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_expire(self):
+        '''超过ttl的数据不再返回'''
+        lru = LRUCache(maxsize=2, ttl=60)
+        with mock.patch('utils.lru.time.time', return_value=1000):
+            lru.set('a', None)
+            # None也是可以缓存的数据
+            self.assertIsNone(lru.get('a'))
+        with mock.patch('utils.lru.time.time', return_value=1061):
+            self.assertIs(lru.get('a'), LRUCache.MISSING)
+        self.assertEqual(len(lru), 0)
@@ -1,5 +1,5 @@
 from django.conf.urls import url
-from goods.views import IndexView, DetailView, ListView
+from goods.views import IndexView, DetailView, ListView, SuggestView
 
 urlpatterns = [
     url(r'^index$', IndexView.as_view(), name='index'),  # 首页
@@ -7,4 +7,6 @@ urlpatterns = [
     url(r'^goods/(?P<sku_id>\d+)$', DetailView.as_view(), name='detail'),  # 详情页
 
     url(r'^list/(?P<type_id>\d+)/(?P<page>\d+)$', ListView.as_view(), name='list'),  # 列表页
+
+    url(r'^search/suggest$', SuggestView.as_view(), name='suggest'),  # 搜索框的输入提示
 ]
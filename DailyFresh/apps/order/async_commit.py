@@ -0,0 +1,101 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from order.commit import new_order_id, read_cart_counts, create_order_batch, orders_created, stock_changed
+from order.tickets import init_ticket, finish_tickets
+from order.work_queue import claim_batch, ack_batch, requeue_stale, split_created
+from cart.store import user_cart, delete_cart_items
+from utils.cache_tasks import schedule_once
+import json
+
+
+# 异步下单
+# 下单请求只读取一次购物车就放入队列，立即返回订单id作为凭据，web进程不等待数据库
+# 队列中的订单由orders队列上的celery worker按批处理，一批订单中同一个商品只加锁一次、只减少一次库存
+# orders队列只启动一个worker进程，同一个商品的库存修改被串行化，不会有多个事务争抢同一行的锁:
+# celery -A celery_tasks.tasks worker -Q orders -c 1
+# 处理完成之后才从处理中的集合删除，worker异常退出时下单请求不会丢失(order.work_queue)
+
+# 等待处理的下单请求
+ORDER_QUEUE_KEY = 'order_requests'
+# 是否已经发出了处理任务
+ORDER_SCHEDULED_KEY = 'order_process_scheduled'
+# 发出处理任务之前等待的时间(秒)，期间的下单请求合并为一批处理
+ORDER_BATCH_DELAY = 0.2
+# 每批处理的下单请求数目
+ORDER_BATCH_SIZE = 100
+
+
+def enqueue_order(user, addr_id, pay_method, sku_ids):
+    '''
+    把下单请求放入队列，返回订单id作为查询处理结果的凭据
+    商品不在购物车中时抛出OrderError，其余的校验在处理时进行
+    '''
+    cart = user_cart(user.id)
+    counts = read_cart_counts(cart, sku_ids)
+
+    order_id = new_order_id()
+    data = {'order_id': order_id,
+            'user_id': user.id,
+            'addr_id': int(addr_id),
+            'pay_method': int(pay_method),
+            'counts': counts}
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    init_ticket(pipe, order_id, user.id)
+    pipe.rpush(ORDER_QUEUE_KEY, json.dumps(data))
+    pipe.execute()
+
+    schedule_order_process()
+    return order_id
+
+
+def schedule_order_process():
+    '''发出处理任务，短时间内的下单请求合并为一批处理'''
+    schedule_once(ORDER_SCHEDULED_KEY, 30, 'process_order_requests', countdown=ORDER_BATCH_DELAY)
+
+
+def recover_order_requests():
+    '''把处理中途worker退出而没有完成的下单请求放回队列，重新发出处理任务'''
+    conn = get_redis_connection('default')
+    count = requeue_stale(conn, ORDER_QUEUE_KEY)
+    if count:
+        schedule_order_process()
+    return count
+
+
+def process_order_requests():
+    '''按批处理队列中的下单请求，返回创建成功的订单数目'''
+    # 之后的下单请求会发出新的处理任务
+    cache.delete(ORDER_SCHEDULED_KEY)
+
+    conn = get_redis_connection('default')
+    created = 0
+    while True:
+        batch = claim_batch(conn, ORDER_QUEUE_KEY, ORDER_BATCH_SIZE)
+        if not batch:
+            break
+
+        # 重新处理的请求中已经创建的订单不再创建
+        requests, existing = split_created([data for item, data in batch])
+
+        # 地址错误、商品不存在、库存不足的订单不创建
+        orders, lines, failures, sales = create_order_batch(requests)
+        orders_created(orders, lines)
+        succeeded = [order.order_id for order in orders]
+
+        # 删除购物车中已经下单的商品
+        for item, request in batch:
+            if request['order_id'] not in failures:
+                delete_cart_items(user_cart(request['user_id']), sorted(request['counts']))
+
+        finish_tickets(succeeded + existing, failures)
+        if sales:
+            stock_changed(sales)
+        created += len(succeeded)
+
+        # 处理完成，从处理中的集合删除
+        ack_batch(conn, ORDER_QUEUE_KEY, batch)
+
+    return created
@@ -0,0 +1,232 @@
+from django.db import transaction, DatabaseError
+from django.db.models import Case, When, F, IntegerField
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from goods.listing import expire_list_sales
+from goods.ranking import record_sales
+from goods.sku_cache import invalidate_skus
+from goods.static_pages import schedule_static_index_html
+from user.models import Address
+from order.models import OrderInfo, OrderGoods
+from order.history import expire_order_history
+from order.summary import add_orders
+from cart.store import user_cart, delete_cart_items, refresh_sku_stock
+from utils.snowflake import next_id
+import logging
+
+
+# 订单的创建
+# 一次HMGET读取所有商品的数目，在一个事务中按照商品id的顺序锁定所有商品
+# 不论一批订单中有多少订单和商品，事务中都只执行固定数目的语句:
+# 锁定商品(select ... for update)、校验地址、减少库存增加销量(一条update)、批量创建订单、批量创建订单商品
+# 按照id的顺序加锁，同时下单的事务之间不会死锁，也不需要乐观锁的重试
+# 事务提交之后订单已经创建，之后对redis的更新失败时只记录日志，不能再把订单当作失败
+
+logger = logging.getLogger(__name__)
+
+# 运费
+TRANSIT_PRICE = 10
+
+
+class OrderError(Exception):
+    '''创建订单失败，res和errmsg直接返回给前端'''
+
+    def __init__(self, res, errmsg):
+        super(OrderError, self).__init__(errmsg)
+        self.res = res
+        self.errmsg = errmsg
+
+
+def new_order_id():
+    '''生成订单id，同一个用户同一秒内的多个订单也不会重复'''
+    return next_id()
+
+
+def decrease_stock(counts):
+    '''一条update语句减少所有商品的库存，增加销量，counts: {sku_id: 数目}'''
+    stock = Case(*[When(id=sku_id, then=F('stock') - count) for sku_id, count in counts.items()],
+                 output_field=IntegerField())
+    sales = Case(*[When(id=sku_id, then=F('sales') + count) for sku_id, count in counts.items()],
+                 output_field=IntegerField())
+    return GoodsSKU.objects.filter(id__in=list(counts)).update(stock=stock, sales=sales)
+
+
+def read_cart_counts(cart, sku_ids):
+    '''一次HMGET获取用户要购买的所有商品的数目，返回{sku_id: 数目}，商品不在购物车中时抛出OrderError'''
+    sku_ids = sorted(set(int(sku_id) for sku_id in sku_ids))
+    if not sku_ids:
+        raise OrderError(4, '商品信息错误')
+
+    conn = get_redis_connection('default')
+    counts = conn.hmget(cart.key, sku_ids)
+    if None in counts:
+        # 商品不在购物车中
+        raise OrderError(4, '商品信息错误')
+    return dict(zip(sku_ids, (int(count) for count in counts)))
+
+
+def create_orders(requests):
+    '''
+    在一个事务中批量创建订单
+    requests: [{'order_id', 'user_id', 'addr_id', 'pay_method', 'counts': {sku_id: 数目}}, ...]
+    按照商品id的顺序一次锁定这一批订单涉及的所有商品，按照订单的先后顺序分配库存
+    同一个商品的库存只用一条update语句减少，地址错误、商品不存在、库存不足的订单不创建
+    只访问数据库，提交之后由调用的一方执行orders_created
+    返回(创建的订单列表, 订单商品列表, 失败的订单{order_id: OrderError}, 销量[(种类id, 商品id, 数目), ...])
+    '''
+    sku_ids = sorted(set(sku_id for request in requests for sku_id in request['counts']))
+    addr_ids = set(request['addr_id'] for request in requests)
+
+    orders = []
+    failures = {}
+    sold = {}
+    with transaction.atomic():
+        # select * from df_goods_sku where id in (...) order by id for update;
+        skus = {sku.id: sku for sku in GoodsSKU.objects.select_for_update().filter(id__in=sku_ids).order_by('id')}
+        # 收货地址只能是下单用户自己的地址
+        addrs = dict(Address.objects.filter(id__in=list(addr_ids)).values_list('id', 'user_id'))
+
+        stocks = {sku_id: sku.stock for sku_id, sku in skus.items()}
+        accepted = []
+        for request in requests:
+            counts = request['counts']
+            if addrs.get(request['addr_id']) != request['user_id']:
+                failures[request['order_id']] = OrderError(2, '地址信息错误')
+            elif any(sku_id not in skus for sku_id in counts):
+                failures[request['order_id']] = OrderError(4, '商品信息错误')
+            elif any(count > stocks[sku_id] for sku_id, count in counts.items()):
+                failures[request['order_id']] = OrderError(6, '商品库存不足')
+            else:
+                for sku_id, count in counts.items():
+                    stocks[sku_id] -= count
+                    sold[sku_id] = sold.get(sku_id, 0) + count
+                accepted.append(request)
+
+        if not accepted:
+            return orders, [], failures, []
+
+        # 减少商品的库存，增加销量
+        decrease_stock(sold)
+
+        # 订单只写入一次，直接写入最终的总件数和总价格
+        lines = []
+        for request in accepted:
+            total_count = 0
+            total_price = 0
+            for sku_id, count in sorted(request['counts'].items()):
+                sku = skus[sku_id]
+                total_count += count
+                total_price += sku.price * count
+                lines.append(OrderGoods(order_id=request['order_id'], sku=sku, count=count, price=sku.price))
+            orders.append(OrderInfo(order_id=request['order_id'],
+                                    user_id=request['user_id'],
+                                    addr_id=request['addr_id'],
+                                    pay_method=request['pay_method'],
+                                    total_count=total_count,
+                                    total_price=total_price,
+                                    transit_price=TRANSIT_PRICE))
+
+        # 一条insert语句添加所有的订单，一条insert语句添加所有的订单商品
+        OrderInfo.objects.bulk_create(orders)
+        OrderGoods.objects.bulk_create(lines)
+
+    return orders, lines, failures, [(skus[sku_id].type_id, sku_id, count) for sku_id, count in sorted(sold.items())]
+
+
+def create_order_batch(requests):
+    '''
+    批量创建订单，一批订单的事务因为数据库错误失败时逐个创建，不影响其他订单
+    返回值和create_orders相同
+    '''
+    if not requests:
+        return [], [], {}, []
+
+    try:
+        return create_orders(requests)
+    except DatabaseError:
+        logger.exception('批量创建%d个订单失败，逐个创建', len(requests))
+
+    orders = []
+    lines = []
+    failures = {}
+    sales = []
+    for request in requests:
+        try:
+            created, created_lines, failed, sold = create_orders([request])
+        except DatabaseError:
+            logger.exception('创建订单%s失败', request['order_id'])
+            created, created_lines, failed, sold = [], [], {request['order_id']: OrderError(7, '下单失败')}, []
+        orders.extend(created)
+        lines.extend(created_lines)
+        failures.update(failed)
+        sales.extend(sold)
+    return orders, lines, failures, sales
+
+
+def _after_commit(func, *args):
+    '''订单已经提交，执行失败时只记录日志'''
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('订单提交之后执行%s失败', func.__name__)
+
+
+def orders_created(orders, lines):
+    '''订单提交之后记录支付截止时间，更新用户订单页的缓存和读模型'''
+    if not orders:
+        return
+
+    # 记录订单的支付截止时间，超时未支付的订单会被取消并归还库存
+    # expiry中使用了本模块的函数，在这里导入
+    from order.expiry import schedule_expiry
+    _after_commit(schedule_expiry, orders)
+
+    # 用户订单页的分页游标失效
+    _after_commit(expire_order_history, set(order.user_id for order in orders))
+
+    # 加入用户订单的读模型
+    _after_commit(add_orders, orders, lines)
+
+
+def create_order(user, addr, pay_method, sku_ids, order_id=None):
+    '''
+    根据购物车中的商品创建订单，返回创建的订单
+    商品不存在或者不在购物车中、库存不足时抛出OrderError
+    '''
+    cart = user_cart(user.id)
+    counts = read_cart_counts(cart, sku_ids)
+
+    order_id = order_id or new_order_id()
+    orders, lines, failures, sales = create_orders([{'order_id': order_id,
+                                                     'user_id': user.id,
+                                                     'addr_id': addr.id,
+                                                     'pay_method': int(pay_method),
+                                                     'counts': counts}])
+    if order_id in failures:
+        raise failures[order_id]
+    orders_created(orders, lines)
+
+    # 删除购物车中的对应记录
+    _after_commit(delete_cart_items, cart, sorted(counts))
+
+    _after_commit(stock_changed, sales)
+
+    return orders[0]
+
+
+def stock_changed(sales):
+    '''订单提交之后更新redis中的数据，sales: [(种类id, 商品id, 数目), ...]'''
+    # 增加redis中商品的销量排行
+    record_sales(sales)
+
+    # 按照销量排序的列表页的游标失效
+    expire_list_sales(set(type_id for type_id, sku_id, count in sales))
+
+    # 商品的库存和销量变化，删除商品的缓存，更新添加购物车时使用的库存
+    sku_ids = sorted(set(sku_id for type_id, sku_id, count in sales))
+    invalidate_skus(sku_ids)
+    refresh_sku_stock(sku_ids)
+
+    # 热销排行可能变化，请求重新生成静态首页，排行没有变化时不会重写文件
+    schedule_static_index_html()
@@ -0,0 +1,142 @@
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from order.models import OrderInfo, OrderGoods
+from order.commit import decrease_stock, stock_changed
+from order.summary import set_order_status
+import time
+
+
+# 超时未支付订单的取消
+# 创建订单时已经减少了库存，等待支付的订单放入redis的有序集合，分数是支付的截止时间
+# 定时任务每次只取出已经到期的订单，取消仍未支付的订单，按商品批量归还库存、减少销量
+# 每次执行的开销只和到期的订单数目有关，和订单表的大小无关
+# 货到付款的订单不需要在线支付，不会超时取消
+# 取消之前先关闭已经发起的支付宝交易，交易已经支付的订单不取消，关闭失败的订单稍后重试
+# 取出订单时不删除，只把截止时间推迟ORDER_EXPIRE_CLAIM_TIMEOUT，取消的事务提交之后才删除
+# worker在取出之后、提交之前被杀死时，订单在推迟的时间之后重新被取出
+
+# 等待支付的订单 order_pay_deadline: {订单id: 支付截止时间}
+ORDER_DEADLINE_KEY = 'order_pay_deadline'
+# 支付的时限(秒)
+ORDER_PAY_TIMEOUT = 30 * 60
+# 每批取消的订单数目
+ORDER_EXPIRE_BATCH = 500
+# 关闭支付宝交易失败的订单重试之前等待的时间(秒)
+ORDER_CLOSE_RETRY = 60
+# 取出之后多久没有删除就重新取出(秒)，远大于关闭交易、取消一批订单的时间
+ORDER_EXPIRE_CLAIM_TIMEOUT = 600
+
+# 取出一批已经到期的订单，把截止时间推迟到重新取出的时间，多个worker同时执行时同一个订单只会被取出一次
+# KEYS[1]: 等待支付的订单 ARGV[1]: 当前时间 ARGV[2]: 最多取出的数目 ARGV[3]: 重新取出的时间
+CLAIM_DUE_SCRIPT = '''
+local ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, order_id in ipairs(ids) do
+    redis.call('zadd', KEYS[1], ARGV[3], order_id)
+end
+return ids
+'''
+
+
+def schedule_expiry(orders, now=None):
+    '''记录新创建的订单的支付截止时间'''
+    deadline = (now or time.time()) + ORDER_PAY_TIMEOUT
+    deadlines = {str(order.order_id): deadline for order in orders
+                 if order.pay_method != OrderInfo.PAY_METHODS_ENUM['CASH']}
+    if deadlines:
+        conn = get_redis_connection('default')
+        conn.zadd(ORDER_DEADLINE_KEY, **deadlines)
+
+
+def cancel_expiry(order_id):
+    '''订单已经支付，不再需要超时取消'''
+    conn = get_redis_connection('default')
+    conn.zrem(ORDER_DEADLINE_KEY, order_id)
+
+
+def _claim_due(conn, now):
+    '''取出一批已经到期的订单id，处理完成之前留在队列中'''
+    ids = conn.register_script(CLAIM_DUE_SCRIPT)(keys=[ORDER_DEADLINE_KEY],
+                                                 args=[now, ORDER_EXPIRE_BATCH, now + ORDER_EXPIRE_CLAIM_TIMEOUT])
+    return [int(order_id) for order_id in ids]
+
+
+def _cancel_orders(order_ids):
+    '''在一个事务中取消仍未支付的订单，归还库存，返回(取消的订单id列表, 销量[(种类id, 商品id, -数目), ...])'''
+    with transaction.atomic():
+        # 锁定订单，同时支付成功的订单不会被取消
+        unpaid = list(OrderInfo.objects.select_for_update()
+                      .filter(order_id__in=order_ids, order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+                      .values_list('order_id', flat=True))
+        if not unpaid:
+            return [], []
+
+        # 按商品汇总要归还的数目
+        counts = {}
+        types = {}
+        for sku_id, type_id, count in OrderGoods.objects.filter(order_id__in=unpaid) \
+                .values_list('sku_id', 'sku__type_id', 'count'):
+            counts[sku_id] = counts.get(sku_id, 0) + count
+            types[sku_id] = type_id
+
+        OrderInfo.objects.filter(order_id__in=unpaid).update(order_status=OrderInfo.ORDER_STATUS_ENUM['CANCELED'])
+
+        # 一条update语句增加所有商品的库存，减少销量
+        if counts:
+            decrease_stock({sku_id: -count for sku_id, count in counts.items()})
+
+    return unpaid, [(types[sku_id], sku_id, -count) for sku_id, count in sorted(counts.items())]
+
+
+def expire_orders(now=None):
+    '''取消所有已经到期的未支付订单，返回取消的订单数目'''
+    now = now or time.time()
+    conn = get_redis_connection('default')
+    canceled = 0
+    while True:
+        order_ids = _claim_due(conn, now)
+        if not order_ids:
+            break
+
+        # 取消之前关闭支付宝交易，之后用户不能再支付
+        # 出错时订单留在队列中，推迟的时间之后重新取出
+        from order.payment import close_trades
+        closable, retry = close_trades(order_ids)
+        if retry:
+            conn.zadd(ORDER_DEADLINE_KEY, **{str(order_id): now + ORDER_CLOSE_RETRY for order_id in retry})
+
+        unpaid, sales = _cancel_orders(closable) if closable else ([], [])
+
+        # 事务已经提交，从队列删除，已经支付的订单在确认支付时已经删除
+        retry = set(retry)
+        done = [order_id for order_id in order_ids if order_id not in retry]
+        if done:
+            conn.zrem(ORDER_DEADLINE_KEY, *done)
+
+        canceled += len(unpaid)
+        set_order_status(unpaid, OrderInfo.ORDER_STATUS_ENUM['CANCELED'])
+        if sales:
+            # 减少销量排行，删除商品的缓存，更新添加购物车时使用的库存
+            stock_changed(sales)
+
+    return canceled
+
+
+def backfill_expiry():
+    '''把已经存在的未支付订单加入队列，截止时间从订单的创建时间开始计算，返回加入的订单数目'''
+    orders = OrderInfo.objects.filter(order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']) \
+        .exclude(pay_method=OrderInfo.PAY_METHODS_ENUM['CASH']).values_list('order_id', 'create_time')
+
+    conn = get_redis_connection('default')
+    added = 0
+    deadlines = {}
+    for order_id, create_time in orders.iterator():
+        deadlines[str(order_id)] = create_time.timestamp() + ORDER_PAY_TIMEOUT
+        if len(deadlines) == ORDER_EXPIRE_BATCH:
+            conn.zadd(ORDER_DEADLINE_KEY, **deadlines)
+            added += len(deadlines)
+            deadlines = {}
+    if deadlines:
+        conn.zadd(ORDER_DEADLINE_KEY, **deadlines)
+        added += len(deadlines)
+    return added
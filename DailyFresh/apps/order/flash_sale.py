@@ -0,0 +1,198 @@
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from order.commit import OrderError, new_order_id, read_cart_counts, create_order_batch, orders_created, stock_changed
+from order.tickets import init_ticket, finish_tickets, ticket_key, TICKET_TIMEOUT
+from order.work_queue import claim_batch, ack_batch, requeue_stale, split_created
+from cart.store import user_cart, delete_cart_items
+from utils.cache_tasks import schedule_once
+import json
+
+
+# 秒杀模式
+# 开启秒杀的商品的可售数目保存在redis中 flash_stock: {'sku_id': 剩余数目}
+# 下单时在lua脚本中原子地预扣数目，预扣成功的订单放入结算队列，由celery批量写入数据库
+# 抢不到的请求只访问redis，不访问数据库
+# 开启秒杀时从商品的库存中划出可售数目，数据库中的库存在结算时才减少
+# 结算时先把订单移到处理中的集合，结算完成之后才删除，worker异常退出时订单不会丢失(order.work_queue)
+# 重新结算的失败订单不能重复归还预扣的数目，归还时在订单的凭据中标记released，只归还一次
+
+# 开启秒杀的商品的剩余数目
+FLASH_STOCK_KEY = 'flash_stock'
+# 等待结算的订单
+FLASH_QUEUE_KEY = 'flash_orders'
+# 是否已经发出了结算任务
+FLASH_SCHEDULED_KEY = 'flash_settle_scheduled'
+# 发出结算任务之前等待的时间，期间的订单合并为一批结算
+FLASH_SETTLE_DEBOUNCE = 1
+# 每批结算的订单数目
+FLASH_SETTLE_BATCH = 200
+
+# 预扣秒杀商品的数目
+# 返回: 1 预扣成功 0 数目不足 -1 没有秒杀商品 -2 秒杀商品和普通商品一起下单
+# KEYS[1]: 秒杀商品的剩余数目 KEYS[2]: 结算队列
+# ARGV[1]: 订单数据 ARGV[2...]: 商品id1, 数目1, 商品id2, 数目2, ...
+FLASH_RESERVE_SCRIPT = '''
+local flash = 0
+for i = 2, #ARGV, 2 do
+    flash = flash + redis.call('hexists', KEYS[1], ARGV[i])
+end
+if flash == 0 then
+    return -1
+end
+if flash * 2 ~= #ARGV - 1 then
+    return -2
+end
+for i = 2, #ARGV, 2 do
+    if tonumber(redis.call('hget', KEYS[1], ARGV[i])) < tonumber(ARGV[i + 1]) then
+        return 0
+    end
+end
+for i = 2, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+end
+redis.call('rpush', KEYS[2], ARGV[1])
+return 1
+'''
+
+# 归还结算失败的订单预扣的数目，已经归还过的订单不再归还，秒杀已经结束的商品不再归还
+# KEYS[1]: 订单的凭据 KEYS[2]: 秒杀商品的剩余数目
+# ARGV[1]: 凭据的保存时间 ARGV[2...]: 商品id1, 数目1, 商品id2, 数目2, ...
+FLASH_RELEASE_SCRIPT = '''
+if redis.call('hsetnx', KEYS[1], 'released', 1) == 0 then
+    return 0
+end
+redis.call('expire', KEYS[1], ARGV[1])
+for i = 2, #ARGV, 2 do
+    if redis.call('hexists', KEYS[2], ARGV[i]) == 1 then
+        redis.call('hincrby', KEYS[2], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+'''
+
+
+def start_flash_sale(sku_id, stock):
+    '''开启商品的秒杀，可售数目不超过商品的库存'''
+    sku = GoodsSKU.objects.get(id=sku_id)
+    stock = min(stock, sku.stock)
+    conn = get_redis_connection('default')
+    conn.hset(FLASH_STOCK_KEY, sku.id, stock)
+    return stock
+
+
+def stop_flash_sale(sku_id):
+    '''结束商品的秒杀，已经预扣成功的订单继续结算，返回剩余的数目'''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.hget(FLASH_STOCK_KEY, int(sku_id))
+    pipe.hdel(FLASH_STOCK_KEY, int(sku_id))
+    stock, _ = pipe.execute()
+    return int(stock) if stock is not None else None
+
+
+def flash_sales():
+    '''正在秒杀的商品和剩余数目，{sku_id: 数目}'''
+    conn = get_redis_connection('default')
+    return {int(sku_id): int(stock) for sku_id, stock in conn.hgetall(FLASH_STOCK_KEY).items()}
+
+
+def _release(requests):
+    '''订单结算失败，归还预扣的数目，requests: [订单数据, ...]'''
+    if not requests:
+        return
+    conn = get_redis_connection('default')
+    script = conn.register_script(FLASH_RELEASE_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for data in requests:
+        args = [TICKET_TIMEOUT]
+        for sku_id, count in sorted(data['counts'].items()):
+            args.extend([sku_id, count])
+        script(keys=[ticket_key(data['order_id']), FLASH_STOCK_KEY], args=args, client=pipe)
+    pipe.execute()
+
+
+def reserve_flash_order(user, addr_id, pay_method, sku_ids):
+    '''
+    秒杀商品下单: 预扣数目之后放入结算队列，返回订单id
+    订单中没有秒杀商品时返回None，按照普通订单创建
+    数目不足时抛出OrderError
+    '''
+    cart = user_cart(user.id)
+    counts = read_cart_counts(cart, sku_ids)
+    sku_ids = sorted(counts)
+
+    order_id = new_order_id()
+    data = {'order_id': order_id,
+            'user_id': user.id,
+            'addr_id': int(addr_id),
+            'pay_method': int(pay_method),
+            'counts': counts}
+    args = [json.dumps(data)]
+    for sku_id in sku_ids:
+        args.extend([sku_id, counts[sku_id]])
+
+    conn = get_redis_connection('default')
+    res = conn.register_script(FLASH_RESERVE_SCRIPT)(keys=[FLASH_STOCK_KEY, FLASH_QUEUE_KEY], args=args)
+    if res == -1:
+        return None
+    if res == -2:
+        raise OrderError(8, '秒杀商品需要单独下单')
+    if res == 0:
+        raise OrderError(6, '商品库存不足')
+
+    # 抢购成功，记录等待结算的订单，删除购物车中的对应记录，发出结算任务
+    pipe = conn.pipeline()
+    init_ticket(pipe, order_id, user.id)
+    pipe.execute()
+    delete_cart_items(cart, sku_ids)
+    schedule_flash_settle()
+    return order_id
+
+
+def schedule_flash_settle():
+    '''发出结算任务，短时间内的订单合并为一批结算'''
+    schedule_once(FLASH_SCHEDULED_KEY, FLASH_SETTLE_DEBOUNCE * 30, 'settle_flash_orders',
+                  countdown=FLASH_SETTLE_DEBOUNCE)
+
+
+def recover_flash_orders():
+    '''把结算中途worker退出而没有完成的订单放回结算队列，重新发出结算任务'''
+    conn = get_redis_connection('default')
+    count = requeue_stale(conn, FLASH_QUEUE_KEY)
+    if count:
+        schedule_flash_settle()
+    return count
+
+
+def settle_flash_orders():
+    '''把结算队列中的订单批量写入数据库，返回结算成功的订单数目'''
+    # 之后的订单会发出新的结算任务
+    cache.delete(FLASH_SCHEDULED_KEY)
+
+    conn = get_redis_connection('default')
+    settled = 0
+    while True:
+        batch = claim_batch(conn, FLASH_QUEUE_KEY, FLASH_SETTLE_BATCH)
+        if not batch:
+            break
+
+        # 重新结算的订单中已经写入数据库的不再创建
+        requests, created = split_created([data for item, data in batch])
+
+        # 地址错误、库存不足的订单不结算，归还预扣的数目
+        orders, lines, failures, sales = create_order_batch(requests)
+        orders_created(orders, lines)
+
+        _release([data for data in requests if data['order_id'] in failures])
+        finish_tickets([order.order_id for order in orders] + created, failures)
+        settled += len(orders)
+
+        if sales:
+            stock_changed(sales)
+
+        # 结算完成，从处理中的集合删除
+        ack_batch(conn, FLASH_QUEUE_KEY, batch)
+
+    return settled
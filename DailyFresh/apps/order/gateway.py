@@ -0,0 +1,169 @@
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+from alipay import AliPay
+from datetime import datetime
+import requests
+import threading
+import os
+
+
+# 支付网关
+# 每个进程只创建一个网关对象，密钥在创建时读取解析一次，之后的签名和验签直接使用
+# 查询接口的http请求使用连接池，和网关之间保持长连接，不需要每次都建立tls连接
+# 通过settings.PAYMENT_GATEWAY选择网关的实现，本地开发和压测时可以使用StubGateway连接本地的stub网关
+
+# 每个进程和网关之间保持的连接数目，不少于uwsgi每个进程的线程数
+HTTP_POOL_SIZE = 4
+# 请求网关的超时时间(秒)
+HTTP_TIMEOUT = 15
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+class PaymentGateway(object):
+    '''支付网关的接口'''
+
+    def __init__(self, options):
+        self.appid = str(options['APPID'])
+        self.url = options['URL']
+        self._session = None
+        self._session_pid = None
+
+    def session(self):
+        '''当前进程的http连接池，uwsgi在fork之前创建的连接不能在子进程中使用'''
+        if self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._session_pid = os.getpid()
+        return self._session
+
+    def page_pay_url(self, order_id, total_amount, subject, time_expire):
+        '''电脑网站支付的页面地址，time_expire: 交易关闭的时间戳，之后不能再支付'''
+        raise NotImplementedError
+
+    def query(self, order_id):
+        '''
+        查询交易，返回交易查询接口的结果
+        {'code': '10000', 'trade_status': 'TRADE_SUCCESS', 'trade_no': '支付宝交易号', ...}
+        '''
+        raise NotImplementedError
+
+    def close(self, order_id):
+        '''
+        关闭等待支付的交易，返回交易关闭接口的结果
+        交易不存在时sub_code为ACQ.TRADE_NOT_EXIST，已经支付时为ACQ.TRADE_STATUS_ERROR
+        '''
+        raise NotImplementedError
+
+    def refund(self, order_id, refund_amount):
+        '''全额退款，返回退款接口的结果，同一个订单重复调用只退款一次'''
+        raise NotImplementedError
+
+    def verify(self, data, signature):
+        '''校验异步通知的签名，data中不包含sign'''
+        raise NotImplementedError
+
+
+class AlipayGateway(PaymentGateway):
+    '''支付宝'''
+
+    def __init__(self, options):
+        super(AlipayGateway, self).__init__(options)
+        self.alipay = AliPay(
+            appid=self.appid,  # 应用APPID
+            app_notify_url=settings.ALIPAY_NOTIFY_URL,  # 默认回调url
+            app_private_key_path=os.path.join(settings.BASE_DIR, 'apps/order/app_private_key.pem'),  # 私钥文件的路径
+            alipay_public_key_path=os.path.join(settings.BASE_DIR, 'apps/order/alipay_public_key.pem'),
+            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
+            sign_type="RSA2",  # RSA 或者 RSA2
+            debug=True  # 默认False,代表真实环境
+        )
+        # AliPay在第一次使用密钥时才读取解析，这里提前加载，之后的请求不再读取文件
+        self.alipay.app_private_key
+        self.alipay.alipay_public_key
+
+    def page_pay_url(self, order_id, total_amount, subject, time_expire):
+        order_string = self.alipay.api_alipay_trade_page_pay(
+            out_trade_no=order_id,  # 订单id
+            total_amount=str(total_amount),  # 订单总金额
+            subject=subject,  # 订单标题
+            return_url=None,
+            notify_url=None,  # 可选, 不填则使用默认notify url
+            # 交易的绝对超时时间(北京时间，精确到分钟)，向前取整，不会晚于time_expire
+            time_expire=timezone.localtime(datetime.fromtimestamp(time_expire, timezone.utc)).strftime('%Y-%m-%d %H:%M')
+        )
+        return self.url + '?' + order_string
+
+    def _call(self, method, biz_content):
+        '''使用连接池调用接口，返回校验签名之后的结果'''
+        data = self.alipay.build_body(method, biz_content)
+        response = self.session().get(self.url + '?' + self.alipay.sign_data(data), timeout=HTTP_TIMEOUT)
+        return self.alipay._verify_and_return_sync_response(response.content.decode('utf-8'),
+                                                            method.replace('.', '_') + '_response')
+
+    def query(self, order_id):
+        # 和AliPay.api_alipay_trade_query相同，只是使用连接池发送请求
+        return self._call('alipay.trade.query', {'out_trade_no': str(order_id)})
+
+    def close(self, order_id):
+        return self._call('alipay.trade.close', {'out_trade_no': str(order_id)})
+
+    def refund(self, order_id, refund_amount):
+        # out_request_no相同的退款请求只退款一次
+        return self._call('alipay.trade.refund', {'out_trade_no': str(order_id), 'refund_amount': str(refund_amount),
+                                                  'out_request_no': str(order_id)})
+
+    def verify(self, data, signature):
+        return self.alipay.verify(data, signature)
+
+
+class StubGateway(PaymentGateway):
+    '''本地的stub网关(manage.py payment_stub)，不签名，通知的签名为stub'''
+
+    SIGNATURE = 'stub'
+
+    def page_pay_url(self, order_id, total_amount, subject, time_expire):
+        request = requests.Request('GET', self.url.rstrip('/') + '/pay',
+                                   params={'out_trade_no': order_id, 'total_amount': str(total_amount),
+                                           'app_id': self.appid, 'notify_url': settings.ALIPAY_NOTIFY_URL,
+                                           'time_expire': int(time_expire)})
+        return request.prepare().url
+
+    def _call(self, method, params):
+        params = dict(params, method=method)
+        response = self.session().get(self.url.rstrip('/') + '/gateway.do', params=params, timeout=HTTP_TIMEOUT)
+        return response.json()[method.replace('.', '_') + '_response']
+
+    def query(self, order_id):
+        return self._call('alipay.trade.query', {'out_trade_no': order_id})
+
+    def close(self, order_id):
+        return self._call('alipay.trade.close', {'out_trade_no': order_id})
+
+    def refund(self, order_id, refund_amount):
+        return self._call('alipay.trade.refund', {'out_trade_no': order_id, 'refund_amount': str(refund_amount)})
+
+    def verify(self, data, signature):
+        return signature == self.SIGNATURE
+
+
+def create_gateway(options=None):
+    '''根据配置创建网关'''
+    options = options or settings.PAYMENT_GATEWAY
+    return import_string(options['BACKEND'])(options)
+
+
+def get_gateway():
+    '''当前进程的网关，第一次调用时创建'''
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = create_gateway()
+    return _gateway
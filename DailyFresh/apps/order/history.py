@@ -0,0 +1,66 @@
+from django.core.cache import cache
+from django.db.models import F, Prefetch, ExpressionWrapper, DecimalField
+
+from order.models import OrderInfo, OrderGoods
+from utils.cache_tasks import incr_version
+from utils.pagination import keyset_page
+
+
+# 用户订单页的分页
+# 先分页再查询: 只查询当前页的订单和这些订单的订单商品，一共两条语句，小计和实付款由数据库计算
+# 访问过的页的游标根据(user, create_time, order_id)索引按需生成并缓存，翻页时不需要OFFSET扫描
+# 用户创建了新的订单时增加该用户的版本号，使缓存的订单数目和游标失效
+
+# 每页显示的订单数目
+ORDER_PER_PAGE = 1
+
+# 排序方式: 按照创建时间降序，创建时间相同时按照订单id降序
+ORDER_HISTORY_ORDERING = (('create_time', True), ('order_id', True))
+
+# 缓存的过期时间，缓存通过版本号失效
+ORDER_CURSORS_TIMEOUT = 3600
+
+
+def history_version_key(user_id):
+    '''用户订单版本号的缓存名称'''
+    return 'order_history_version_%d' % user_id
+
+
+def expire_order_history(user_ids):
+    '''使用户的订单数目和游标的缓存失效'''
+    for user_id in user_ids:
+        incr_version(history_version_key(user_id))
+
+
+def get_order_page(user_id, page):
+    '''获取用户订单第page页的内容，每个订单带有订单商品order_skus、实付款total_amount和状态名称status_name'''
+    # 订单数目和生成的游标按照版本号缓存
+    version = cache.get(history_version_key(user_id), 0)
+    count_key = 'order_count_%d_%d' % (user_id, version)
+    cursors_key = 'order_cursors_%d_%d' % (user_id, version)
+    values = cache.get_many([count_key, cursors_key])
+    count = values.get(count_key)
+    if count is None:
+        count = OrderInfo.objects.filter(user=user_id).count()
+        cache.set(count_key, count, ORDER_CURSORS_TIMEOUT)
+    cursors = values.get(cursors_key, {})
+
+    # 订单商品的小计
+    order_skus = OrderGoods.objects.select_related('sku').order_by('id').annotate(
+        amount=ExpressionWrapper(F('count') * F('price'), output_field=DecimalField(max_digits=10, decimal_places=2)))
+
+    # 订单的实付款
+    queryset = OrderInfo.objects.filter(user=user_id).annotate(
+        total_amount=ExpressionWrapper(F('total_price') + F('transit_price'),
+                                       output_field=DecimalField(max_digits=10, decimal_places=2))
+    ).prefetch_related(Prefetch('ordergoods_set', queryset=order_skus, to_attr='order_skus'))
+
+    known = len(cursors)
+    order_page = keyset_page(queryset, ORDER_HISTORY_ORDERING, cursors, count, ORDER_PER_PAGE, page)
+    if len(cursors) != known:
+        cache.set(cursors_key, cursors, ORDER_CURSORS_TIMEOUT)
+    for order in order_page:
+        # 获取订单状态的名称
+        order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
+
+    return order_page
@@ -0,0 +1,162 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+
+from goods.models import GoodsType, Goods, GoodsSKU
+from order.models import OrderInfo, OrderGoods
+from order.commit import create_order, new_order_id, OrderError, TRANSIT_PRICE
+from user.models import User, Address
+from cart.store import user_cart, update_cart_items
+import random
+import threading
+import time
+
+
+# 压测数据的名称前缀，结束之后删除
+BENCH_PREFIX = 'bench_order'
+
+
+def legacy_commit(user, addr, sku_ids, counts, order_id, stats):
+    '''原来的下单方式: 逐个商品查询、读取购物车、乐观锁减少库存(最多重试3次)、添加订单商品'''
+    conn = get_redis_connection('default')
+    cart = user_cart(user.id)
+    with transaction.atomic():
+        order = OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=3,
+                                         total_count=0, total_price=0, transit_price=TRANSIT_PRICE)
+        total_count = 0
+        total_price = 0
+        for sku_id in sku_ids:
+            for i in range(3):
+                sku = GoodsSKU.objects.get(id=sku_id)
+                count = int(conn.hget(cart.key, sku_id) or counts[sku_id])
+                res = GoodsSKU.objects.filter(id=sku_id, stock=sku.stock).update(stock=sku.stock - count,
+                                                                                sales=sku.sales + count)
+                if res == 0:
+                    stats['retries'] += 1
+                    if i == 2:
+                        raise OrderError(7, '订单错误2')
+                    continue
+
+                OrderGoods.objects.create(order=order, sku=sku, count=count, price=sku.price)
+                total_count += count
+                total_price += sku.price * count
+                break
+
+        order.total_count = total_count
+        order.total_price = total_price
+        order.save()
+
+
+def batch_commit(user, addr, sku_ids, counts, order_id, stats):
+    '''批量下单: 一次读取购物车，按照id的顺序锁定商品，一条update减少库存，bulk_create添加订单商品'''
+    update_cart_items(user_cart(user.id), counts.items())
+    create_order(user, addr, 3, sku_ids, order_id=order_id)
+
+
+class Command(BaseCommand):
+    help = '模拟多个用户同时购买少数几个商品，比较逐个商品乐观锁下单和批量下单的重试次数、语句数目和耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='同时下单的用户数目')
+        parser.add_argument('--orders', type=int, default=20, help='每个用户下单的次数')
+        parser.add_argument('--skus', type=int, default=10, help='商品数目，越少冲突越多')
+        parser.add_argument('--lines', type=int, default=5, help='每个订单中的商品数目')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        users, addrs, skus = self.setup(options)
+        try:
+            for name, commit in (('逐个商品乐观锁', legacy_commit), ('批量下单', batch_commit)):
+                stats = self.run(commit, users, addrs, skus, options)
+                self.report(name, stats)
+        finally:
+            self.cleanup(users, skus)
+
+    def setup(self, options):
+        '''创建压测用的用户、地址和商品，商品不上线'''
+        type = GoodsType.objects.create(name=BENCH_PREFIX, logo=BENCH_PREFIX, image='type/%s.jpg' % BENCH_PREFIX)
+        goods = Goods.objects.create(name=BENCH_PREFIX)
+        GoodsSKU.objects.bulk_create([
+            GoodsSKU(type=type, goods=goods, name='%s_%d' % (BENCH_PREFIX, i), desc='', price=1, unite='个',
+                     image='goods/%s.jpg' % BENCH_PREFIX, stock=10 ** 8, sales=0, status=0)
+            for i in range(options['skus'])])
+        skus = list(GoodsSKU.objects.filter(goods=goods).order_by('id'))
+
+        users = []
+        addrs = []
+        for i in range(options['users']):
+            user = User.objects.create_user('%s_%d' % (BENCH_PREFIX, i), '%s_%d@example.com' % (BENCH_PREFIX, i), BENCH_PREFIX)
+            users.append(user)
+            addrs.append(Address.objects.create(user=user, receiver=BENCH_PREFIX, addr=BENCH_PREFIX, phone='1' * 11))
+        return users, addrs, skus
+
+    def cleanup(self, users, skus):
+        '''删除压测数据'''
+        conn = get_redis_connection('default')
+        for user in users:
+            cart = user_cart(user.id)
+            conn.delete(cart.key, cart.summary_key)
+
+        OrderGoods.objects.filter(sku__in=skus).delete()
+        OrderInfo.objects.filter(user__in=users).delete()
+        Address.objects.filter(user__in=users).delete()
+        User.objects.filter(id__in=[user.id for user in users]).delete()
+        type_id, goods_id = skus[0].type_id, skus[0].goods_id
+        GoodsSKU.objects.filter(id__in=[sku.id for sku in skus]).delete()
+        Goods.objects.filter(id=goods_id).delete()
+        GoodsType.objects.filter(id=type_id).delete()
+
+    def run(self, commit, users, addrs, skus, options):
+        '''每个用户一个线程，同时下单'''
+        stats = {'orders': 0, 'failures': 0, 'retries': 0, 'statements': 0, 'timings': []}
+        lock = threading.Lock()
+        lines = min(options['lines'], len(skus))
+
+        def worker(n):
+            rnd = random.Random(options['seed'] + n)
+            user_stats = {'retries': 0}
+            try:
+                for i in range(options['orders']):
+                    sku_ids = [sku.id for sku in rnd.sample(skus, lines)]
+                    counts = {sku_id: rnd.randint(1, 3) for sku_id in sku_ids}
+                    order_id = new_order_id()
+
+                    failed = False
+                    with CaptureQueriesContext(connection) as queries:
+                        start = time.perf_counter()
+                        try:
+                            commit(users[n], addrs[n], sku_ids, counts, order_id, user_stats)
+                        except OrderError:
+                            failed = True
+                        elapsed = time.perf_counter() - start
+
+                    with lock:
+                        stats['orders'] += 1
+                        stats['failures'] += failed
+                        stats['statements'] += len(queries)
+                        stats['timings'].append(elapsed)
+            finally:
+                with lock:
+                    stats['retries'] += user_stats['retries']
+                # 每个线程使用自己的数据库连接
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(len(users))]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats['elapsed'] = time.time() - start
+        return stats
+
+    def report(self, name, stats):
+        '''输出压测结果'''
+        timings = sorted(stats['timings'])
+        count = len(timings) or 1
+        avg = sum(timings) / count
+        p99 = timings[int(len(timings) * 0.99) - 1] if timings else 0
+        self.stdout.write('%s: %d个订单，失败%d个，重试%d次，平均每个订单%.1f条语句，耗时平均%.1f毫秒 p99 %.1f毫秒，%.1f单/秒' % (
+            name, stats['orders'], stats['failures'], stats['retries'], stats['statements'] / count,
+            avg * 1000, p99 * 1000, stats['orders'] / stats['elapsed'] if stats['elapsed'] else 0))
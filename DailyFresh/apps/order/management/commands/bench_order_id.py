@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from utils.snowflake import Snowflake
+from multiprocessing import Pool
+from array import array
+import time
+
+
+def generate(args):
+    '''在子进程中使用指定的worker id生成count个id，返回(id数组, 耗时, 是否单调递增)'''
+    worker_id, count = args
+    snowflake = Snowflake(worker_id)
+    next_id = snowflake.next_id
+
+    start = time.perf_counter()
+    ids = [next_id() for i in range(count)]
+    elapsed = time.perf_counter() - start
+
+    ids = array('q', ids)
+    monotonic = all(ids[i] < ids[i + 1] for i in range(len(ids) - 1))
+    return ids, elapsed, monotonic
+
+
+class Command(BaseCommand):
+    help = '多个进程同时生成订单id，测试生成速度并检查是否重复'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='进程数，每个进程使用不同的worker id')
+        parser.add_argument('--count', type=int, default=1000000, help='每个进程生成的id数目')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        pool = Pool(processes)
+        try:
+            results = pool.map(generate, [(worker_id, options['count']) for worker_id in range(processes)])
+        finally:
+            pool.close()
+            pool.join()
+
+        seen = set()
+        total = 0
+        rate = 0
+        for worker_id, (ids, elapsed, monotonic) in enumerate(results):
+            total += len(ids)
+            seen.update(ids)
+            rate += len(ids) / elapsed if elapsed else 0
+            self.stdout.write('worker %d: %d个id，%.0f个/秒，%s' % (
+                worker_id, len(ids), len(ids) / elapsed if elapsed else 0, '单调递增' if monotonic else '不是单调递增'))
+
+        self.stdout.write('共%d个id，合计%.0f个/秒，重复%d个' % (total, rate, total - len(seen)))
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from order.gateway import AlipayGateway, StubGateway
+from order.stub_gateway import start_stub_gateway
+from decimal import Decimal
+import time
+
+
+class Command(BaseCommand):
+    help = '离线比较每次请求创建支付宝接口和进程中复用网关时，发起支付和查询支付结果的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='每种方式的请求数目')
+        parser.add_argument('--url', default=None, help='stub网关的地址，默认在当前进程中启动一个')
+        parser.add_argument('--delay', type=float, default=0, help='当前进程中启动的stub网关每个请求的处理时间(毫秒)')
+
+    def timeit(self, label, func, count):
+        begin = time.time()
+        for i in range(count):
+            func(i)
+        elapsed = (time.time() - begin) / count * 1000
+        self.stdout.write('%-36s %8.3f ms/请求' % (label, elapsed))
+        return elapsed
+
+    def handle(self, *args, **options):
+        count = options['requests']
+
+        # 发起支付: 生成签名的支付页面地址
+        # 原来每次请求都创建AliPay，重新读取解析两个密钥文件
+        alipay_options = dict(settings.PAYMENT_GATEWAY, BACKEND='order.gateway.AlipayGateway')
+        shared = AlipayGateway(alipay_options)
+        amount = Decimal('15.00')
+        time_expire = time.time() + 1800
+        legacy = self.timeit('pay   每次创建(读取解析密钥)',
+                             lambda i: AlipayGateway(alipay_options).page_pay_url(i, amount, '天天生鲜%d' % i, time_expire), count)
+        reused = self.timeit('pay   复用网关',
+                             lambda i: shared.page_pay_url(i, amount, '天天生鲜%d' % i, time_expire), count)
+        self.stdout.write('pay   加速: %.1fx' % (legacy / reused))
+
+        # 查询支付结果: 在stub网关上比较每次新建连接和连接池长连接
+        server = None
+        url = options['url']
+        if url is None:
+            server = start_stub_gateway(delay=options['delay'] / 1000.0, auto_pay=True)
+            url = 'http://%s:%d' % server.server_address
+        stub_options = {'BACKEND': 'order.gateway.StubGateway', 'APPID': shared.appid, 'URL': url}
+        stub = StubGateway(stub_options)
+        legacy = self.timeit('check 每次新建连接', lambda i: StubGateway(stub_options).query(i), count)
+        reused = self.timeit('check 连接池长连接', lambda i: stub.query(i), count)
+        self.stdout.write('check 加速: %.1fx' % (legacy / reused))
+
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from order.expiry import expire_orders, backfill_expiry
+
+
+class Command(BaseCommand):
+    help = '取消超时未支付的订单，归还库存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true',
+                            help='先把已经存在的未支付订单加入队列，上线时执行一次')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self.stdout.write('加入队列的订单: %d' % backfill_expiry())
+        self.stdout.write('取消的订单: %d' % expire_orders())
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from goods.models import GoodsSKU
+from order.flash_sale import start_flash_sale, stop_flash_sale, flash_sales
+
+
+class Command(BaseCommand):
+    help = '开启、结束秒杀，查看正在秒杀的商品'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'stop', 'list'], help='start: 开启 stop: 结束 list: 查看')
+        parser.add_argument('sku_id', type=int, nargs='?', help='商品id')
+        parser.add_argument('--stock', type=int, default=None, help='秒杀的数目，默认为商品的全部库存')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'list':
+            for sku_id, stock in sorted(flash_sales().items()):
+                self.stdout.write('商品%d: 剩余%d' % (sku_id, stock))
+            return
+
+        sku_id = options['sku_id']
+        if sku_id is None:
+            raise CommandError('需要指定商品id')
+
+        if action == 'start':
+            try:
+                stock = start_flash_sale(sku_id, options['stock'] if options['stock'] is not None else float('inf'))
+            except GoodsSKU.DoesNotExist:
+                raise CommandError('商品%d不存在' % sku_id)
+            self.stdout.write('商品%d开始秒杀，可售%d' % (sku_id, stock))
+        else:
+            stock = stop_flash_sale(sku_id)
+            if stock is None:
+                raise CommandError('商品%d没有在秒杀' % sku_id)
+            self.stdout.write('商品%d结束秒杀，剩余%d' % (sku_id, stock))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from order.stub_gateway import StubGatewayServer
+
+
+class Command(BaseCommand):
+    help = '启动本地的stub支付网关，PAYMENT_GATEWAY使用order.gateway.StubGateway时连接该网关'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='监听的地址')
+        parser.add_argument('--port', type=int, default=8090, help='监听的端口')
+        parser.add_argument('--delay', type=float, default=0, help='每个请求的处理时间(毫秒)，模拟网关的延迟')
+        parser.add_argument('--auto-pay', action='store_true', help='查询时所有交易都返回支付成功')
+
+    def handle(self, *args, **options):
+        server = StubGatewayServer((options['host'], options['port']), delay=options['delay'] / 1000.0,
+                                   auto_pay=options['auto_pay'])
+        self.stdout.write('stub网关: http://%s:%d/gateway.do' % server.server_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
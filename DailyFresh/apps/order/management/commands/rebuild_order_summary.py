@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from order.models import OrderInfo
+from order.summary import build_user_summary
+
+
+class Command(BaseCommand):
+    help = '根据数据库重新生成用户订单的读模型'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='只生成指定用户的读模型，可以指定多次')
+
+    def handle(self, *args, **options):
+        user_ids = options['users'] or \
+            OrderInfo.objects.order_by('user_id').values_list('user_id', flat=True).distinct()
+        users = 0
+        orders = 0
+        for user_id in user_ids:
+            orders += build_user_summary(user_id)
+            users += 1
+        self.stdout.write('用户: %d 订单: %d' % (users, orders))
@@ -1,5 +1,6 @@
 from django.db import models
 from db.base_model import BaseModel
+from utils.snowflake import display_id
 
 
 # Create your models here.
@@ -24,7 +25,8 @@ class OrderInfo(BaseModel):
         "UNSEND": 2,
         "UNRECEIVED": 3,
         "UNCOMMENT": 4,
-        "FINISHED": 5
+        "FINISHED": 5,
+        "CANCELED": 6
     }
 
     PAY_METHOD_CHOICES = (
@@ -39,7 +41,8 @@ class OrderInfo(BaseModel):
         2: '待发货',
         3: '待收货',
         4: '待评价',
-        5: '已完成'
+        5: '已完成',
+        6: '已取消'
     }
 
     ORDER_STATUS_CHOICES = (
@@ -47,10 +50,12 @@ class OrderInfo(BaseModel):
         (2, '待发货'),
         (3, '待收货'),
         (4, '待评价'),
-        (5, '已完成')
+        (5, '已完成'),
+        (6, '已取消')
     )
 
-    order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单id')
+    # snowflake风格的id，按照生成时间递增
+    order_id = models.BigIntegerField(primary_key=True, verbose_name='订单id')
     user = models.ForeignKey('user.User', verbose_name='用户')
     addr = models.ForeignKey('user.Address', verbose_name='地址')
     pay_method = models.SmallIntegerField(choices=PAY_METHOD_CHOICES, default=3, verbose_name='支付方式')
@@ -64,6 +69,15 @@ class OrderInfo(BaseModel):
         db_table = 'df_order_info'
         verbose_name = '订单'
         verbose_name_plural = verbose_name
+        # 用户订单页按照创建时间分页使用的覆盖索引
+        index_together = [
+            ('user', 'create_time', 'order_id'),
+        ]
+
+    @property
+    def order_no(self):
+        '''页面上展示的订单号'''
+        return display_id(self.order_id)
 
 
 class OrderGoods(BaseModel):
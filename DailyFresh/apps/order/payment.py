@@ -0,0 +1,249 @@
+from django_redis import get_redis_connection
+
+from order.models import OrderInfo
+from order.expiry import cancel_expiry, ORDER_PAY_TIMEOUT
+from order.gateway import get_gateway
+from order.summary import set_order_status
+from decimal import Decimal, InvalidOperation
+
+
+# 支付结果的确认
+# 支付宝异步通知(/order/notify)和celery的轮询任务都可以确认支付结果，先到的一方修改订单状态
+# 轮询任务的间隔按指数增长，订单取消或者支付完成之后不再查询
+# 浏览器查询支付结果时只读取redis中的支付状态，不访问支付宝和数据库
+# order_pay_订单id: {'user_id': 用户id, 'status': 支付状态, 'polling': 是否已经发出了轮询任务}
+# 支付宝交易的关闭时间早于订单的取消时间，取消订单之前先关闭交易，取消之后用户不能再支付
+# 已经取消的订单仍然收到了支付时全额退款，退款失败时记录下来，通知返回failure等待支付宝重试
+
+# 支付状态的保存时间
+PAY_STATUS_TIMEOUT = ORDER_PAY_TIMEOUT * 2
+
+# 支付宝交易的关闭时间比订单的取消时间提前的秒数
+PAY_EXPIRE_MARGIN = 2 * 60
+# 交易关闭之前至少要留给用户支付的时间(秒)，不足时不再发起支付
+PAY_MIN_TIME = 60
+
+# 支付状态
+PAY_WAITING = 'waiting'
+PAY_SUCCESS = 'paid'
+PAY_FAILED = 'failed'
+PAY_REFUNDED = 'refunded'
+
+# 已经取消的订单收到了支付，退款失败等待处理 {订单id: 支付宝交易号}
+PAID_CANCELED_KEY = 'order_paid_canceled'
+
+# 第一次轮询之前等待的时间(秒)，之后每次加倍
+POLL_FIRST_DELAY = 5
+# 轮询的最大间隔(秒)
+POLL_MAX_DELAY = 300
+
+# 支付宝的交易状态，交易查询接口返回code为10000时有效，code为40004表示交易还未创建
+TRADE_PAID = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+TRADE_WAITING = ('WAIT_BUYER_PAY',)
+
+
+def pay_status_key(order_id):
+    return 'order_pay_%d' % int(order_id)
+
+
+def order_amount(order):
+    '''订单的支付金额'''
+    return order.total_price + order.transit_price
+
+
+def trade_expire_time(order):
+    '''订单的支付宝交易关闭的时间戳'''
+    return order.create_time.timestamp() + ORDER_PAY_TIMEOUT - PAY_EXPIRE_MARGIN
+
+
+def start_payment(order):
+    '''用户发起支付，记录等待支付的状态，第一次发起时开始轮询支付结果'''
+    key = pay_status_key(order.order_id)
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.hset(key, 'user_id', order.user_id)
+    pipe.hset(key, 'status', PAY_WAITING)
+    pipe.hsetnx(key, 'polling', 1)
+    pipe.expire(key, PAY_STATUS_TIMEOUT)
+    polling = pipe.execute()[2]
+
+    if polling:
+        schedule_payment_poll(order.order_id)
+
+
+def schedule_payment_poll(order_id):
+    '''发出轮询支付结果的任务'''
+    from celery_tasks.tasks import poll_payment
+    poll_payment.apply_async((order_id, 0), countdown=POLL_FIRST_DELAY)
+
+
+def set_pay_status(order_id, status):
+    key = pay_status_key(order_id)
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.hset(key, 'status', status)
+    pipe.expire(key, PAY_STATUS_TIMEOUT)
+    pipe.execute()
+
+
+def get_pay_status(order_id, user_id):
+    '''获取用户的订单的支付状态，没有发起过支付或者订单不属于该用户时返回None'''
+    conn = get_redis_connection('default')
+    user, status = conn.hmget(pay_status_key(order_id), ['user_id', 'status'])
+    if user is None or status is None or int(user) != user_id:
+        return None
+    return status.decode()
+
+
+def confirm_payment(order_id, trade_no):
+    '''支付成功，修改订单的状态，返回这次支付是否已经处理完成，已经取消的订单退款失败时返回False'''
+    # 只修改等待支付的订单，通知和轮询同时到达时只有一方修改成功
+    updated = OrderInfo.objects.filter(order_id=order_id,
+                                       order_status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']) \
+        .update(order_status=4, trade_no=trade_no)  # 待评价
+
+    if updated:
+        # 不再需要超时取消
+        cancel_expiry(order_id)
+        set_pay_status(order_id, PAY_SUCCESS)
+        set_order_status([order_id], 4)
+        return True
+
+    order = OrderInfo.objects.filter(order_id=order_id).first()
+    if order is not None and order.order_status == OrderInfo.ORDER_STATUS_ENUM['CANCELED'] \
+            and order.trade_no != trade_no:
+        # 订单已经超时取消、归还了库存，支付的款项退回给用户
+        return refund_canceled_payment(order, trade_no)
+
+    # 重复的通知
+    return True
+
+
+def refund_canceled_payment(order, trade_no):
+    '''已经取消的订单收到了支付，全额退款，返回是否退款成功，失败时记录下来'''
+    conn = get_redis_connection('default')
+    try:
+        refunded = get_gateway().refund(order.order_id, order_amount(order)).get('code') == '10000'
+    except Exception:
+        refunded = False
+
+    if not refunded:
+        conn.hset(PAID_CANCELED_KEY, order.order_id, trade_no)
+        return False
+
+    # 记录交易号，重复的通知不再退款
+    OrderInfo.objects.filter(order_id=order.order_id).update(trade_no=trade_no)
+    conn.hdel(PAID_CANCELED_KEY, order.order_id)
+    set_pay_status(order.order_id, PAY_REFUNDED)
+    return True
+
+
+def close_trades(order_ids):
+    '''
+    超时取消订单之前关闭已经发起支付的交易，返回(可以取消的订单id, 稍后重试的订单id)
+    交易已经支付的订单确认支付结果，不取消；网关出错时不取消，稍后重试
+    '''
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    for order_id in order_ids:
+        pipe.exists(pay_status_key(order_id))
+    started = pipe.execute()
+
+    closable = []
+    retry = []
+    gateway = get_gateway() if any(started) else None
+    for order_id, exists in zip(order_ids, started):
+        if not exists:
+            # 没有发起过支付
+            closable.append(order_id)
+            continue
+
+        try:
+            response = gateway.close(order_id)
+            if response.get('code') == '10000' or response.get('sub_code') == 'ACQ.TRADE_NOT_EXIST':
+                closable.append(order_id)
+                continue
+            # 交易已经支付或者已经关闭
+            response = gateway.query(order_id)
+        except Exception:
+            retry.append(order_id)
+            continue
+
+        trade_status = response.get('trade_status') if response.get('code') == '10000' else None
+        if trade_status in TRADE_PAID:
+            confirm_payment(order_id, response.get('trade_no'))
+        elif trade_status == 'TRADE_CLOSED':
+            closable.append(order_id)
+        else:
+            retry.append(order_id)
+    return closable, retry
+
+
+def verify_notify(data):
+    '''
+    校验支付宝的异步通知，data: 通知的参数
+    签名、应用id、订单金额都正确时返回(订单id, 支付宝交易号, 交易状态)，否则返回None
+    '''
+    data = dict(data)
+    signature = data.pop('sign', None)
+    if not signature:
+        return None
+
+    gateway = get_gateway()
+    try:
+        if not gateway.verify(data, signature):
+            return None
+    except Exception:
+        return None
+
+    if data.get('app_id') != gateway.appid:
+        return None
+
+    try:
+        order = OrderInfo.objects.get(order_id=data.get('out_trade_no'))
+        amount = Decimal(data.get('total_amount'))
+    except (OrderInfo.DoesNotExist, ValueError, TypeError, InvalidOperation):
+        return None
+    if amount != order_amount(order):
+        return None
+
+    return order.order_id, data.get('trade_no', ''), data.get('trade_status')
+
+
+def poll_delay(attempt):
+    '''第attempt次轮询之后等待的时间'''
+    return min(POLL_FIRST_DELAY * 2 ** (attempt + 1), POLL_MAX_DELAY)
+
+
+def poll_payment(order_id, attempt):
+    '''查询一次支付结果，还需要继续查询时返回下次查询之前等待的时间，否则返回None'''
+    order_status = OrderInfo.objects.filter(order_id=order_id).values_list('order_status', flat=True).first()
+    if order_status != OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+        # 订单已经支付或者已经取消
+        if order_status == OrderInfo.ORDER_STATUS_ENUM['CANCELED']:
+            set_pay_status(order_id, PAY_FAILED)
+        return None
+
+    try:
+        response = get_gateway().query(order_id)
+    except Exception:
+        # 网络错误，稍后重试
+        return poll_delay(attempt)
+
+    code = response.get('code')
+    trade_status = response.get('trade_status')
+    if code == '10000' and trade_status in TRADE_PAID:
+        if not confirm_payment(order_id, response.get('trade_no')):
+            # 已经取消的订单退款失败，稍后重试
+            return poll_delay(attempt)
+        return None
+
+    if code == '40004' or (code == '10000' and trade_status in TRADE_WAITING):
+        # 支付交易还未创建或者等待买家付款
+        return poll_delay(attempt)
+
+    # 交易关闭，用户可以重新发起支付
+    set_pay_status(order_id, PAY_FAILED)
+    conn = get_redis_connection('default')
+    conn.hdel(pay_status_key(order_id), 'polling')
+    return None
@@ -0,0 +1,160 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+import itertools
+import json
+import threading
+import time
+
+
+# 本地的stub支付网关，用于离线开发和压测支付、查询的延迟，不连接支付宝
+# GET /gateway.do?method=alipay.trade.query&out_trade_no=订单id  交易查询，返回和支付宝相同结构的json
+# GET /gateway.do?method=alipay.trade.close&out_trade_no=订单id  关闭交易，之后不能再支付
+# GET /gateway.do?method=alipay.trade.refund&out_trade_no=订单id&refund_amount=金额  全额退款
+# GET /pay?out_trade_no=订单id&total_amount=金额&notify_url=通知地址&time_expire=时间戳
+#     模拟用户支付成功，向网站发送异步通知，交易已经关闭或者超过time_expire时不能支付
+# 请求使用HTTP/1.1，支持长连接
+
+# 支付宝交易号的序号
+_trade_nos = itertools.count(1)
+
+
+class StubGatewayServer(ThreadingMixIn, HTTPServer):
+    '''stub网关，trades: {订单id: (交易状态, 支付宝交易号, 金额)}'''
+    daemon_threads = True
+
+    def __init__(self, address, delay=0, auto_pay=False, quiet=False):
+        HTTPServer.__init__(self, address, StubGatewayHandler)
+        # 每个请求的处理时间(秒)，模拟网关的延迟
+        self.delay = delay
+        # 查询时所有交易都返回支付成功
+        self.auto_pay = auto_pay
+        # 不输出每个请求的日志
+        self.quiet = quiet
+        self.trades = {}
+        self.lock = threading.Lock()
+
+    def pay(self, out_trade_no, total_amount):
+        '''支付交易，交易已经关闭时返回None'''
+        with self.lock:
+            trade = self.trades.get(out_trade_no)
+            if trade is not None and trade[0] == 'TRADE_CLOSED':
+                return None
+            trade = ('TRADE_SUCCESS', '%s%012d' % (time.strftime('%Y%m%d'), next(_trade_nos)), total_amount)
+            self.trades[out_trade_no] = trade
+        return trade
+
+    def close(self, out_trade_no):
+        '''关闭交易，返回关闭之前的交易'''
+        with self.lock:
+            trade = self.trades.get(out_trade_no)
+            if trade is None or trade[0] == 'WAIT_BUYER_PAY':
+                self.trades[out_trade_no] = ('TRADE_CLOSED', trade[1] if trade else '', trade[2] if trade else '')
+            return trade
+
+    def refund(self, out_trade_no):
+        '''全额退款，交易关闭，返回退款之前的交易'''
+        with self.lock:
+            trade = self.trades.get(out_trade_no)
+            if trade is not None and trade[0] == 'TRADE_SUCCESS':
+                self.trades[out_trade_no] = ('TRADE_CLOSED', trade[1], trade[2])
+            return trade
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分开写入，长连接上需要关闭nagle算法，否则每个请求都要等待延迟确认
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        method = params.get('method')
+        if url.path == '/gateway.do' and method in self.METHODS:
+            response = getattr(self, self.METHODS[method])(params.get('out_trade_no'))
+            self.reply(json.dumps({method.replace('.', '_') + '_response': response, 'sign': ''}),
+                       'application/json')
+        elif url.path == '/pay' and params.get('out_trade_no'):
+            if self.pay(params):
+                self.reply('支付成功', 'text/plain')
+            else:
+                self.reply('交易已关闭', 'text/plain')
+        else:
+            self.send_error(404)
+
+    # 网关接口对应的处理方法
+    METHODS = {'alipay.trade.query': 'query', 'alipay.trade.close': 'close', 'alipay.trade.refund': 'refund'}
+
+    def query(self, out_trade_no):
+        trade = self.server.trades.get(out_trade_no)
+        if trade is None and self.server.auto_pay:
+            trade = self.server.pay(out_trade_no, '0.00')
+        if trade is None:
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+
+        trade_status, trade_no, total_amount = trade
+        return {'code': '10000', 'msg': 'Success', 'out_trade_no': out_trade_no, 'trade_no': trade_no,
+                'trade_status': trade_status, 'total_amount': total_amount}
+
+    def close(self, out_trade_no):
+        trade = self.server.close(out_trade_no)
+        if trade is None:
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+        if trade[0] != 'WAIT_BUYER_PAY':
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_STATUS_ERROR'}
+        return {'code': '10000', 'msg': 'Success', 'out_trade_no': out_trade_no, 'trade_no': trade[1]}
+
+    def refund(self, out_trade_no):
+        trade = self.server.refund(out_trade_no)
+        if trade is None:
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+        if trade[0] != 'TRADE_SUCCESS':
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_STATUS_ERROR'}
+        return {'code': '10000', 'msg': 'Success', 'out_trade_no': out_trade_no, 'trade_no': trade[1],
+                'refund_fee': trade[2]}
+
+    def pay(self, params):
+        '''用户支付，超过time_expire或者交易已经关闭时返回False'''
+        if params.get('time_expire') and time.time() > int(params['time_expire']):
+            self.server.close(params['out_trade_no'])
+            return False
+        trade = self.server.pay(params['out_trade_no'], params.get('total_amount', ''))
+        if trade is None:
+            return False
+
+        trade_status, trade_no, total_amount = trade
+        notify_url = params.get('notify_url')
+        if notify_url:
+            # 向网站发送异步通知，签名为stub
+            data = {'app_id': params.get('app_id', ''), 'out_trade_no': params['out_trade_no'],
+                    'trade_no': trade_no, 'trade_status': trade_status, 'total_amount': total_amount,
+                    'sign': 'stub'}
+            try:
+                urlopen(notify_url, urlencode(data).encode(), timeout=5).read()
+            except Exception as e:
+                self.log_message('notify failed: %s', e)
+        return True
+
+    def reply(self, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', '%s; charset=utf-8' % content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def start_stub_gateway(host='127.0.0.1', port=0, delay=0, auto_pay=False, quiet=True):
+    '''在后台线程中启动stub网关，返回server，server.server_address是实际监听的地址'''
+    server = StubGatewayServer((host, port), delay=delay, auto_pay=auto_pay, quiet=quiet)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
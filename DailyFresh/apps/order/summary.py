@@ -0,0 +1,264 @@
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from goods.models import GoodsSKU
+from order.models import OrderInfo, OrderGoods
+from order.history import ORDER_PER_PAGE
+from utils.pagination import KeysetPage
+from utils.cache_tasks import schedule_once
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+import json
+
+
+# 用户订单的读模型
+# 用户订单页和页面头部的待支付订单数目只访问redis，一次往返获取一页订单和各种状态的订单数目
+# user_orders_用户id: 有序集合 {订单id: 创建时间}
+# order_summary_订单id: {'user_id', 'status', 'create_time', 'total_count', 'total_price', 'transit_price',
+#                        'line_count': 订单商品的数目, 'lines': 前几个订单商品的json}
+# user_order_counts_用户id: {'built': 1, 状态: 订单数目}
+# 订单创建、支付、取消、评论时更新读模型，只更新已经生成过或者正在生成读模型的用户
+# 用户的读模型还没有生成时从数据库查询，同时发出生成该用户读模型的任务，也可以用rebuild_order_summary一次全部生成
+# 生成时先在用户的订单数目中标记building，再WATCH用户的订单数目、查询数据库
+# 生成期间的增量更新都会修改用户的订单数目，使写入读模型的事务失败，重新查询数据库生成
+# 读模型设置了过期时间，即使有遗漏的更新，过期之后也会重新生成
+
+# 每个订单保存的订单商品的数目
+ORDER_SUMMARY_LINES = 3
+# 生成读模型的任务的间隔，避免同一个用户的请求重复发出任务
+SUMMARY_BUILD_DEBOUNCE = 60
+# 生成期间有订单变化时重试的次数
+SUMMARY_BUILD_RETRIES = 5
+# 读模型的过期时间(秒)
+SUMMARY_TIMEOUT = 7 * 24 * 3600
+
+# 添加一个订单，用户的读模型不存在或者订单已经存在时不添加
+# KEYS[1]: 用户的订单数目 KEYS[2]: 用户的订单 KEYS[3]: 订单摘要
+# ARGV[1]: 订单id ARGV[2]: 创建时间 ARGV[3]: 订单状态 ARGV[4...]: 订单摘要的字段1, 值1, ...
+SUMMARY_ADD_SCRIPT = '''
+if redis.call('exists', KEYS[1]) == 0 or redis.call('zscore', KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+redis.call('hmset', KEYS[3], unpack(ARGV, 4))
+redis.call('hincrby', KEYS[1], ARGV[3], 1)
+return 1
+'''
+
+# 修改订单的状态，同时修改用户各种状态的订单数目
+# 用户的订单数目的名称根据订单摘要中的用户id生成
+# KEYS[1]: 订单摘要 ARGV[1]: 新的状态
+SUMMARY_STATUS_SCRIPT = '''
+local user_id, status = unpack(redis.call('hmget', KEYS[1], 'user_id', 'status'))
+if not status or status == ARGV[1] then
+    return 0
+end
+local counts = 'user_order_counts_' .. user_id
+redis.call('hset', KEYS[1], 'status', ARGV[1])
+redis.call('hincrby', counts, status, -1)
+redis.call('hincrby', counts, ARGV[1], 1)
+return 1
+'''
+
+# 获取用户各种状态的订单数目、订单总数和一页订单的摘要，用户的读模型还没有生成完成或者订单摘要已经过期时返回空
+# 订单摘要的名称根据订单id生成
+# KEYS[1]: 用户的订单数目 KEYS[2]: 用户的订单 ARGV[1]: 开始位置 ARGV[2]: 结束位置
+SUMMARY_PAGE_SCRIPT = '''
+if redis.call('hexists', KEYS[1], 'built') == 0 then
+    return {}
+end
+local result = {redis.call('hgetall', KEYS[1]), redis.call('zcard', KEYS[2])}
+for _, order_id in ipairs(redis.call('zrevrange', KEYS[2], ARGV[1], ARGV[2])) do
+    local fields = redis.call('hgetall', 'order_summary_' .. order_id)
+    if #fields == 0 then
+        return {}
+    end
+    table.insert(result, {order_id, fields})
+end
+return result
+'''
+
+# 用户的订单数目中不是订单状态的字段
+COUNTS_FLAGS = ('built', 'building')
+
+# 订单摘要中的订单商品
+SummaryLine = namedtuple('SummaryLine', ['sku', 'count', 'price', 'amount'])
+
+
+def user_orders_key(user_id):
+    return 'user_orders_%d' % user_id
+
+
+def user_counts_key(user_id):
+    return 'user_order_counts_%d' % user_id
+
+
+def summary_key(order_id):
+    return 'order_summary_%d' % order_id
+
+
+def _summary_fields(order, lines):
+    '''订单摘要的字段，lines: 订单的所有订单商品'''
+    return {'user_id': order.user_id,
+            'status': order.order_status,
+            'create_time': order.create_time.timestamp(),
+            'total_count': order.total_count,
+            'total_price': str(order.total_price),
+            'transit_price': str(order.transit_price),
+            'line_count': len(lines),
+            'lines': json.dumps([[line.sku.id, line.sku.name, line.sku.unite, line.sku.image.name,
+                                  str(line.price), line.count] for line in lines[:ORDER_SUMMARY_LINES]])}
+
+
+def add_orders(orders, lines):
+    '''把新创建的订单加入用户的读模型，lines: 这些订单的订单商品，带有sku'''
+    order_lines = {}
+    for line in lines:
+        order_lines.setdefault(line.order_id, []).append(line)
+
+    conn = get_redis_connection('default')
+    script = conn.register_script(SUMMARY_ADD_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for order in orders:
+        fields = _summary_fields(order, order_lines.get(order.order_id, []))
+        args = [order.order_id, fields['create_time'], order.order_status]
+        for field, value in fields.items():
+            args.extend([field, value])
+        script(keys=[user_counts_key(order.user_id), user_orders_key(order.user_id), summary_key(order.order_id)],
+               args=args, client=pipe)
+        # 没有添加时订单摘要不存在，不会设置
+        pipe.expire(summary_key(order.order_id), SUMMARY_TIMEOUT)
+    pipe.execute()
+
+
+def set_order_status(order_ids, status):
+    '''修改读模型中订单的状态'''
+    if not order_ids:
+        return
+
+    conn = get_redis_connection('default')
+    script = conn.register_script(SUMMARY_STATUS_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for order_id in order_ids:
+        script(keys=[summary_key(order_id)], args=[status], client=pipe)
+    pipe.execute()
+
+
+def _load_orders(user_id):
+    '''从数据库查询用户的订单和订单商品'''
+    orders = list(OrderInfo.objects.filter(user=user_id))
+    order_lines = {}
+    for line in OrderGoods.objects.filter(order__user=user_id).select_related('sku').order_by('id'):
+        order_lines.setdefault(line.order_id, []).append(line)
+    return orders, order_lines
+
+
+def build_user_summary(user_id):
+    '''根据数据库生成用户的读模型，返回订单数目，一直有订单变化而没有生成时返回None'''
+    conn = get_redis_connection('default')
+    counts_key = user_counts_key(user_id)
+
+    # 标记正在生成，之后的增量更新都会修改用户的订单数目
+    pipe = conn.pipeline()
+    pipe.hset(counts_key, 'building', 1)
+    pipe.hexists(counts_key, 'built')
+    built = pipe.execute()[1]
+    if not built:
+        # 生成失败时标记自动删除
+        conn.expire(counts_key, SUMMARY_BUILD_DEBOUNCE)
+
+    for i in range(SUMMARY_BUILD_RETRIES):
+        with conn.pipeline() as pipe:
+            try:
+                # 查询数据库之后用户的订单数目有变化时事务失败
+                pipe.watch(counts_key)
+                orders, order_lines = _load_orders(user_id)
+
+                # 在一个事务中替换，读取的一方不会看到一半的数据
+                pipe.multi()
+                pipe.delete(user_orders_key(user_id), counts_key)
+                counts = {'built': 1}
+                scores = {}
+                for order in orders:
+                    fields = _summary_fields(order, order_lines.get(order.order_id, []))
+                    pipe.delete(summary_key(order.order_id))
+                    pipe.hmset(summary_key(order.order_id), fields)
+                    pipe.expire(summary_key(order.order_id), SUMMARY_TIMEOUT)
+                    scores[str(order.order_id)] = fields['create_time']
+                    counts[order.order_status] = counts.get(order.order_status, 0) + 1
+                if scores:
+                    pipe.zadd(user_orders_key(user_id), **scores)
+                    pipe.expire(user_orders_key(user_id), SUMMARY_TIMEOUT)
+                pipe.hmset(counts_key, counts)
+                pipe.expire(counts_key, SUMMARY_TIMEOUT)
+                pipe.execute()
+                return len(orders)
+            except WatchError:
+                # 生成期间有订单变化，重新查询
+                continue
+    return None
+
+
+def schedule_build_user_summary(user_id):
+    '''发出生成用户读模型的任务'''
+    schedule_once('order_summary_building_%d' % user_id, SUMMARY_BUILD_DEBOUNCE, 'build_order_summary', (user_id,))
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _pairs(items):
+    '''hgetall的结果转换为字典'''
+    items = [_decode(item) for item in items]
+    return dict(zip(items[::2], items[1::2]))
+
+
+def _order_from_summary(order_id, fields):
+    '''订单摘要转换为订单对象，提供订单页模板中用到的属性'''
+    order = OrderInfo(order_id=order_id,
+                      user_id=int(fields['user_id']),
+                      order_status=int(fields['status']),
+                      total_count=int(fields['total_count']),
+                      total_price=Decimal(fields['total_price']),
+                      transit_price=Decimal(fields['transit_price']))
+    order.create_time = datetime.fromtimestamp(float(fields['create_time']), timezone.utc)
+    order.total_amount = order.total_price + order.transit_price
+    order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
+
+    order.order_skus = []
+    for sku_id, name, unite, image, price, count in json.loads(fields['lines']):
+        sku = GoodsSKU(id=sku_id, name=name, unite=unite, image=image)
+        price = Decimal(price)
+        order.order_skus.append(SummaryLine(sku, count, price, price * count))
+    # 没有显示的订单商品的数目
+    order.more_lines = int(fields['line_count']) - len(order.order_skus)
+    return order
+
+
+def get_summary_page(user_id, page):
+    '''
+    从读模型获取用户订单第page页的内容和各种状态的订单数目
+    返回(订单页, {状态: 订单数目})，用户的读模型不存在时返回(None, None)
+    '''
+    if page <= 0:
+        page = 1
+    start = (page - 1) * ORDER_PER_PAGE
+
+    conn = get_redis_connection('default')
+    script = conn.register_script(SUMMARY_PAGE_SCRIPT)
+    result = script(keys=[user_counts_key(user_id), user_orders_key(user_id)], args=[start, start + ORDER_PER_PAGE - 1])
+    if not result:
+        return None, None
+
+    counts = {status: int(count) for status, count in _pairs(result[0]).items() if status not in COUNTS_FLAGS}
+    total = result[1]
+    num_pages = max(1, (total + ORDER_PER_PAGE - 1) // ORDER_PER_PAGE)
+    if page > num_pages:
+        # 默认获取第1页的内容
+        return get_summary_page(user_id, 1)
+
+    orders = [_order_from_summary(int(order_id), _pairs(fields)) for order_id, fields in result[2:] if fields]
+    return KeysetPage(orders, page, num_pages), counts
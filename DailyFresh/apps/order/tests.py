@@ -1,3 +1,654 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.db import DatabaseError
+from django_redis import get_redis_connection
+
+from goods.models import GoodsType, Goods, GoodsSKU
+from user.models import User, Address
+from order.models import OrderInfo, OrderGoods
+from order import commit
+from order.commit import create_order, create_order_batch, read_cart_counts, new_order_id, OrderError
+from order.flash_sale import start_flash_sale, stop_flash_sale, reserve_flash_order, settle_flash_orders, \
+    recover_flash_orders, flash_sales, FLASH_QUEUE_KEY
+from order.work_queue import processing_key, QUEUE_CLAIM_TIMEOUT
+from order.async_commit import enqueue_order, process_order_requests, recover_order_requests, ORDER_QUEUE_KEY
+from order.tickets import get_ticket, ticket_key
+from order.expiry import expire_orders, ORDER_PAY_TIMEOUT, ORDER_EXPIRE_CLAIM_TIMEOUT
+from order.history import get_order_page
+from order import summary
+from order.summary import build_user_summary, set_order_status, get_summary_page, user_orders_key, \
+    user_counts_key, summary_key
+from order.gateway import PaymentGateway, StubGateway
+from order.stub_gateway import start_stub_gateway
+from order.payment import start_payment, poll_payment, pay_status_key, POLL_FIRST_DELAY, PAID_CANCELED_KEY
+from cart.store import user_cart, update_cart_items
+from utils.snowflake import Snowflake, display_id, id_time, acquire_worker_id, renew_worker_id, uwsgi_worker_id, \
+    WORKER_BITS, SEQUENCE_BITS, WORKER_LEASE_KEY, LEASE_PROCESS_FLAG
+from decimal import Decimal
+from unittest import mock
+import json
+import time
 
 # Create your tests here.
+
+
+class OrderTestCase(TestCase):
+    '''创建测试用的商品、用户和地址'''
+
+    def setUp(self):
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type/fruit.jpg')
+        goods = Goods.objects.create(name='苹果')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='苹果%d' % i, desc='', price=Decimal('2.50'),
+                                             unite='500g', image='sku/%d.jpg' % i, stock=5, sales=0, status=1)
+                     for i in range(3)]
+
+        self.user = User.objects.create_user('ordertest', 'ordertest@example.com', 'ordertest')
+        self.addr = Address.objects.create(user=self.user, receiver='张三', addr='北京', phone='13800000000')
+
+        self.cart = user_cart(self.user.id)
+        conn = get_redis_connection('default')
+        conn.delete(self.cart.key, self.cart.summary_key)
+        self.addCleanup(conn.delete, self.cart.key, self.cart.summary_key)
+
+
+class CreateOrderTest(OrderTestCase):
+    '''订单创建的测试'''
+
+    def test_create_order(self):
+        '''批量减少库存、增加销量，一次写入订单的总件数和总价格，删除购物车记录'''
+        update_cart_items(self.cart, [(self.skus[0].id, 2), (self.skus[1].id, 3)])
+
+        order = create_order(self.user, self.addr, 3, [self.skus[1].id, self.skus[0].id])
+
+        order = OrderInfo.objects.get(order_id=order.order_id)
+        self.assertEqual(order.total_count, 5)
+        self.assertEqual(order.total_price, Decimal('12.50'))
+        self.assertEqual(sorted(OrderGoods.objects.filter(order=order).values_list('sku_id', 'count')),
+                         [(self.skus[0].id, 2), (self.skus[1].id, 3)])
+
+        stocks = dict(GoodsSKU.objects.values_list('id', 'stock'))
+        self.assertEqual([stocks[sku.id] for sku in self.skus], [3, 2, 5])
+        self.assertEqual(GoodsSKU.objects.get(id=self.skus[1].id).sales, 3)
+        self.assertFalse(get_redis_connection('default').exists(self.cart.key))
+
+    def test_understock_rolls_back(self):
+        '''有一个商品库存不足时不修改任何商品的库存'''
+        update_cart_items(self.cart, [(self.skus[0].id, 2), (self.skus[1].id, 6)])
+
+        with self.assertRaises(OrderError) as cm:
+            create_order(self.user, self.addr, 3, [self.skus[0].id, self.skus[1].id])
+
+        self.assertEqual(cm.exception.res, 6)
+        self.assertEqual(GoodsSKU.objects.get(id=self.skus[0].id).stock, 5)
+        self.assertFalse(OrderInfo.objects.filter(user=self.user).exists())
+
+    def test_not_in_cart(self):
+        '''商品不在购物车中'''
+        with self.assertRaises(OrderError) as cm:
+            create_order(self.user, self.addr, 3, [self.skus[0].id])
+        self.assertEqual(cm.exception.res, 4)
+
+    def test_redis_error_after_commit(self):
+        '''订单提交之后更新redis失败时订单仍然创建成功，其他的更新照常执行'''
+        update_cart_items(self.cart, [(self.skus[0].id, 2)])
+        with mock.patch('order.commit.add_orders', side_effect=ConnectionError), \
+                mock.patch('order.commit.schedule_static_index_html') as schedule:
+            order = create_order(self.user, self.addr, 3, [self.skus[0].id])
+        self.assertTrue(OrderInfo.objects.filter(order_id=order.order_id).exists())
+        self.assertFalse(get_redis_connection('default').exists(self.cart.key))
+        self.assertTrue(schedule.called)
+
+    def test_batch_fallback(self):
+        '''批量创建因为数据库错误失败时逐个创建'''
+        update_cart_items(self.cart, [(self.skus[0].id, 1)])
+        counts = read_cart_counts(self.cart, [self.skus[0].id])
+        requests = [{'order_id': order_id, 'user_id': self.user.id, 'addr_id': self.addr.id, 'pay_method': 3,
+                     'counts': counts} for order_id in (new_order_id(), new_order_id())]
+        create_orders = commit.create_orders
+
+        def fail_batch(batch):
+            if len(batch) > 1:
+                raise DatabaseError
+            return create_orders(batch)
+
+        with mock.patch('order.commit.create_orders', side_effect=fail_batch):
+            orders, lines, failures, sales = create_order_batch(requests)
+        self.assertEqual(len(orders), 2)
+        self.assertEqual(failures, {})
+        self.assertEqual(GoodsSKU.objects.get(id=self.skus[0].id).stock, 3)
+
+
+class FlashSaleTest(OrderTestCase):
+    '''秒杀模式的测试'''
+
+    def setUp(self):
+        super(FlashSaleTest, self).setUp()
+        self.flash = self.skus[0]
+        start_flash_sale(self.flash.id, 3)
+        self.addCleanup(stop_flash_sale, self.flash.id)
+        conn = get_redis_connection('default')
+        conn.delete(FLASH_QUEUE_KEY, processing_key(FLASH_QUEUE_KEY))
+        self.addCleanup(conn.delete, FLASH_QUEUE_KEY, processing_key(FLASH_QUEUE_KEY))
+
+        patcher = mock.patch('order.flash_sale.schedule_flash_settle')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reserve_and_settle(self):
+        '''预扣成功之后结算写入数据库，数目不足时不访问数据库'''
+        update_cart_items(self.cart, [(self.flash.id, 2)])
+        with self.assertNumQueries(0):
+            order_id = reserve_flash_order(self.user, self.addr.id, 3, [self.flash.id])
+
+        update_cart_items(self.cart, [(self.flash.id, 2)])
+        with self.assertNumQueries(0):
+            with self.assertRaises(OrderError) as cm:
+                reserve_flash_order(self.user, self.addr.id, 3, [self.flash.id])
+        self.assertEqual(cm.exception.res, 6)
+
+        self.assertEqual(settle_flash_orders(), 1)
+        order = OrderInfo.objects.get(order_id=order_id)
+        self.assertEqual(order.total_count, 2)
+        self.assertEqual(GoodsSKU.objects.get(id=self.flash.id).stock, 3)
+
+    def test_recover_after_crash(self):
+        '''结算中途worker退出时订单不会丢失，重新结算时已经创建的订单不再创建'''
+        update_cart_items(self.cart, [(self.flash.id, 2)])
+        order_id = reserve_flash_order(self.user, self.addr.id, 3, [self.flash.id])
+        self.addCleanup(get_redis_connection('default').delete, ticket_key(order_id))
+
+        # 写入数据库之前退出
+        with mock.patch('order.flash_sale.create_order_batch', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                settle_flash_orders()
+        # 还没有超时，不放回队列
+        self.assertEqual(recover_flash_orders(), 0)
+        self.assertEqual(settle_flash_orders(), 0)
+
+        later = time.time() + QUEUE_CLAIM_TIMEOUT + 1
+        with mock.patch('order.work_queue.time.time', return_value=later):
+            self.assertEqual(recover_flash_orders(), 1)
+
+        # 写入数据库之后、确认之前退出
+        with mock.patch('order.flash_sale.ack_batch', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                settle_flash_orders()
+        with mock.patch('order.work_queue.time.time', return_value=later + QUEUE_CLAIM_TIMEOUT + 1):
+            self.assertEqual(recover_flash_orders(), 1)
+        self.assertEqual(settle_flash_orders(), 0)
+
+        self.assertEqual(OrderInfo.objects.filter(order_id=order_id).count(), 1)
+        self.assertEqual(get_ticket(order_id, self.user.id)['status'], 'success')
+        self.assertEqual(GoodsSKU.objects.get(id=self.flash.id).stock, 3)
+        self.assertEqual(flash_sales()[self.flash.id], 1)
+
+    def test_release_once(self):
+        '''结算失败的订单重新结算时只归还一次预扣的数目'''
+        update_cart_items(self.cart, [(self.flash.id, 2)])
+        order_id = reserve_flash_order(self.user, self.addr.id + 1000, 3, [self.flash.id])
+        self.addCleanup(get_redis_connection('default').delete, ticket_key(order_id))
+        self.assertEqual(flash_sales()[self.flash.id], 1)
+
+        # 归还之后、确认之前退出
+        with mock.patch('order.flash_sale.ack_batch', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                settle_flash_orders()
+        self.assertEqual(flash_sales()[self.flash.id], 3)
+
+        with mock.patch('order.work_queue.time.time', return_value=time.time() + QUEUE_CLAIM_TIMEOUT + 1):
+            self.assertEqual(recover_flash_orders(), 1)
+        self.assertEqual(settle_flash_orders(), 0)
+        self.assertEqual(flash_sales()[self.flash.id], 3)
+        self.assertEqual(get_ticket(order_id, self.user.id)['res'], '2')
+
+    def test_normal_order(self):
+        '''没有秒杀商品时按照普通订单创建，秒杀商品不能和普通商品一起下单'''
+        update_cart_items(self.cart, [(self.flash.id, 1), (self.skus[1].id, 1)])
+        self.assertIsNone(reserve_flash_order(self.user, self.addr.id, 3, [self.skus[1].id]))
+
+        with self.assertRaises(OrderError) as cm:
+            reserve_flash_order(self.user, self.addr.id, 3, [self.flash.id, self.skus[1].id])
+        self.assertEqual(cm.exception.res, 8)
+
+
+class AsyncCommitTest(OrderTestCase):
+    '''异步下单的测试'''
+
+    def setUp(self):
+        super(AsyncCommitTest, self).setUp()
+        conn = get_redis_connection('default')
+        conn.delete(ORDER_QUEUE_KEY, processing_key(ORDER_QUEUE_KEY))
+        self.addCleanup(conn.delete, ORDER_QUEUE_KEY, processing_key(ORDER_QUEUE_KEY))
+
+        patcher = mock.patch('order.async_commit.schedule_order_process')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enqueue(self, counts, addr_id=None):
+        update_cart_items(self.cart, counts)
+        with self.assertNumQueries(0):
+            ticket = enqueue_order(self.user, addr_id or self.addr.id, 3, [sku_id for sku_id, count in counts])
+        self.addCleanup(get_redis_connection('default').delete, ticket_key(ticket))
+        self.assertEqual(get_ticket(ticket, self.user.id)['status'], 'pending')
+        return ticket
+
+    def test_process_batch(self):
+        '''一批订单按照先后顺序分配库存，库存不足、地址错误的订单失败，不影响其他订单'''
+        first = self.enqueue([(self.skus[0].id, 3), (self.skus[1].id, 1)])
+        second = self.enqueue([(self.skus[0].id, 3)])
+        third = self.enqueue([(self.skus[0].id, 2)])
+        wrong_addr = self.enqueue([(self.skus[1].id, 1)], addr_id=self.addr.id + 100)
+
+        self.assertEqual(process_order_requests(), 2)
+
+        self.assertEqual(get_ticket(first, self.user.id)['status'], 'success')
+        self.assertEqual(get_ticket(third, self.user.id)['status'], 'success')
+        self.assertEqual(get_ticket(second, self.user.id)['res'], '6')
+        self.assertEqual(get_ticket(wrong_addr, self.user.id)['res'], '2')
+        self.assertIsNone(get_ticket(first, self.user.id + 1))
+
+        self.assertEqual(OrderInfo.objects.get(order_id=first).total_count, 4)
+        stocks = dict(GoodsSKU.objects.values_list('id', 'stock'))
+        self.assertEqual([stocks[sku.id] for sku in self.skus], [0, 4, 5])
+
+    def test_recover_after_crash(self):
+        '''处理中途worker退出时下单请求不会丢失，超时之后放回队列重新处理'''
+        ticket = self.enqueue([(self.skus[0].id, 2)])
+
+        with mock.patch('order.async_commit.create_order_batch', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                process_order_requests()
+        self.assertEqual(get_ticket(ticket, self.user.id)['status'], 'pending')
+        self.assertEqual(recover_order_requests(), 0)
+
+        with mock.patch('order.work_queue.time.time', return_value=time.time() + QUEUE_CLAIM_TIMEOUT + 1):
+            self.assertEqual(recover_order_requests(), 1)
+        self.assertEqual(process_order_requests(), 1)
+        self.assertEqual(get_ticket(ticket, self.user.id)['status'], 'success')
+        self.assertEqual(GoodsSKU.objects.get(id=self.skus[0].id).stock, 3)
+
+
+class ExpiryTest(OrderTestCase):
+    '''超时未支付订单的取消的测试'''
+
+    def setUp(self):
+        super(ExpiryTest, self).setUp()
+        # 使用单独的有序集合，不影响其他订单
+        patcher = mock.patch('order.expiry.ORDER_DEADLINE_KEY', 'test_order_pay_deadline')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_redis_connection('default').delete, 'test_order_pay_deadline')
+
+    def create(self, counts, pay_method=3):
+        update_cart_items(self.cart, counts)
+        return create_order(self.user, self.addr, pay_method, [sku_id for sku_id, count in counts])
+
+    def test_expire_unpaid(self):
+        '''只取消到期的未支付订单，按商品归还库存、减少销量'''
+        unpaid = self.create([(self.skus[0].id, 2), (self.skus[1].id, 1)])
+        other = self.create([(self.skus[0].id, 1)])
+        paid = self.create([(self.skus[1].id, 2)])
+        cash = self.create([(self.skus[2].id, 1)], pay_method=1)
+        OrderInfo.objects.filter(order_id=paid.order_id).update(order_status=4)
+
+        # 还没有到期
+        self.assertEqual(expire_orders(), 0)
+
+        self.assertEqual(expire_orders(now=time.time() + ORDER_PAY_TIMEOUT + 1), 2)
+        statuses = dict(OrderInfo.objects.values_list('order_id', 'order_status'))
+        self.assertEqual([statuses[order.order_id] for order in (unpaid, other, paid, cash)], [6, 6, 4, 1])
+
+        skus = {sku.id: sku for sku in GoodsSKU.objects.all()}
+        self.assertEqual([(skus[sku.id].stock, skus[sku.id].sales) for sku in self.skus], [(5, 0), (3, 2), (4, 1)])
+
+        # 已经取出的订单不会再次取消
+        self.assertEqual(expire_orders(now=time.time() + ORDER_PAY_TIMEOUT + 1), 0)
+
+    def test_recover_after_crash(self):
+        '''取出之后、取消之前worker退出时，订单留在队列中，推迟的时间之后重新取消'''
+        order = self.create([(self.skus[0].id, 2)])
+        now = time.time() + ORDER_PAY_TIMEOUT + 1
+        with mock.patch('order.expiry._cancel_orders', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                expire_orders(now=now)
+
+        # 推迟的时间之内不会被其他worker重复取出
+        self.assertEqual(expire_orders(now=now), 0)
+        self.assertEqual(expire_orders(now=now + ORDER_EXPIRE_CLAIM_TIMEOUT + 1), 1)
+        self.assertEqual(OrderInfo.objects.get(order_id=order.order_id).order_status, 6)
+        self.assertEqual(GoodsSKU.objects.get(id=self.skus[0].id).stock, 5)
+        self.assertEqual(get_redis_connection('default').zcard('test_order_pay_deadline'), 0)
+
+
+class OrderHistoryTest(OrderTestCase):
+    '''用户订单页分页的测试'''
+
+    def test_page_queries(self):
+        '''按照创建时间倒序分页，翻页时只查询当前页的订单和订单商品'''
+        orders = []
+        for sku in self.skus:
+            update_cart_items(self.cart, [(sku.id, 2)])
+            orders.append(create_order(self.user, self.addr, 3, [sku.id]))
+
+        # 第一次访问时查询订单数目，记录第1页的游标
+        with self.assertNumQueries(3):
+            order_page = get_order_page(self.user.id, 1)
+        self.assertEqual((order_page.number, order_page.num_pages), (1, 3))
+
+        with self.assertNumQueries(2):
+            order_page = get_order_page(self.user.id, 2)
+            order = list(order_page)[0]
+            self.assertEqual(order.order_id, orders[1].order_id)
+            self.assertEqual([(line.sku.name, line.amount) for line in order.order_skus],
+                             [(self.skus[1].name, Decimal('5.00'))])
+            self.assertEqual(order.total_amount, Decimal('15.00'))
+            self.assertEqual(order.status_name, '待支付')
+
+        # 新的订单使游标失效，直接跳到第3页时只查询一次游标
+        update_cart_items(self.cart, [(self.skus[0].id, 1)])
+        orders.append(create_order(self.user, self.addr, 3, [self.skus[0].id]))
+        with self.assertNumQueries(4):
+            order_page = get_order_page(self.user.id, 3)
+        self.assertEqual(list(order_page)[0].order_id, orders[1].order_id)
+        self.assertEqual(order_page.num_pages, 4)
+
+
+class OrderSummaryTest(OrderTestCase):
+    '''用户订单读模型的测试'''
+
+    def setUp(self):
+        super(OrderSummaryTest, self).setUp()
+        patchers = [mock.patch('order.summary.ORDER_SUMMARY_LINES', 2),
+                    mock.patch('order.expiry.ORDER_DEADLINE_KEY', 'test_order_pay_deadline')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        conn = get_redis_connection('default')
+        self.addCleanup(conn.delete, 'test_order_pay_deadline')
+        self.addCleanup(self.clear)
+
+    def clear(self):
+        conn = get_redis_connection('default')
+        keys = [summary_key(order_id) for order_id in
+                OrderInfo.objects.filter(user=self.user).values_list('order_id', flat=True)]
+        conn.delete(user_orders_key(self.user.id), user_counts_key(self.user.id), *keys)
+
+    def test_not_built(self):
+        '''读模型还没有生成时不添加订单'''
+        update_cart_items(self.cart, [(self.skus[0].id, 1)])
+        create_order(self.user, self.addr, 3, [self.skus[0].id])
+        self.assertEqual(get_summary_page(self.user.id, 1), (None, None))
+
+    def test_summary_page(self):
+        '''创建、支付订单时更新读模型，获取订单页不访问数据库'''
+        update_cart_items(self.cart, [(self.skus[0].id, 2)])
+        first = create_order(self.user, self.addr, 3, [self.skus[0].id])
+        self.assertEqual(build_user_summary(self.user.id), 1)
+
+        update_cart_items(self.cart, [(sku.id, 1) for sku in self.skus])
+        second = create_order(self.user, self.addr, 3, [sku.id for sku in self.skus])
+        OrderInfo.objects.filter(order_id=first.order_id).update(order_status=4)
+        set_order_status([first.order_id], 4)
+
+        with self.assertNumQueries(0):
+            order_page, counts = get_summary_page(self.user.id, 1)
+        self.assertEqual(counts, {'1': 1, '4': 1})
+        self.assertEqual((order_page.number, order_page.num_pages), (1, 2))
+        order = list(order_page)[0]
+        self.assertEqual(order.order_id, second.order_id)
+        self.assertEqual(order.total_amount, Decimal('17.50'))
+        self.assertEqual([(line.sku.name, line.amount) for line in order.order_skus],
+                         [(self.skus[0].name, Decimal('2.50')), (self.skus[1].name, Decimal('2.50'))])
+        self.assertEqual(order.more_lines, 1)
+
+        order = list(get_summary_page(self.user.id, 2)[0])[0]
+        self.assertEqual((order.order_id, order.status_name), (first.order_id, '待评价'))
+
+        # 重新生成的读模型和增量更新的结果相同
+        build_user_summary(self.user.id)
+        self.assertEqual(get_summary_page(self.user.id, 1)[1], {'1': 1, '4': 1})
+
+    def test_order_during_build(self):
+        '''生成期间创建的订单不会被生成的结果覆盖'''
+        update_cart_items(self.cart, [(self.skus[0].id, 1)])
+        create_order(self.user, self.addr, 3, [self.skus[0].id])
+        load_orders = summary._load_orders
+        created = []
+
+        def create_after_load(user_id):
+            # 查询数据库之后、写入读模型之前创建订单
+            result = load_orders(user_id)
+            if not created:
+                update_cart_items(self.cart, [(self.skus[1].id, 1)])
+                created.append(create_order(self.user, self.addr, 3, [self.skus[1].id]))
+            return result
+
+        with mock.patch('order.summary._load_orders', side_effect=create_after_load) as load:
+            self.assertEqual(build_user_summary(self.user.id), 2)
+        self.assertEqual(load.call_count, 2)
+        order_page, counts = get_summary_page(self.user.id, 1)
+        self.assertEqual(counts, {'1': 2})
+        self.assertEqual(order_page.paginator.count, 2)
+
+
+class FakeGateway(PaymentGateway):
+    '''本地的假支付宝，签名为valid时验证通过'''
+
+    def __init__(self):
+        super(FakeGateway, self).__init__({'APPID': '2016090800464004', 'URL': 'http://127.0.0.1/gateway.do'})
+        # {订单id: (交易状态, 支付宝交易号)}
+        self.trades = {}
+        # [(订单id, 退款金额)]
+        self.refunds = []
+        self.refund_fails = False
+
+    def verify(self, data, signature):
+        return signature == 'valid'
+
+    def query(self, order_id):
+        if int(order_id) not in self.trades:
+            return {'code': '40004', 'msg': 'Business Failed'}
+        trade_status, trade_no = self.trades[int(order_id)]
+        return {'code': '10000', 'trade_status': trade_status, 'trade_no': trade_no}
+
+    def close(self, order_id):
+        if int(order_id) not in self.trades:
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+        trade_status, trade_no = self.trades[int(order_id)]
+        if trade_status != 'WAIT_BUYER_PAY':
+            return {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_STATUS_ERROR'}
+        self.trades[int(order_id)] = ('TRADE_CLOSED', trade_no)
+        return {'code': '10000'}
+
+    def refund(self, order_id, refund_amount):
+        self.refunds.append((int(order_id), refund_amount))
+        return {'code': '40004' if self.refund_fails else '10000'}
+
+
+class PaymentTest(OrderTestCase):
+    '''支付结果确认的测试'''
+
+    def setUp(self):
+        super(PaymentTest, self).setUp()
+        self.gateway = FakeGateway()
+        patchers = [mock.patch('order.payment.get_gateway', return_value=self.gateway),
+                    mock.patch('order.payment.schedule_payment_poll'),
+                    mock.patch('order.expiry.ORDER_DEADLINE_KEY', 'test_order_pay_deadline')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(get_redis_connection('default').delete, 'test_order_pay_deadline')
+
+        update_cart_items(self.cart, [(self.skus[0].id, 2)])
+        self.order = create_order(self.user, self.addr, 3, [self.skus[0].id])
+        self.addCleanup(get_redis_connection('default').delete, pay_status_key(self.order.order_id))
+        start_payment(self.order)
+        self.client.login(username='ordertest', password='ordertest')
+
+    def check(self):
+        response = self.client.post('/order/check', {'order_id': self.order.order_id})
+        return json.loads(response.content.decode())['res']
+
+    def test_poll_with_backoff(self):
+        '''等待支付时间隔加倍，支付成功之后修改订单状态，查询支付结果不访问数据库'''
+        self.assertEqual(poll_payment(self.order.order_id, 0), POLL_FIRST_DELAY * 2)
+        self.gateway.trades[self.order.order_id] = ('WAIT_BUYER_PAY', '')
+        self.assertEqual(poll_payment(self.order.order_id, 1), POLL_FIRST_DELAY * 4)
+        self.assertEqual(self.check(), 5)
+
+        self.gateway.trades[self.order.order_id] = ('TRADE_SUCCESS', '2017032121001004070200176844')
+        self.assertIsNone(poll_payment(self.order.order_id, 2))
+
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        self.assertEqual((order.order_status, order.trade_no), (4, '2017032121001004070200176844'))
+        with self.assertNumQueries(1):
+            # session保存在缓存中，只有读取用户的查询
+            self.assertEqual(self.check(), 4)
+
+    def test_notify(self):
+        '''签名和金额都正确的通知才修改订单状态'''
+        data = {'app_id': self.gateway.appid, 'out_trade_no': self.order.order_id, 'trade_no': '123',
+                'trade_status': 'TRADE_SUCCESS', 'total_amount': '15.00', 'sign': 'valid'}
+
+        self.assertEqual(self.client.post('/order/notify', dict(data, sign='forged')).content, b'failure')
+        self.assertEqual(self.client.post('/order/notify', dict(data, total_amount='0.01')).content, b'failure')
+        self.assertEqual(OrderInfo.objects.get(order_id=self.order.order_id).order_status, 1)
+
+        self.assertEqual(self.client.post('/order/notify', data).content, b'success')
+        self.assertEqual(OrderInfo.objects.get(order_id=self.order.order_id).order_status, 4)
+        self.assertEqual(self.check(), 4)
+
+        # 支付之后不再超时取消
+        self.assertEqual(expire_orders(now=time.time() + ORDER_PAY_TIMEOUT + 1), 0)
+
+    def notify(self, trade_no):
+        data = {'app_id': self.gateway.appid, 'out_trade_no': self.order.order_id, 'trade_no': trade_no,
+                'trade_status': 'TRADE_SUCCESS', 'total_amount': '15.00', 'sign': 'valid'}
+        return self.client.post('/order/notify', data).content
+
+    def test_paid_before_cancel(self):
+        '''取消之前交易已经支付，确认支付结果，不取消'''
+        self.gateway.trades[self.order.order_id] = ('TRADE_SUCCESS', '123')
+        self.assertEqual(expire_orders(now=time.time() + ORDER_PAY_TIMEOUT + 1), 0)
+        self.assertEqual(OrderInfo.objects.get(order_id=self.order.order_id).order_status, 4)
+
+    def test_paid_after_cancel(self):
+        '''取消之后收到的支付全额退款，退款失败时通知返回failure，等待支付宝重试'''
+        self.gateway.trades[self.order.order_id] = ('WAIT_BUYER_PAY', '')
+        self.assertEqual(expire_orders(now=time.time() + ORDER_PAY_TIMEOUT + 1), 1)
+        self.assertEqual(self.gateway.trades[self.order.order_id][0], 'TRADE_CLOSED')
+        conn = get_redis_connection('default')
+        self.addCleanup(conn.hdel, PAID_CANCELED_KEY, self.order.order_id)
+
+        self.gateway.refund_fails = True
+        self.assertEqual(self.notify('123'), b'failure')
+        self.assertEqual(conn.hget(PAID_CANCELED_KEY, self.order.order_id), b'123')
+
+        self.gateway.refund_fails = False
+        self.assertEqual(self.notify('123'), b'success')
+        self.assertEqual(self.notify('123'), b'success')
+        self.assertEqual(self.gateway.refunds, [(self.order.order_id, Decimal('15.00'))] * 2)
+        self.assertFalse(conn.hexists(PAID_CANCELED_KEY, self.order.order_id))
+
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        self.assertEqual((order.order_status, order.trade_no), (6, '123'))
+        self.assertEqual(self.check(), 6)
+
+
+class StubGatewayTest(SimpleTestCase):
+    '''本地stub网关的测试'''
+
+    def setUp(self):
+        self.server = start_stub_gateway()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.gateway = StubGateway({'APPID': '2016090800464004', 'URL': 'http://%s:%d' % self.server.server_address})
+
+    @override_settings(ALIPAY_NOTIFY_URL='')
+    def test_pay_and_query(self):
+        '''支付之前交易不存在，支付之后查询到支付成功，查询复用同一个连接池'''
+        self.assertEqual(self.gateway.query(1)['code'], '40004')
+
+        session = self.gateway.session()
+        session.get(self.gateway.page_pay_url(1, Decimal('15.00'), '天天生鲜1', time.time() + 60))
+
+        response = self.gateway.query(1)
+        self.assertEqual((response['code'], response['trade_status'], response['total_amount']),
+                         ('10000', 'TRADE_SUCCESS', '15.00'))
+        self.assertIs(self.gateway.session(), session)
+
+    @override_settings(ALIPAY_NOTIFY_URL='')
+    def test_close_and_refund(self):
+        '''关闭之后不能再支付，超过time_expire不能支付，支付之后可以全额退款'''
+        self.assertEqual(self.gateway.close(1)['sub_code'], 'ACQ.TRADE_NOT_EXIST')
+        self.assertEqual(self.gateway.session().get(self.gateway.page_pay_url(1, Decimal('15.00'), '天天生鲜1',
+                                                                              time.time() + 60)).text, '交易已关闭')
+        self.assertEqual(self.gateway.query(1)['trade_status'], 'TRADE_CLOSED')
+
+        self.gateway.session().get(self.gateway.page_pay_url(2, Decimal('15.00'), '天天生鲜2', time.time() - 1))
+        self.assertEqual(self.gateway.query(2)['trade_status'], 'TRADE_CLOSED')
+
+        self.gateway.session().get(self.gateway.page_pay_url(3, Decimal('15.00'), '天天生鲜3', time.time() + 60))
+        self.assertEqual(self.gateway.close(3)['sub_code'], 'ACQ.TRADE_STATUS_ERROR')
+        self.assertEqual(self.gateway.refund(3, Decimal('15.00'))['code'], '10000')
+        self.assertEqual(self.gateway.query(3)['trade_status'], 'TRADE_CLOSED')
+
+
+class SnowflakeTest(SimpleTestCase):
+    '''订单id生成器的测试'''
+
+    def test_unique_and_monotonic(self):
+        '''同一个worker的id单调递增，不同worker的id不重复'''
+        ids = [[Snowflake(worker_id).next_id() for i in range(10000)] for worker_id in (1, 2)]
+        for worker_ids in ids:
+            self.assertEqual(worker_ids, sorted(set(worker_ids)))
+        self.assertFalse(set(ids[0]) & set(ids[1]))
+        self.assertEqual(ids[0][0] >> SEQUENCE_BITS & ((1 << WORKER_BITS) - 1), 1)
+
+    def test_sequence_overflow(self):
+        '''一毫秒内生成超过4096个id时也不重复'''
+        with mock.patch('utils.snowflake.time.time', return_value=1500000000.0):
+            snowflake = Snowflake(3)
+            ids = [snowflake.next_id() for i in range(10000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_time_follows_clock(self):
+        '''id中的时间是生成时的实际时间，时钟回拨时仍然单调递增'''
+        snowflake = Snowflake(3)
+        with mock.patch('utils.snowflake.time.time', return_value=1500000000.0):
+            first = snowflake.next_id()
+        with mock.patch('utils.snowflake.time.time', return_value=1500000002.0):
+            second = snowflake.next_id()
+        self.assertEqual((id_time(second) - id_time(first)).total_seconds(), 2)
+
+        with mock.patch('utils.snowflake.time.time', return_value=1500000001.0):
+            self.assertGreater(snowflake.next_id(), second)
+
+    def test_worker_id_lease(self):
+        '''每个进程获取不同的worker id，租约被其他进程获取之后不能续约'''
+        conn = get_redis_connection('default')
+        first = acquire_worker_id(conn, 'first')
+        self.addCleanup(conn.delete, WORKER_LEASE_KEY % first)
+        second = acquire_worker_id(conn, 'second')
+        self.addCleanup(conn.delete, WORKER_LEASE_KEY % second)
+
+        self.assertNotEqual(first, second)
+        # 租约编号不会和uwsgi的worker编号重复
+        self.assertTrue(first & LEASE_PROCESS_FLAG and second & LEASE_PROCESS_FLAG)
+        self.assertTrue(renew_worker_id(conn, first, 'first'))
+        self.assertFalse(renew_worker_id(conn, first, 'second'))
+
+    @override_settings(SNOWFLAKE_HOST_ID=2)
+    def test_uwsgi_worker_id(self):
+        '''uwsgi的worker使用主机和worker的编号，不在uwsgi中运行时使用租约'''
+        with mock.patch('utils.snowflake.uwsgi', mock.Mock(**{'worker_id.return_value': 3})):
+            self.assertEqual(uwsgi_worker_id(), 2 << 5 | 3)
+        with mock.patch('utils.snowflake.uwsgi', None):
+            self.assertIsNone(uwsgi_worker_id())
+
+    def test_display_id(self):
+        '''展示形式以生成时间开头，和id一一对应'''
+        snowflake = Snowflake(0)
+        values = [snowflake.next_id() for i in range(100)]
+        displays = [display_id(value) for value in values]
+        self.assertEqual(len(set(displays)), len(values))
+        self.assertTrue(all(len(display) == 24 and display.isdigit() for display in displays))
@@ -0,0 +1,51 @@
+from django_redis import get_redis_connection
+
+
+# 异步创建的订单的处理结果
+# 下单请求放入队列之后立即返回订单id作为凭据，前端根据凭据轮询处理结果
+# order_ticket_订单id: {'user_id': 用户id, 'status': 处理状态, 'res': 失败时的res, 'errmsg': 失败时的errmsg}
+
+# 处理结果的保存时间
+TICKET_TIMEOUT = 3600
+
+# 处理状态
+TICKET_PENDING = 'pending'
+TICKET_SUCCESS = 'success'
+TICKET_FAILED = 'failed'
+
+
+def ticket_key(ticket):
+    return 'order_ticket_%d' % int(ticket)
+
+
+def init_ticket(pipe, ticket, user_id):
+    '''在pipeline中记录等待处理的订单，处理结果先于等待状态写入时不覆盖处理结果'''
+    key = ticket_key(ticket)
+    pipe.hset(key, 'user_id', user_id)
+    pipe.hsetnx(key, 'status', TICKET_PENDING)
+    pipe.expire(key, TICKET_TIMEOUT)
+
+
+def finish_tickets(succeeded, failures):
+    '''记录一批订单的处理结果，succeeded: [订单id, ...] failures: {订单id: OrderError}'''
+    if not succeeded and not failures:
+        return
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline(transaction=False)
+    for ticket in succeeded:
+        pipe.hmset(ticket_key(ticket), {'status': TICKET_SUCCESS})
+        pipe.expire(ticket_key(ticket), TICKET_TIMEOUT)
+    for ticket, error in failures.items():
+        pipe.hmset(ticket_key(ticket), {'status': TICKET_FAILED, 'res': error.res, 'errmsg': error.errmsg})
+        pipe.expire(ticket_key(ticket), TICKET_TIMEOUT)
+    pipe.execute()
+
+
+def get_ticket(ticket, user_id):
+    '''获取用户的订单的处理结果，凭据不存在或者不属于该用户时返回None'''
+    conn = get_redis_connection('default')
+    data = {key.decode(): value.decode() for key, value in conn.hgetall(ticket_key(ticket)).items()}
+    if data.get('user_id') != str(user_id) or 'status' not in data:
+        return None
+    return data
@@ -1,10 +1,12 @@
 from django.conf.urls import url
-from order.views import OrderPlaceView, OrderCommitView, OrderPayView, OrderCheckView, CommentView
+from order.views import OrderPlaceView, OrderCommitView, OrderStatusView, OrderPayView, OrderNotifyView, OrderCheckView, CommentView
 
 urlpatterns = [
     url(r'^place$', OrderPlaceView.as_view(), name='place'), # 提交订单页面显示
     url(r'^commit$', OrderCommitView.as_view(), name='commit'), # 订单创建
+    url(r'^status/(?P<ticket>\d+)$', OrderStatusView.as_view(), name='status'), # 订单处理结果查询
     url(r'^pay$', OrderPayView.as_view(), name='pay'), # 订单支付
+    url(r'^notify$', OrderNotifyView.as_view(), name='notify'), # 支付结果通知
     url(r'^check$', OrderCheckView.as_view(), name='check'), # 支付结果查询
-    url(r'^comment/(?P<order_id>.+)$', CommentView.as_view(), name='comment'),  # 订单评论
+    url(r'^comment/(?P<order_id>\d+)$', CommentView.as_view(), name='comment'),  # 订单评论
 ]
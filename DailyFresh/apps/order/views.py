@@ -3,17 +3,26 @@ from django.core.urlresolvers import reverse
 from django.views.generic import View
 from django.db import transaction
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 
 from user.models import Address
 from goods.models import GoodsSKU
+from cart.store import user_cart, get_cart_skus, delete_cart_items
 from order.models import OrderInfo, OrderGoods
+from order.commit import create_order, new_order_id, OrderError
+from order.flash_sale import reserve_flash_order
+from order.async_commit import enqueue_order
+from order.summary import set_order_status
+from order.tickets import get_ticket, TICKET_PENDING, TICKET_SUCCESS
+from order.gateway import get_gateway
+from order.payment import order_amount, start_payment, get_pay_status, verify_notify, confirm_payment, \
+    trade_expire_time, TRADE_PAID, PAY_SUCCESS, PAY_FAILED, PAY_REFUNDED, PAY_MIN_TIME
 
 from utils.mixin import LoginRequiredMixin
 from django_redis import get_redis_connection
-from alipay import AliPay
-from datetime import datetime
-import os
+import time
 
 
 # Create your views here.
@@ -38,28 +47,11 @@ class OrderPlaceView(LoginRequiredMixin, View):
         user = request.user
         addrs = Address.objects.filter(user=user)
 
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        skus = []
-        total_count = 0
-        total_price = 0
-        # 遍历获取用户要购买的商品的信息
-        for sku_id in sku_ids:
-            # 根据sku_id获取商品信息
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 获取用户所要购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
-            # 计算商品的小计
-            amount = sku.price * int(count)
-            # 动态给sku对象增加属性amount和count, 分别保存商品的小计和商品的数量
-            sku.amount = amount
-            sku.count = count
-            # 添加sku
-            skus.append(sku)
-            # 累加计算所要购买商品的总件数和总金额
-            total_count += int(count)
-            total_price += amount
+        # 一次获取用户要购买的商品的数目和信息
+        skus, total_count, total_price = get_cart_skus(user_cart(user.id), sku_ids)
+        if not skus:
+            # 商品都已经下线或者不在购物车中，跳转到购物车页面
+            return redirect(reverse('cart:show'))
 
         # 运费：运费的子系统
         transit_price = 10
@@ -68,7 +60,7 @@ class OrderPlaceView(LoginRequiredMixin, View):
         total_pay = total_price + transit_price
 
         # 组织上下文
-        sku_ids = ','.join(sku_ids)
+        sku_ids = ','.join(str(sku.id) for sku in skus)
         context = {'addrs': addrs,
                    'skus': skus,
                    'total_count': total_count,
@@ -118,8 +110,8 @@ class OrderCommitView1(View):
 
         # 业务处理:订单创建
         # 组织参数
-        # 订单id(order_id): 20171211182130+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        # 订单id(order_id): snowflake风格的id
+        order_id = new_order_id()
 
         # 运费
         transit_price = 10
@@ -195,7 +187,7 @@ class OrderCommitView1(View):
         transaction.savepoint_commit(sid)
 
         # todo: 删除购物车中的对应记录
-        conn.hdel(cart_key, *sku_ids)  # hdel(cart_key, 2, 5)
+        delete_cart_items(user_cart(user.id), sku_ids)
 
         # 返回应答
         return JsonResponse({'res': 5, 'message': '订单创建成功'})
@@ -206,7 +198,7 @@ class OrderCommitView1(View):
 class OrderCommitView(View):
     '''订单创建'''
 
-    @transaction.atomic
+    # create_order中自己管理事务，事务提交之后才修改redis中的购物车、销量排行和缓存
     def post(self, request):
         '''订单创建'''
         # 判断用户是否登录
@@ -223,116 +215,84 @@ class OrderCommitView(View):
         if not all([addr_id, pay_method, sku_ids]):
             return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
 
-        # 校验地址信息
-        try:
-            addr = Address.objects.get(id=addr_id)
-        except Address.DoesNotExist:
-            # 地址不存在
-            return JsonResponse({'res': 2, 'errmsg': '地址信息错误'})
-
         # 校验支付的方式
         if pay_method not in OrderInfo.PAY_METHODS.keys():
             # 支付方式非法
             return JsonResponse({'res': 3, 'errmsg': '非法的支付方式'})
 
-        # 业务处理:订单创建
-        # 组织参数
-        # 订单id(order_id): 20171211182130+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        try:
+            addr_id = int(addr_id)
+        except ValueError:
+            return JsonResponse({'res': 2, 'errmsg': '地址信息错误'})
 
-        # 运费
-        transit_price = 10
+        # 秒杀商品: 在redis中预扣数目之后直接返回，由celery批量写入数据库，抢不到时不访问数据库
+        try:
+            order_id = reserve_flash_order(user, addr_id, pay_method, sku_ids.split(','))
+        except OrderError as e:
+            return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
 
-        # 订单中商品的总数目和总价格
-        total_count = 0
-        total_price = 0
+        if order_id is not None:
+            return JsonResponse({'res': 5, 'message': '抢购成功，订单正在处理', 'order_id': str(order_id),
+                                 'ticket': str(order_id)})
 
-        # 设置保存点
-        sid = transaction.savepoint()
+        # 异步下单: 放入队列之后立即返回凭据，由celery按批创建订单，前端根据凭据查询处理结果
+        if settings.ORDER_ASYNC_COMMIT:
+            try:
+                ticket = enqueue_order(user, addr_id, pay_method, sku_ids.split(','))
+            except OrderError as e:
+                return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
+            return JsonResponse({'res': 5, 'message': '订单正在处理', 'ticket': str(ticket)})
 
+        # 校验地址信息
         try:
-            # todo: 需要向df_order_info添加一条记录
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_count=total_count,
-                                             total_price=total_price,
-                                             transit_price=transit_price)
-
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            # todo: 用户的订单中包含几个商品，应该向df_order_goods中添加几条记录
-            sku_ids = sku_ids.split(',')  # [2,5]
-            for sku_id in sku_ids:
-                for i in range(3):
-                    # 根据sku_id获取商品的信息
-                    try:
-                        # select * from df_goods_sku where id=sku_id;
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'res': 4, 'errmsg': '商品信息错误'})
-
-                    # 获取用户要购买的商品的数目
-                    count = conn.hget(cart_key, sku_id)
-
-                    # 判断商品的库存
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(sid)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-                    # todo: 减少商品的库存，增加销量
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - int(count)
-                    new_sales = sku.sales + int(count)
-                    # print('user:%d times:%d stock:%d'%(user.id, i, origin_stock))
-                    # import time
-                    # time.sleep(10)
-                    # update df_goods_sku set stock = new_stock, sales = new_sales
-                    # where id = sku_id and stock = origin_stock
-                    # 返回更新的行数
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock,
-                                                                                        sales=new_sales)
-                    if res == 0:
-                        # 更新失败
-                        if i == 2:
-                            # 尝试了3次，更新仍然失败
-                            transaction.savepoint_rollback(sid)
-                            return JsonResponse({'res': 7, 'errmsg': '订单错误2'})
-                        continue
-
-                    # todo: 向df_order_goods中添加1条记录
-                    OrderGoods.objects.create(order=order,
-                                              sku=sku,
-                                              count=count,
-                                              price=sku.price)
-
-                    # todo: 累加计算商品的总件数和总价格
-                    total_count += int(count)
-                    total_price += sku.price * int(count)
-
-                    # 更新成功之后跳转循环
-                    break
+            addr = Address.objects.get(id=addr_id)
+        except Address.DoesNotExist:
+            # 地址不存在
+            return JsonResponse({'res': 2, 'errmsg': '地址信息错误'})
 
-            # todo: 更新order中订单商品的总件数和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+        # 业务处理:订单创建
+        # 一次读取购物车，在一个事务中按照商品id的顺序锁定商品，批量减少库存、添加订单商品
+        try:
+            create_order(user, addr, pay_method, sku_ids.split(','))
+        except OrderError as e:
+            return JsonResponse({'res': e.res, 'errmsg': e.errmsg})
         except Exception as e:
-            transaction.savepoint_rollback(sid)
             return JsonResponse({'res': 7, 'errmsg': '下单失败'})
 
-        # 释放保存点
-        transaction.savepoint_commit(sid)
-
-        # todo: 删除购物车中的对应记录
-        conn.hdel(cart_key, *sku_ids)  # hdel(cart_key, 2, 5)
-
         # 返回应答
         return JsonResponse({'res': 5, 'message': '订单创建成功'})
 
 
+# /order/status/订单id
+# 采用ajax get请求
+# 异步下单和秒杀下单之后，前端根据返回的凭据轮询订单的处理结果
+class OrderStatusView(View):
+    '''订单处理结果查询'''
+
+    def get(self, request, ticket):
+        '''查询'''
+        # 判断用户是否登录
+        user = request.user
+        if not user.is_authenticated():
+            return JsonResponse({'res': 0, 'errmsg': '用户未登录'})
+
+        # 只访问redis，不查询数据库
+        data = get_ticket(ticket, user.id)
+        if data is None:
+            # 凭据不存在、已经过期或者不属于该用户
+            return JsonResponse({'res': 1, 'errmsg': '订单信息错误'})
+
+        if data['status'] == TICKET_PENDING:
+            return JsonResponse({'res': 2, 'status': data['status'], 'message': '订单正在处理'})
+
+        if data['status'] == TICKET_SUCCESS:
+            return JsonResponse({'res': 3, 'status': data['status'], 'order_id': ticket, 'message': '订单创建成功'})
+
+        # 下单失败，返回创建订单时的错误信息
+        return JsonResponse({'res': 4, 'status': data['status'], 'errcode': int(data['res']),
+                             'errmsg': data['errmsg']})
+
+
 # /order/pay
 # 采用ajax post请求
 # 前端传递的参数：订单id（order_id)
@@ -359,39 +319,53 @@ class OrderPayView(View):
                                           pay_method=3,
                                           order_status=1)
 
-        except OrderInfo.DoesNotExist:
+        except (OrderInfo.DoesNotExist, ValueError):
             # 订单信息错误
             return JsonResponse({'res': 2, 'errmsg': '订单信息错误'})
 
-        # 业务处理：调用支付宝的支付接口
-        # 初始化
-        alipay = AliPay(
-            appid="2016090800464004",  # 应用APPID
-            app_notify_url=None,  # 默认回调url
-            app_private_key_path=os.path.join(settings.BASE_DIR, 'apps/order/app_private_key.pem'),  # 私钥文件的路径
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, 'apps/order/alipay_public_key.pem'),
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False,代表真实环境
-        )
+        # 交易在订单超时取消之前关闭，剩余的时间太短时不再发起支付
+        time_expire = trade_expire_time(order)
+        if time_expire - time.time() < PAY_MIN_TIME:
+            return JsonResponse({'res': 4, 'errmsg': '订单支付已超时'})
 
+        # 业务处理：调用支付宝的支付接口
         # 电脑网站支付，需要跳转到https://openapi.alipay.com/gateway.do? + order_string
-        total_amount = order.total_price + order.transit_price  # Decimal
-        order_string = alipay.api_alipay_trade_page_pay(
-            out_trade_no=order_id,  # 订单id
-            total_amount=str(total_amount),  # 订单总金额
-            subject='天天生鲜%s' % order_id,  # 订单标题
-            return_url=None,
-            notify_url=None  # 可选, 不填则使用默认notify url
-        )
-
+        # 进程中的网关对象已经加载了密钥，不需要每次读取密钥文件
         # 支付页面地址
-        pay_url = "https://openapi.alipaydev.com/gateway.do?" + order_string
+        pay_url = get_gateway().page_pay_url(order_id, order_amount(order), '天天生鲜%s' % order_id, time_expire)
+
+        # 记录等待支付的状态，由支付宝的异步通知和celery的轮询确认支付结果
+        start_payment(order)
 
         # 返回应答
         return JsonResponse({'res': 3, 'pay_url': pay_url})
 
 
+# /order/notify
+# 支付宝的异步通知，采用post请求
+# 验证签名之后修改订单的状态，返回success之后支付宝不再重复通知
+class OrderNotifyView(View):
+    '''支付结果通知'''
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super(OrderNotifyView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        '''接收通知'''
+        result = verify_notify(request.POST.dict())
+        if result is None:
+            # 签名错误或者订单信息错误
+            return HttpResponse('failure')
+
+        order_id, trade_no, trade_status = result
+        if trade_status in TRADE_PAID and not confirm_payment(order_id, trade_no):
+            # 已经取消的订单退款失败，返回failure，支付宝稍后再次通知
+            return HttpResponse('failure')
+
+        return HttpResponse('success')
+
+
 # /order/check
 # 采用ajax post请求
 # 前端传递的参数：订单id（order_id)
@@ -413,76 +387,27 @@ class OrderCheckView(View):
         if not order_id:
             return JsonResponse({'res': 1, 'errmsg': '订单id不完整'})
 
-        # 获取订单信息
+        # 只读取redis中的支付状态，支付结果由支付宝的异步通知和celery的轮询确认
         try:
-            order = OrderInfo.objects.get(order_id=order_id,
-                                          user=user,
-                                          pay_method=3,
-                                          order_status=1)
-        except OrderInfo.DoesNotExist:
+            status = get_pay_status(order_id, user.id)
+        except ValueError:
+            status = None
+
+        if status is None:
             # 订单信息错误
             return JsonResponse({'res': 2, 'errmsg': '订单信息错误'})
 
-        # 业务处理：调用支付宝的支付接口 sdk
-        # 初始化
-        alipay = AliPay(
-            appid="2016090800464004",  # 应用APPID
-            app_notify_url=None,  # 默认回调url
-            app_private_key_path=os.path.join(settings.BASE_DIR, 'apps/order/app_private_key.pem'),  # 私钥文件的路径
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, 'apps/order/alipay_public_key.pem'),
-            # 支付宝的公钥，验证支付宝回传消息使用，不是你自己的公钥,
-            sign_type="RSA2",  # RSA 或者 RSA2
-            debug=True  # 默认False,代表真实环境
-        )
-
-        # 调用支付宝交易查询接口
-        # {
-        #      "trade_no": "2017032121001004070200176844", # 支付宝交易号
-        #      "code": "10000", # 网关返回码
-        #      "invoice_amount": "20.00",
-        #      "open_id": "20880072506750308812798160715407",
-        #      "fund_bill_list": [
-        #          {
-        #              "amount": "20.00",
-        #              "fund_channel": "ALIPAYACCOUNT"
-        #          }
-        #      ],
-        #      "buyer_logon_id": "csq***@sandbox.com",
-        #      "send_pay_date": "2017-03-21 13:29:17",
-        #      "receipt_amount": "20.00",
-        #      "out_trade_no": "out_trade_no15",
-        #      "buyer_pay_amount": "20.00",
-        #      "buyer_user_id": "2088102169481075",
-        #      "msg": "Success",
-        #      "point_amount": "0.00",
-        #      "trade_status": "TRADE_SUCCESS", # 支付交易状态
-        #      "total_amount": "20.00"
-        #  }
-
-        while True:
-            response = alipay.api_alipay_trade_query(out_trade_no=order_id)
-            code = response.get('code')
-            print('code:%s' % code)
-
-            if code == '10000' and response.get('trade_status') == 'TRADE_SUCCESS':
-                # 用户支付成功
-                # 获取支付宝交易号
-                trade_no = response.get('trade_no')
-                # 更新订单支付状态，设置支付宝交易号
-                order.order_status = 4  # 待评价
-                order.trade_no = trade_no
-                order.save()
-                # 返回应答
-                return JsonResponse({'res': 4, 'message': '支付成功'})
-            elif code == '40004' or (code == '10000' and response.get('trade_status') == 'WAIT_BUYER_PAY'):
-                # 等待买家付款
-                # 支付订单还未创建，一会就可能成功
-                import time
-                time.sleep(5)
-                continue
-            else:
-                # 支付错误
-                return JsonResponse({'res': 3, 'errmsg': '支付失败'})
+        if status == PAY_SUCCESS:
+            return JsonResponse({'res': 4, 'message': '支付成功'})
+
+        if status == PAY_FAILED:
+            return JsonResponse({'res': 3, 'errmsg': '支付失败'})
+
+        if status == PAY_REFUNDED:
+            return JsonResponse({'res': 6, 'errmsg': '订单已超时取消，支付的款项已经退回'})
+
+        # 等待买家付款
+        return JsonResponse({'res': 5, 'message': '等待支付'})
 
 
 # /order/comment/订单id
@@ -553,5 +478,6 @@ class CommentView(LoginRequiredMixin, View):
 
         order.order_status = 5  # 已完成
         order.save()
+        set_order_status([order.order_id], order.order_status)
 
         return redirect(reverse("user:order", kwargs={"page": 1}))
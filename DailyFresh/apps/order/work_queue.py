@@ -0,0 +1,75 @@
+from order.models import OrderInfo
+import json
+import time
+
+
+# 订单队列的可靠取出
+# 取出一批订单时在lua脚本中原子地把它们从队列移到处理中的有序集合，分数是取出的时间
+# 订单写入数据库、处理完结果之后才从处理中的集合删除(确认)
+# worker在取出之后、确认之前被杀死时，订单留在处理中的集合，超过QUEUE_CLAIM_TIMEOUT之后放回队列的头部重新处理
+# 重新处理的订单可能已经写入了数据库，处理之前先按订单id过滤掉已经创建的订单
+
+# 取出之后多久没有确认就认为处理的worker已经退出(秒)，远大于处理一批订单的时间
+QUEUE_CLAIM_TIMEOUT = 60
+
+# 取出一批订单，移到处理中的集合
+# KEYS[1]: 队列 KEYS[2]: 处理中的集合 ARGV[1]: 最多取出的数目 ARGV[2]: 当前时间
+CLAIM_SCRIPT = '''
+local items = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], #items, -1)
+    for _, item in ipairs(items) do
+        redis.call('zadd', KEYS[2], ARGV[2], item)
+    end
+end
+return items
+'''
+
+# 把超时没有确认的订单放回队列的头部，保持原来的顺序
+# KEYS[1]: 队列 KEYS[2]: 处理中的集合 ARGV[1]: 取出时间早于该时间的订单超时
+REQUEUE_SCRIPT = '''
+local items = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])
+for i = #items, 1, -1 do
+    redis.call('lpush', KEYS[1], items[i])
+end
+if #items > 0 then
+    redis.call('zrem', KEYS[2], unpack(items))
+end
+return #items
+'''
+
+
+def processing_key(queue_key):
+    '''队列对应的处理中的集合'''
+    return queue_key + '_processing'
+
+
+def claim_batch(conn, queue_key, size):
+    '''从队列中取出一批订单，返回[(队列中的原始数据, 订单数据), ...]'''
+    items = conn.register_script(CLAIM_SCRIPT)(keys=[queue_key, processing_key(queue_key)],
+                                               args=[size, time.time()])
+    batch = []
+    for item in items:
+        data = json.loads(item.decode() if isinstance(item, bytes) else item)
+        data['counts'] = {int(sku_id): count for sku_id, count in data['counts'].items()}
+        batch.append((item, data))
+    return batch
+
+
+def ack_batch(conn, queue_key, batch):
+    '''订单处理完成，从处理中的集合删除'''
+    if batch:
+        conn.zrem(processing_key(queue_key), *[item for item, data in batch])
+
+
+def requeue_stale(conn, queue_key, timeout=QUEUE_CLAIM_TIMEOUT):
+    '''把取出之后超时没有确认的订单放回队列，返回放回的数目'''
+    return conn.register_script(REQUEUE_SCRIPT)(keys=[queue_key, processing_key(queue_key)],
+                                                args=[time.time() - timeout])
+
+
+def split_created(requests):
+    '''重新处理的订单可能已经创建，返回(还没有创建的订单, 已经创建的订单id)'''
+    created = set(OrderInfo.objects.filter(order_id__in=[request['order_id'] for request in requests])
+                  .values_list('order_id', flat=True))
+    return [request for request in requests if request['order_id'] not in created], sorted(created)
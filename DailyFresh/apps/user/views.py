@@ -1,20 +1,22 @@
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator
 from django.contrib.auth import authenticate, login, logout
 from django.http import HttpResponse
 from django.conf import settings
 from django.views.generic import View
 
 from user.models import User, Address
-from goods.models import GoodsSKU
-from order.models import OrderInfo, OrderGoods
+from order.models import OrderInfo
+from order.history import get_order_page
+from order.summary import get_summary_page, schedule_build_user_summary
+from cart.store import merge_guest_cart
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import SignatureExpired
 from celery_tasks.tasks import send_register_active_email
 from utils.mixin import LoginRequiredMixin
-from django_redis import get_redis_connection
+from utils.pagination import page_range
+from utils.user_state import get_history
 import re
 
 
@@ -159,9 +161,16 @@ class LoginView(View):
             if user.is_active:
                 # 用户已经激活哦
 
+                # 登录会更换session_key，先记录未登录时的购物车
+                session_key = request.session.session_key
+
                 # 记住用户的登录状态
                 login(request, user)
 
+                # 把未登录时的购物车合并到用户的购物车
+                if session_key is not None:
+                    merge_guest_cart(session_key, user.id)
+
                 # 获取登录后跳转的的地址， 默认商品首页
                 next_url = request.GET.get('next', 'goods:index')
 
@@ -219,22 +228,8 @@ class UserInfoView(View):
         # 获取用户的默认地址
         address = Address.objects.get_default_address(user)
 
-        # 获取用户最近浏览记录
-        conn = get_redis_connection('default')
-        history_key = 'history_%d' % user.id
-
-        # 获取最近5个商品记录
-        sku_ids = conn.lrange(history_key, 0, 4)
-
-        # 获取用户浏览的商品的信息
-        skus_li = []
-        skus = GoodsSKU.objects.filter(id__in=sku_ids)
-
-        for sku_id in sku_ids:
-            # 遍历商品的信息
-            for sku in skus:
-                if sku.id == int(sku_id):
-                    skus_li.append(sku)
+        # 获取用户最近浏览的商品，按照浏览的先后排列
+        skus = get_history(user.id)
 
         # 组织模板上下文
         context = {'skus': skus, 'address': address, 'page': 'user'}
@@ -338,55 +333,27 @@ class UserOrderView(LoginRequiredMixin,View):
 
         # 获取登陆的用户
         user = request.user
-        # 获取用户的订单信息
-        orders = OrderInfo.objects.filter(user=user).order_by("-create_time")
-        # 遍历orders 获取每个订单的订单商品信息
-        for order in orders:
-            # 查询和order相关的订单商品的信息
-            order_skus = OrderGoods.objects.filter(order=order)
-            # 遍历order_skus,计算订单中每个商品的小计
-            for order_sku in order_skus:
-                # 计算小计
-                amount = order_sku.count * order_sku.price
-                # orser_sku增加属性,保存订单商品的小计
-                order_sku.amount = amount
-            # 计算订单的实付款
-            total_amount = order.total_price + order.transit_price
-
-            # 获取订单状态的名称
-            status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            # 给order动态增加属性order_skus，保存订单商品的属性
-            order.order_skus = order_skus
-            order.total_amount = total_amount
-            order.status_name = status_name
-
-        # 分页
-        paginator = Paginator(orders,1)
-
-        # 处理页码，
-        page = int(page)
-
-        # 获取page页的Page对象
-        order_page = paginator.page(page)
+
+        # 从redis中的读模型获取一页订单和各种状态的订单数目
+        order_page, counts = get_summary_page(user.id, int(page))
+        if order_page is None:
+            # 读模型还没有生成，先从数据库查询，同时发出生成读模型的任务
+            # 先分页，只查询第page页的订单和这些订单的订单商品，小计和实付款由数据库计算
+            order_page = get_order_page(user.id, int(page))
+            schedule_build_user_summary(user.id)
+            counts = {}
 
         # 处理页码
         # 总页数小于5时，显示总页数
         # 当前页是前3页时，显示前5页
         # 当前页时后3页时，显示后5页
         # 当前页的前两页，当前页，当前页的后两页
-        num_pages = paginator.num_pages
-        if num_pages <= 5:
-            pages = range(1, num_pages + 1)
-        elif page <= 3:
-            pages = range(1, 6)
-        elif num_pages - page <= 2:
-            pages = range(num_pages - 4, num_pages + 1)
-        else:
-            pages = range(page - 2, page + 3)
+        pages = page_range(order_page.number, order_page.num_pages)
 
         # 组织模板上下文
         content = {'order_page':order_page,
                    'pages':pages,
+                   'unpaid_count': counts.get(str(OrderInfo.ORDER_STATUS_ENUM['UNPAID'])),
                    'page': 'order'}
 
         return render(request,"user_center_order.html",content)
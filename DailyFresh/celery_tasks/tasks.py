@@ -3,6 +3,7 @@ from django.conf import settings
 from django.core.mail import send_mail
 from django.template import loader
 from celery import Celery
+from celery.signals import worker_ready
 
 
 # 初始化django运行所依赖的环境
@@ -13,12 +14,49 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DailyFresh.settings")
 django.setup()
 
 
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.index_data import get_index_data
+from goods.static_pages import static_index_wait_time, begin_static_index_html, index_fingerprint, \
+    static_index_changed, save_static_index_fingerprint, write_static_file, generate_static_detail_pages, \
+    pop_static_detail_pending, static_detail_chunks, begin_static_detail_rebuild
+from goods.ranking import reconcile_sales
+from goods.search_signals import pop_search_pending, apply_search_updates
+from goods.suggest import save_suggest_snapshot
+from order import flash_sale, async_commit, expiry, payment, summary
+from order.gateway import get_gateway
+
+
+# 轮询支付结果的任务使用的支付网关，worker启动时加载密钥
+get_gateway()
 
 
 # 创建一个Celery类的对象
 app = Celery('celery_tasks.tasks', broker='redis://127.0.0.1:6379/9')
 
+# 定时任务，需要启动celery beat
+app.conf.beat_schedule = {
+    # 每小时根据订单商品校正一次销量排行
+    'reconcile-hot-sales': {
+        'task': 'celery_tasks.tasks.reconcile_hot_sales',
+        'schedule': 3600,
+    },
+    # 每分钟取消一次超时未支付的订单
+    'expire-unpaid-orders': {
+        'task': 'celery_tasks.tasks.expire_unpaid_orders',
+        'schedule': 60,
+    },
+    # 每分钟把worker退出时没有处理完的订单放回队列
+    'recover-order-queues': {
+        'task': 'celery_tasks.tasks.recover_order_queues',
+        'schedule': 60,
+    },
+}
+
+# 异步下单的任务放在单独的队列中，只由一个worker进程处理，不和其他任务争抢worker
+# celery -A celery_tasks.tasks worker -Q orders -c 1
+app.conf.task_routes = {
+    'celery_tasks.tasks.process_order_requests': {'queue': 'orders'},
+}
+
 
 # 定义任务函数
 @app.task
@@ -41,36 +79,25 @@ def send_register_active_email(to_email, username, token):
 def generate_static_index_html():
     '''生成静态首页'''
 
-    # 获取商品的分类信息
-    types = GoodsType.objects.all()
+    # 等待期间又有新的修改，推迟生成
+    wait = static_index_wait_time()
+    if wait > 0:
+        generate_static_index_html.apply_async(countdown=wait)
+        return
 
-    # 获取首页的轮播商品信息
-    index_banner = IndexGoodsBanner.objects.all().order_by('index')
+    # 之后的修改会发出新的生成任务
+    begin_static_index_html()
 
-    # 获取首页促销活动信息
-    promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
+    # 获取首页展示的数据
+    context = get_index_data()
 
-    # 获取首页分类商品展示信息
-    # type_banner = IndexTypeGoodsBanner.objects.all()
-    for type in types:
-        # 查询type类型首页展示的文字商品的信息
-        title_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-        # 查询type类型首页展示的图片商品的信息
-        image_banner = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-        # 动态给type对象增加两个属性:
-        # title_banner(保存type类型首页展示的文字商品)
-        # image_banner(保存type类型首页展示的图片商品)
-        type.title_banner = title_banner
-        type.image_banner = image_banner
+    # 数据没有变化，不需要重新生成
+    value = index_fingerprint(context)
+    if not static_index_changed(value):
+        return
 
     # 获取用户购物车中商品的数目
-    cart_count = 0
-
-    # 组织模板上下文
-    context = {'types': types,
-               'index_banner': index_banner,
-               'promotion_banner': promotion_banner,
-               'cart_count': cart_count}
+    context.update(cart_count=0)
 
     # 生成静态首页的内容
     # 1.加载模板文件
@@ -79,7 +106,94 @@ def generate_static_index_html():
     # 2.模板渲染：产生标准的html页面内容
     static_html = temp.render(context)
 
-    # 生成静态文件0
-    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
-    with open(save_path, 'w') as f:
-        f.write(static_html)
+    # 生成静态文件以及压缩文件
+    write_static_file('index.html', static_html)
+    save_static_index_fingerprint(value)
+
+
+@app.task
+def generate_static_detail_html():
+    '''重新生成数据变化的商品的静态详情页'''
+    sku_ids = pop_static_detail_pending()
+    if sku_ids:
+        generate_static_detail_pages(sku_ids)
+
+
+@app.task
+def generate_static_detail_chunk(sku_ids):
+    '''生成一组商品的静态详情页'''
+    return generate_static_detail_pages(sku_ids)
+
+
+@app.task
+def rebuild_static_detail_html():
+    '''重新生成所有商品的静态详情页，分组之后交给多个worker进程并行处理'''
+    # 之后的修改会发出新的生成任务
+    begin_static_detail_rebuild()
+    for sku_ids in static_detail_chunks():
+        generate_static_detail_chunk.delay(sku_ids)
+
+
+@app.task
+def reconcile_hot_sales():
+    '''根据订单商品校正redis中的销量排行'''
+    reconcile_sales()
+
+
+@app.task
+def update_search_index():
+    '''批量更新数据变化的商品的全文检索索引'''
+    sku_ids = pop_search_pending()
+    if sku_ids:
+        apply_search_updates(sku_ids)
+
+
+@app.task
+def generate_suggest_snapshot():
+    '''生成搜索提示的前缀索引的快照'''
+    save_suggest_snapshot()
+
+
+@app.task
+def settle_flash_orders():
+    '''把预扣成功的秒杀订单批量写入数据库'''
+    flash_sale.settle_flash_orders()
+
+
+@app.task
+def recover_order_queues():
+    '''把worker退出时没有处理完的订单放回队列'''
+    flash_sale.recover_flash_orders()
+    async_commit.recover_order_requests()
+
+
+@worker_ready.connect
+def recover_on_startup(**kwargs):
+    '''worker启动时放回之前退出的worker没有处理完的订单'''
+    recover_order_queues.delay()
+
+
+@app.task
+def process_order_requests():
+    '''按批创建队列中的订单'''
+    async_commit.process_order_requests()
+
+
+@app.task
+def expire_unpaid_orders():
+    '''取消超时未支付的订单，归还库存'''
+    expiry.expire_orders()
+
+
+@app.task
+def poll_payment(order_id, attempt=0):
+    '''查询订单的支付结果，还没有支付时间隔加倍之后再次查询'''
+    delay = payment.poll_payment(order_id, attempt)
+    if delay is not None:
+        poll_payment.apply_async((order_id, attempt + 1), countdown=delay)
+
+
+@app.task
+def build_order_summary(user_id):
+    '''生成用户订单的读模型'''
+    summary.build_user_summary(user_id)
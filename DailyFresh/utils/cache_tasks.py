@@ -0,0 +1,28 @@
+from django.core.cache import cache
+
+
+# 缓存版本号的增加和celery任务的合并发出，多个模块共用
+
+
+def incr_version(key):
+    '''增加版本号，使用旧版本号生成的缓存名称的缓存失效'''
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 版本号不存在
+        cache.set(key, 1, None)
+
+
+def schedule_once(key, timeout, name, args=(), countdown=None, value=1):
+    '''
+    发出celery_tasks.tasks中名称为name的任务，key存在期间的请求不再重复发出，返回是否发出了任务
+    任务开始执行时删除key，之后的请求会发出新的任务
+    timeout: key的过期时间，防止任务丢失之后再也无法发出任务
+    '''
+    if not cache.add(key, value, timeout):
+        return False
+
+    # 任务模块导入了各个app的模块，在这里导入
+    from celery_tasks import tasks
+    getattr(tasks, name).apply_async(args, countdown=countdown)
+    return True
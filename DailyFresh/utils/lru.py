@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    '''进程内的LRU缓存，超过maxsize时删除最久没有使用的数据，数据超过ttl秒之后过期'''
+
+    # get没有命中时的返回值
+    MISSING = object()
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # uwsgi的一个进程中有多个线程
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''获取数据，没有命中时返回LRUCache.MISSING'''
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return self.MISSING
+
+            value, expires = item
+            if expires < time.time():
+                # 数据已经过期
+                del self._data[key]
+                return self.MISSING
+
+            # 最近使用过的数据移动到末尾
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        '''设置数据'''
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                # 删除最久没有使用的数据
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        '''删除数据'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''删除所有数据'''
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,116 @@
+from django.db.models import Q
+
+
+# 基于游标(keyset)的分页
+# 根据上一页最后一条记录的排序字段的值查询下一页，不需要从头OFFSET扫描
+# 游标按需生成: 查询一页时记录该页最后一条记录的排序字段的值，顺序翻页不需要额外的查询
+# 跳到没有游标的页时，从最近的已知游标开始只扫描排序字段的索引，只查询一条记录
+
+
+class KeysetPage(object):
+    '''分页的结果，提供模板中用到的django Page对象的属性和方法'''
+
+    def __init__(self, object_list, number, num_pages):
+        self.object_list = object_list
+        self.number = number
+        self.num_pages = num_pages
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+def page_range(page, num_pages):
+    '''页面上显示的页码列表'''
+    # 1.总页数<5, 显示所有页码
+    # 2.当前页是前3页，显示1-5页
+    # 3.当前页是后3页，显示后5页
+    # 4.其他情况，显示当前页的前2页，当前页，当前页的后2页
+    if num_pages < 5:
+        return range(1, num_pages + 1)
+    elif page <= 3:
+        return range(1, 6)
+    elif num_pages - page <= 2:
+        return range(num_pages - 4, num_pages + 1)
+    else:
+        return range(page - 2, page + 3)
+
+
+def order_by_fields(ordering):
+    '''排序方式转换为order_by的参数'''
+    # ordering: ((字段名, 是否降序), ...)
+    return ['-' + field if desc else field for field, desc in ordering]
+
+
+def keyset_filter(ordering, cursor):
+    '''查询排在cursor之后的记录的条件'''
+    # (a, b) > (x, y) 等价于 a > x or (a = x and b > y)
+    condition = Q()
+    for i, (field, desc) in enumerate(ordering):
+        lookup = {f: value for (f, d), value in zip(ordering[:i], cursor[:i])}
+        lookup[field + ('__lt' if desc else '__gt')] = cursor[i]
+        condition |= Q(**lookup)
+    return condition
+
+
+def row_cursor(obj, ordering):
+    '''记录的排序字段的值'''
+    return tuple(getattr(obj, field) for field, desc in ordering)
+
+
+def page_cursor(queryset, ordering, cursors, per_page, page):
+    '''
+    查询第page页最后一条记录的排序字段的值，记录不足时返回None
+    cursors: 已知的游标{页码: 该页最后一条记录的排序字段的值}，从page之前最近的已知游标开始扫描
+    '''
+    known = max([number for number in cursors if number < page], default=0)
+    queryset = queryset.order_by(*order_by_fields(ordering))
+    if known:
+        queryset = queryset.filter(keyset_filter(ordering, cursors[known]))
+
+    # 只查询排序字段，可以只扫描索引
+    offset = (page - known) * per_page - 1
+    rows = list(queryset.values_list(*[field for field, desc in ordering])[offset:offset + 1])
+    return tuple(rows[0]) if rows else None
+
+
+def keyset_page(queryset, ordering, cursors, count, per_page, page):
+    '''
+    获取第page页，page不合法时返回第1页
+    cursors: 已知的游标{页码: 该页最后一条记录的排序字段的值}，生成的游标加入cursors，由调用的一方缓存
+    '''
+    num_pages = max(1, (count + per_page - 1) // per_page)
+    if page <= 0 or page > num_pages:
+        # 默认获取第1页的内容
+        page = 1
+
+    queryset = queryset.order_by(*order_by_fields(ordering))
+    if page > 1:
+        if page - 1 not in cursors:
+            cursor = page_cursor(queryset, ordering, cursors, per_page, page - 1)
+            if cursor is None:
+                # 记录数目已经变化，还没有失效
+                return keyset_page(queryset, ordering, cursors, count, per_page, 1)
+            cursors[page - 1] = cursor
+        queryset = queryset.filter(keyset_filter(ordering, cursors[page - 1]))
+
+    object_list = list(queryset[:per_page])
+    if len(object_list) == per_page:
+        # 顺序翻到下一页时不需要再查询游标
+        cursors.setdefault(page, row_cursor(object_list[-1], ordering))
+
+    return KeysetPage(object_list, page, num_pages)
@@ -0,0 +1,182 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+from datetime import datetime
+import itertools
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    # 在uwsgi中运行时可以获取worker的编号
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+# snowflake风格的id: 41位毫秒时间戳 + 10位worker id + 12位序号，保存在64位整数中
+# 同一个worker生成的id单调递增，不同的worker生成的id不会重复
+# 每个进程保存(当前毫秒, 这一毫秒的序号计数器)，生成id时读取实际时间，序号只需要next(itertools.count)，不需要加锁
+# 只在进入新的一毫秒、一毫秒内生成超过4096个id时加锁换一个计数器，每毫秒最多一次
+# 序号用完时借用下一毫秒，时钟回拨时继续使用上一次的时间，id仍然单调递增
+# worker id: 高5位是主机，低5位是进程，uwsgi中使用worker的编号(1-15)
+# 其他进程(celery等)通过redis中的租约获取16-31中空闲的编号，同一时间不会有两个进程使用同一个worker id
+
+# 时间戳的起始时间 2017-01-01 00:00:00 UTC
+EPOCH = 1483228800000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# worker id中进程的位数，进程编号的高位为1时是通过租约获取的编号
+PROCESS_BITS = 5
+LEASE_PROCESS_FLAG = 1 << (PROCESS_BITS - 1)
+
+# worker id的租约 snowflake_worker_编号: 持有租约的进程的标识
+WORKER_LEASE_KEY = 'snowflake_worker_%d'
+# 分配worker id时开始尝试的位置，进程依次错开
+WORKER_COUNTER_KEY = 'snowflake_worker_counter'
+# 租约的有效时间(秒)
+WORKER_LEASE_TIMEOUT = 600
+# 续约的间隔(秒)
+WORKER_LEASE_RENEW = 60
+
+# 租约仍然属于当前进程时续约，返回1，否则返回0
+# KEYS[1]: 租约 ARGV[1]: 进程的标识 ARGV[2]: 有效时间
+RENEW_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+
+def host_id():
+    '''
+    worker id中的主机编号(0-31)
+    默认为主机名的crc32，多台主机部署时通过settings.SNOWFLAKE_HOST_ID指定，避免哈希冲突
+    '''
+    value = getattr(settings, 'SNOWFLAKE_HOST_ID', None)
+    if value is None:
+        value = zlib.crc32(socket.gethostname().encode('utf-8'))
+    return value & ((1 << (WORKER_BITS - PROCESS_BITS)) - 1)
+
+
+def uwsgi_worker_id():
+    '''在uwsgi的worker进程中使用主机和worker的编号，不在uwsgi中运行时返回None'''
+    if uwsgi is None or uwsgi.worker_id() <= 0:
+        return None
+    return host_id() << PROCESS_BITS | (uwsgi.worker_id() & (LEASE_PROCESS_FLAG - 1))
+
+
+def acquire_worker_id(conn, token):
+    '''获取当前主机一个空闲的租约编号作为worker id'''
+    base = host_id() << PROCESS_BITS | LEASE_PROCESS_FLAG
+    start = conn.incr(WORKER_COUNTER_KEY)
+    for i in range(LEASE_PROCESS_FLAG):
+        worker_id = base | (start + i) % LEASE_PROCESS_FLAG
+        if conn.set(WORKER_LEASE_KEY % worker_id, token, nx=True, ex=WORKER_LEASE_TIMEOUT):
+            return worker_id
+    raise RuntimeError('没有空闲的worker id')
+
+
+def renew_worker_id(conn, worker_id, token):
+    '''续约，租约已经过期并被其他进程获取时返回False'''
+    script = conn.register_script(RENEW_SCRIPT)
+    return bool(script(keys=[WORKER_LEASE_KEY % worker_id], args=[token, WORKER_LEASE_TIMEOUT]))
+
+
+class Snowflake(object):
+    '''id生成器'''
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker id必须在0到%d之间' % MAX_WORKER_ID)
+        self.worker_id = worker_id
+        # (当前毫秒, 这一毫秒的序号计数器)，整体替换，同一毫秒只会有一个计数器
+        self._tick = (-1, itertools.count())
+        # 只在换计数器时使用
+        self._tick_lock = threading.Lock()
+
+    def next_id(self):
+        '''生成一个id'''
+        timestamp, counter = self._tick
+        # 从EPOCH开始的毫秒数，不调用函数以减少开销
+        now = int(time.time() * 1000) - EPOCH
+        if now > timestamp:
+            # 进入新的一毫秒
+            timestamp, counter = self._advance(timestamp, now)
+
+        sequence = next(counter)
+        while sequence > SEQUENCE_MASK:
+            # 序号用完，借用下一毫秒
+            timestamp, counter = self._advance(timestamp, timestamp + 1)
+            sequence = next(counter)
+
+        return timestamp << (WORKER_BITS + SEQUENCE_BITS) | self.worker_id << SEQUENCE_BITS | sequence
+
+    def _advance(self, timestamp, now):
+        '''当前毫秒还是timestamp时换成now的计数器，时间只会前进，返回新的(毫秒, 计数器)'''
+        with self._tick_lock:
+            if self._tick[0] == timestamp:
+                self._tick = (now, itertools.count())
+            return self._tick
+
+
+def id_time(value):
+    '''id中的时间'''
+    return datetime.fromtimestamp(((value >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0)
+
+
+def display_id(value):
+    '''
+    id的展示形式: 生成时间(年月日时分秒) + 10位数字(毫秒、worker id和序号)
+    例如 20171211182130 + 0704663552，和id一一对应
+    '''
+    rest = (value >> (WORKER_BITS + SEQUENCE_BITS)) % 1000 << (WORKER_BITS + SEQUENCE_BITS) | \
+        value & ((1 << (WORKER_BITS + SEQUENCE_BITS)) - 1)
+    return '%s%010d' % (id_time(value).strftime('%Y%m%d%H%M%S'), rest)
+
+
+# 每个进程的id生成器，uwsgi fork出worker进程之后需要在worker进程中重新获取worker id
+_generator = {'pid': None, 'snowflake': None, 'token': None, 'renewed': 0}
+# 不使用租约的进程的续约时间
+NO_RENEW = float('inf')
+_generator_lock = threading.Lock()
+
+
+def _lease(pid, now):
+    '''获取当前进程的worker id，使用租约时续约'''
+    worker_id = getattr(settings, 'SNOWFLAKE_WORKER_ID', None)
+    if worker_id is None:
+        worker_id = uwsgi_worker_id()
+    if worker_id is not None:
+        # 明确指定或者uwsgi的worker，不需要续约
+        _generator.update(pid=pid, snowflake=Snowflake(worker_id), renewed=NO_RENEW)
+        return
+
+    conn = get_redis_connection('default')
+    if _generator['pid'] == pid and renew_worker_id(conn, _generator['snowflake'].worker_id, _generator['token']):
+        _generator['renewed'] = now
+        return
+
+    # 新的进程，或者长时间没有续约，租约已经被其他进程获取
+    token = '%s:%d:%s' % (socket.gethostname(), pid, uuid.uuid4().hex)
+    _generator.update(pid=pid, snowflake=Snowflake(acquire_worker_id(conn, token)), token=token, renewed=now)
+
+
+def next_id():
+    '''使用当前进程的id生成器生成一个id'''
+    pid = os.getpid()
+    # 不使用租约时不需要读取时间
+    if _generator['pid'] != pid or \
+            _generator['renewed'] != NO_RENEW and time.time() - _generator['renewed'] >= WORKER_LEASE_RENEW:
+        with _generator_lock:
+            now = time.time()
+            if _generator['pid'] != pid or now - _generator['renewed'] >= WORKER_LEASE_RENEW:
+                _lease(pid, now)
+    return _generator['snowflake'].next_id()
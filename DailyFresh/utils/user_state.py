@@ -0,0 +1,80 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from cart.store import request_cart
+from goods.sku_cache import get_sku_cards, CARD_KEY_PREFIX
+from order.models import OrderInfo
+from order.summary import user_counts_key
+
+
+# 用户在redis中保存的状态: 购物车商品的条目数、浏览记录、待支付的订单数目
+# 每个页面需要执行的redis命令通过pipeline一次发送，只需要一次网络往返
+
+# 获取浏览记录和这些商品的卡片缓存，一次往返
+# 商品卡片的名称根据商品id生成
+# KEYS[1]: 浏览记录 ARGV[1]: 获取的数目 ARGV[2]: 商品卡片名称的前缀
+HISTORY_CARDS_SCRIPT = '''
+local ids = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #ids == 0 then
+    return {ids, {}}
+end
+local keys = {}
+for i, sku_id in ipairs(ids) do
+    keys[i] = ARGV[2] .. sku_id
+end
+return {ids, redis.call('mget', unpack(keys))}
+'''
+
+
+def history_key(user_id):
+    return 'history_%d' % user_id
+
+
+def get_history(user_id, count=None):
+    '''按照浏览的先后获取用户最近浏览的商品卡片，最新浏览的在前'''
+    conn = get_redis_connection('default')
+    script = conn.register_script(HISTORY_CARDS_SCRIPT)
+    sku_ids, cached = script(keys=[history_key(user_id)], args=[count or settings.HISTORY_LENGTH, CARD_KEY_PREFIX])
+    return get_sku_cards(sku_ids, cached)
+
+
+def load_user_state(request, viewed_sku_id=None):
+    '''获取页面头部需要的用户状态，viewed_sku_id不为None时同时添加到登录用户的浏览记录'''
+
+    # 没有登录时使用session中的购物车，没有session时购物车为空
+    user = request.user
+    cart = request_cart(request)
+    if cart is None:
+        return {'cart_count': 0}
+
+    conn = get_redis_connection('default')
+
+    # 不需要事务，只是把命令一次发送给redis
+    pipe = conn.pipeline(transaction=False)
+
+    # 获取购物车商品的条目数
+    pipe.hlen(cart.key)
+
+    if user.is_authenticated():
+        # 获取待支付的订单数目，用户的订单读模型还没有生成时为None
+        pipe.hget(user_counts_key(user.id), OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    if viewed_sku_id is not None and user.is_authenticated():
+        # 添加到浏览记录
+        key = history_key(user.id)
+
+        # 先尝试从redis列表中移除元素sku_id
+        pipe.lrem(key, 0, viewed_sku_id)
+
+        # 把元素sku_id添加到redis列表的左侧
+        pipe.lpush(key, viewed_sku_id)
+
+        # 只保留用户最新浏览的几个商品的id
+        pipe.ltrim(key, 0, settings.HISTORY_LENGTH - 1)
+
+    results = pipe.execute()
+
+    state = {'cart_count': results[0]}
+    if user.is_authenticated() and results[1] is not None:
+        state['unpaid_count'] = int(results[1])
+    return state